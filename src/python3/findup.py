@@ -1,439 +1,3495 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import cProfile
+import ctypes
+import ctypes.util
+import datetime
+import errno
 import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import math
+import mmap
 import os
 import platform
+import queue
 import re
+import select
+import shlex
+import sqlite3
+import struct
+import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 import zlib
 from argparse import Namespace
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple
 
 import humanize
 import mmh3
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 PROG_NAME = "findup"
 PROG_VERSION = "1.0"
 COPYRIGHT = "Copyright (c) Kirill Shirokov, 2022-2025"
 
 
-# Globals
-""" Min. memory buffer size for reading files when calculating hashes and doing binary comparisons """
-INTERNAL_FILE_BUFFER_SIZE: int = 8 * 1024 * 1024
+class FileStat(NamedTuple):
+    """ File metadata gathered during scanning, enough to identify file contents without reading them """
+    size: int
+    dev: int
+    ino: int
+    mtime_ns: int
+    """ Number of allocated 512-byte blocks (st_blocks), or -1 if the OS does not provide it """
+    blocks: int
+
+
+class FileTable:
+    """
+    Compact table of all found files. Directory paths are stored once per directory, and other file attributes
+    are stored in typed arrays, which takes much less memory than a dict entry per file.
+    If the table grows over --memory-limit, its records are sorted by size and spilled to a temporary run file,
+    and the table starts over. Runs are merged back when the files are grouped by size, see iter_size_groups().
+    No more than --max-open-files run files are kept: when there are so many, they are merged into one.
+    """
+    """ Run file record header: size, device, inode, mtime, blocks, length of the path which follows the header """
+    RUN_RECORD = struct.Struct("<QQQqqI")
+    """ Min. memory taken by the records spilled to one run file, so that a tiny --memory-limit does not create
+    a run file per found file """
+    MIN_RUN_MEMORY = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.runs: list[BinaryIO] = []
+        self.spilled_count = 0
+        self.string_bytes = 0
+        self.dirs: list[str] = []
+        self.dir_ids: dict[str, int] = {}
+        self.dir_id = array.array('I')
+        self.name: list[str] = []
+        self.size = array.array('Q')
+        self.dev = array.array('Q')
+        self.ino = array.array('Q')
+        self.mtime_ns = array.array('q')
+        self.blocks = array.array('q')
+
+    def __len__(self) -> int:
+        return len(self.name) + self.spilled_count
+
+    def add(self, file_name: str, stat: FileStat) -> None:
+        dir_name, name = os.path.split(file_name)
+        # Files of the same directory come one after another, so try the last directory first
+        if not self.dirs or self.dirs[-1] != dir_name:
+            dir_id = self.dir_ids.get(dir_name)
+            if dir_id is None:
+                dir_id = self.dir_ids[dir_name] = len(self.dirs)
+                self.dirs.append(dir_name)
+                self.string_bytes += sys.getsizeof(dir_name)
+        else:
+            dir_id = len(self.dirs) - 1
+
+        self.dir_id.append(dir_id)
+        self.name.append(name)
+        self.string_bytes += sys.getsizeof(name)
+        self.size.append(stat.size)
+        self.dev.append(stat.dev)
+        self.ino.append(stat.ino)
+        self.mtime_ns.append(stat.mtime_ns)
+        self.blocks.append(stat.blocks)
+
+        if ARGS.memory_limit > 0 and self.memory_usage() > max(ARGS.memory_limit, self.MIN_RUN_MEMORY):
+            self.spill()
+
+    def path(self, i: int) -> str:
+        return os.path.join(self.dirs[self.dir_id[i]], self.name[i])
+
+    def stat(self, i: int) -> FileStat:
+        return FileStat(self.size[i], self.dev[i], self.ino[i], self.mtime_ns[i], self.blocks[i])
+
+    def spill(self) -> None:
+        """
+        Writes all records of the table sorted by size to a new temporary run file and clears the table.
+        If there are --max-open-files run files then, merges them into one.
+        """
+        run = tempfile.TemporaryFile(prefix=f"{PROG_NAME}-run-")
+        order = sorted(range(len(self.name)), key=self.size.__getitem__)
+        run.writelines(self.pack_record(self.path(i), self.stat(i)) for i in order)
+        self.runs.append(run)
+        self.spilled_count += len(order)
+        self.__init_records()
+
+        if len(self.runs) >= max(ARGS.max_open_files, 2):
+            self.runs = [self.merge_run_files(self.runs)]
+            print_verbose1(f"Merged run files of {self.spilled_count} files into one")
+
+    def __init_records(self) -> None:
+        runs, spilled_count = self.runs, self.spilled_count
+        self.__init__()
+        self.runs, self.spilled_count = runs, spilled_count
+
+    @classmethod
+    def pack_record(cls, file_name: str, stat: FileStat) -> bytes:
+        path = os.fsencode(file_name)
+        return cls.RUN_RECORD.pack(stat.size, stat.dev, stat.ino, stat.mtime_ns, stat.blocks, len(path)) + path
+
+    @classmethod
+    def read_run(cls, run: BinaryIO) -> Iterator[tuple[int, str, FileStat]]:
+        """
+        Reads records of a run file written by spill() or merge_run_files().
+
+        :param run: Run file
+        :return: Iterator over (size, file name, file stat) tuples in the order of file sizes
+        """
+        run.seek(0)
+        while header := run.read(cls.RUN_RECORD.size):
+            size, dev, ino, mtime_ns, blocks, path_length = cls.RUN_RECORD.unpack(header)
+            yield size, os.fsdecode(run.read(path_length)), FileStat(size, dev, ino, mtime_ns, blocks)
+
+    @classmethod
+    def merge_run_files(cls, runs: list[BinaryIO]) -> BinaryIO:
+        """
+        Merges run files into a new run file and closes them.
+
+        :param runs: Run files
+        :return: Merged run file
+        """
+        merged_run = tempfile.TemporaryFile(prefix=f"{PROG_NAME}-run-")
+        merged_run.writelines(cls.pack_record(file_name, stat) for size, file_name, stat
+                              in heapq.merge(*map(cls.read_run, runs), key=lambda r: r[0]))
+        for run in runs:
+            run.close()
+        return merged_run
+
+    def merge_runs(self) -> Iterator[tuple[int, str, FileStat]]:
+        """
+        Merges run files. There are no more than --max-open-files of them, see spill().
+
+        :return: Iterator over (size, file name, file stat) tuples of all runs in the order of file sizes
+        """
+        return heapq.merge(*map(self.read_run, self.runs), key=lambda r: r[0])
+
+    def iter_files(self) -> Iterator[tuple[str, FileStat]]:
+        """
+        Iterates over all files of the table, including the ones spilled to run files (in the order of file sizes
+        in this case).
+
+        :return: Iterator over (file name, file stat) tuples
+        """
+        if not self.runs:
+            for i in range(len(self.name)):
+                yield self.path(i), self.stat(i)
+            return
+
+        if self.name:
+            self.spill()
+
+        for size, file_name, stat in self.merge_runs():
+            yield file_name, stat
+
+    def iter_size_groups(self) -> Iterator[tuple[int, list[tuple[str, FileStat]]]]:
+        """
+        Groups files by size, dropping files with unique sizes. A file found more than once, because the scanned
+        paths repeat or overlap, is included only once. If the table has been spilled to run files, groups are formed
+        by merging the runs, so that only one group at a time is kept in memory.
+
+        :return: Iterator over (size, list of (file name, file stat) tuples) in the order of file sizes
+        """
+        if not self.runs:
+            for size, indexes in self.group_by_size().items():
+                group = {self.path(i): self.stat(i) for i in indexes}
+                if len(group) >= 2:
+                    yield size, list(group.items())
+            return
+
+        if self.name:
+            self.spill()
+        print_verbose1(f"Merging {len(self.runs)} run files of {self.spilled_count} files...")
+
+        for size, records in itertools.groupby(self.merge_runs(), key=lambda r: r[0]):
+            group = {file_name: stat for _, file_name, stat in records}
+            if len(group) >= 2:
+                yield size, list(group.items())
+
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+    def group_by_size(self) -> dict[int, list[int]]:
+        """
+        Groups files by size, dropping files with unique sizes. Sorts file sizes with NumPy if it is installed.
+
+        :return: dict: size -> indexes of the files of this size in the table, ordered by size
+        """
+        if numpy is not None:
+            sizes = numpy.frombuffer(self.size, dtype=numpy.uint64)
+            order = numpy.argsort(sizes, kind="stable")
+            sorted_sizes = sizes[order]
+            bounds = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(sorted_sizes)) + 1, [len(sizes)]))
+            starts = bounds[:-1]
+            ends = bounds[1:]
+            is_group = ends - starts >= 2
+            return {int(sorted_sizes[start]): order[start:end].tolist()
+                    for start, end in zip(starts[is_group].tolist(), ends[is_group].tolist())}
+
+        order = sorted(range(len(self.size)), key=self.size.__getitem__)
+        indexes_by_size = {}
+        for size, indexes in itertools.groupby(order, key=self.size.__getitem__):
+            indexes = list(indexes)
+            if len(indexes) >= 2:
+                indexes_by_size[size] = indexes
+        return indexes_by_size
+
+    def memory_usage(self) -> int:
+        """
+        Estimates memory used by the table.
+
+        :return: Size in bytes
+        """
+        arrays = (self.dir_id, self.size, self.dev, self.ino, self.mtime_ns, self.blocks)
+        return (sum(a.buffer_info()[1] * a.itemsize for a in arrays) + self.string_bytes +
+                sys.getsizeof(self.name) + sys.getsizeof(self.dirs) + sys.getsizeof(self.dir_ids))
+
+
+# Globals
+""" Comparison stages, see --stages argument """
+FINGERPRINT_STAGES: tuple[str, ...] = ("prefix", "suffix", "samples", "full")
+
+""" Min. memory buffer size for reading files when calculating hashes and doing binary comparisons """
+INTERNAL_FILE_BUFFER_SIZE: int = 8 * 1024 * 1024
+
+""" Parsed program arguments """
+ARGS: Namespace = Namespace()
+
+""" All found files """
+FILE_TABLE: FileTable = FileTable()
+""" Candidate files (having the same size as some other file) grouped by size, see collect_candidates() """
+FILES_BY_SIZE: dict[int, list[str]] = {}
+""" Size and identity (device, inode, mtime) per each candidate file """
+STAT_BY_FILE: dict[str, FileStat] = {}
+""" Estimated memory taken by a candidate file besides its name: dict and list entries, FileStat, hashes """
+CANDIDATE_MEMORY_OVERHEAD = 256
+""" Other names of the same files (hard links), per the alphabetically first name of the file """
+HARD_LINKS_BY_FILE: dict[str, list[str]] = {}
+""" Compiled file and directory name filters, see compile_path_filters() """
+PATH_FILTERS: dict[str, Any] = {}
+""" Filesystem cluster size in bytes (None if unknown) per device (st_dev), see get_cluster_size() """
+CLUSTER_SIZE_BY_DEV: dict[int, int | None] = {}
+
+""" FIEMAP ioctl request code and structures (see linux/fiemap.h), used to find physical location of file data """
+FS_IOC_FIEMAP: int = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+FIEMAP_EXTENT = struct.Struct("=QQQQQIIII")
+""" FIEMAP extent flags meaning that the physical location is not known yet: FIEMAP_EXTENT_UNKNOWN, DELALLOC """
+FIEMAP_EXTENT_NOT_LOCATED: int = 0x2 | 0x4
+""" Devices which do not support FIEMAP, to avoid trying it for every file """
+FIEMAP_UNSUPPORTED_DEVS: set[int] = set()
+
+""" Pool of hashing workers (see --jobs argument), created on the first use """
+HASH_EXECUTOR: concurrent.futures.Executor | None = None
+
+""" Alignment of file offsets, sizes and memory buffers for reading with O_DIRECT (see --read-policy argument) """
+DIRECT_IO_ALIGNMENT: int = 4096
+""" Number of bytes requested from files and disk read counter (from /proc/self/io) at start, see --io-stats """
+IO_STATS: dict[str, int] = {"requested_bytes": 0, "start_read_bytes": 0}
+
+""" Reusable buffers for reading file blocks with --io-method=readinto, see acquire_read_buffer() """
+READ_BUFFER_POOL: list[memoryview] = []
+READ_BUFFER_POOL_LOCK: threading.Lock = threading.Lock()
+
+""" Persistent hash cache database (see --cache argument), or None if the cache is disabled """
+HASH_CACHE: sqlite3.Connection | None = None
+""" Hash cache usage counters reported by --cache-stats """
+HASH_CACHE_STATS: dict[str, int] = {"hits": 0, "misses": 0, "stale": 0, "evicted": 0, "bytes_saved": 0}
+""" Timestamp of the current run, used to find least recently used hash cache entries """
+HASH_CACHE_RUN_TIME: int = 0
+""" How often new hash cache entries are committed, in seconds, so that an interrupted run does not lose them """
+HASH_CACHE_COMMIT_INTERVAL: float = 5.0
+""" Time of the last hash cache commit, see time.monotonic() """
+HASH_CACHE_COMMIT_TIME: float = 0.0
+
+""" Manifest file format name and version, see --write-manifest argument """
+MANIFEST_FORMAT: str = "findup-manifest"
+MANIFEST_VERSION: int = 1
+""" Reference index format version, see --build-index argument """
+INDEX_VERSION: int = 1
+""" Number of files hashed at once while writing a manifest or an index, or querying an index """
+HASH_BATCH_SIZE: int = 4096
+""" Max. number of files and total size of the size groups hashed at once before reporting their duplicates,
+see iter_hash_windows() """
+HASH_WINDOW_FILES: int = 4096
+HASH_WINDOW_BYTES: int = 256 * 1024 * 1024
+
+""" Statistics of the stages of the run (see --stats argument): stage name -> counter name -> value """
+STAGE_STATS: dict[str, dict[str, float]] = {}
+""" Largest duplicate groups reported by --stats: heap of (wasted disk space, file size, number of files, file name) """
+LARGEST_GROUPS: list[tuple[int, int, int, str]] = []
+""" Number of largest duplicate groups reported by --stats """
+LARGEST_GROUP_COUNT: int = 10
+
+""" Running --exec commands: (argv, process, stdin writer thread or None), oldest first """
+EXEC_PROCESSES: collections.deque[tuple[list[str], subprocess.Popen, threading.Thread | None]] = collections.deque()
+""" Groups of identical files waiting to be given to --exec command in the next batch (see --exec-batch) """
+EXEC_BATCH: list[list[str]] = []
+""" Number of started --exec commands and number of failed ones by exit code """
+EXEC_STATS: dict[str, Any] = {"started": 0, "failed": {}}
+
+""" ioctl request to clone a file on copy-on-write filesystems (btrfs, XFS), see ioctl_ficlone(2) """
+FICLONE: int = 0x40049409
+""" Counters of --action results: files acted on and their allocated space, skipped (changed) and failed files """
+ACTION_STATS: dict[str, int] = {"done": 0, "bytes": 0, "skipped": 0, "failed": 0}
+
+""" inotify(7) event mask bits and flags used by --watch """
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+""" Events of watched directories which can create, change or remove a file """
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+""" inotify event header: watch descriptor, mask, cookie, length of the name which follows the header """
+INOTIFY_EVENT = struct.Struct("iIII")
+""" libc with inotify functions, inotify file descriptor and watched directories by watch descriptor """
+LIBC: ctypes.CDLL | None = None
+WATCH_FD: int | None = None
+WATCH_DIRS: dict[int, str] = {}
+""" All scanned files and their stats, file names by size and full hashes of the files, see --watch """
+WATCH_FILES: dict[str, FileStat] = {}
+WATCH_FILES_BY_SIZE: dict[int, set[str]] = {}
+WATCH_HASHES: dict[str, bytes] = {}
+""" Files replaced by --action while watching, with the device and inode numbers they got, see --watch """
+WATCH_REPLACED_FILES: dict[str, tuple[int, int]] = {}
+
+""" Separator of archive and member names in virtual file names of archive members, see --archives """
+ARCHIVE_SEPARATOR: str = "!"
+""" File name extensions of the archives scanned with --archives """
+ARCHIVE_EXTENSIONS: tuple[str, ...] = (".zip", ".jar", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz",
+                                       ".txz")
+""" Virtual device number of archive members, which have no real device and inode numbers """
+ARCHIVE_MEMBER_DEV: int = 2 ** 64 - 1
+""" First virtual inode number of the members of each archive by archive (device, inode) """
+ARCHIVE_MEMBER_INOS: dict[tuple[int, int], int] = {}
+""" Next free virtual inode number """
+ARCHIVE_MEMBER_NEXT_INO: int = 1
+""" Archive kept open by open_archive_member() in each thread: ((archive name, mtime), ZipFile or TarFile) """
+OPEN_ARCHIVE: threading.local = threading.local()
+
+""" Number of bytes the rolling gear hash of content-defined chunking depends on, see --chunks """
+CHUNK_WINDOW: int = 32
+""" Random values added to the rolling gear hash for each byte value, the same in every run """
+GEAR: tuple[int, ...] = struct.unpack("<256I", hashlib.shake_128(b"findup gear table").digest(1024))
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if numpy is not None else None
+
+""" Progress counters and state of the progress line, see report_progress() """
+PROGRESS: dict[str, Any] = {"files_scanned": 0, "bytes_scanned": 0, "bytes_to_hash": 0, "bytes_hashed": 0,
+                            "hash_start_time": 0.0, "next_time": 0.0, "shown": False}
+PROGRESS_LOCK: threading.Lock = threading.Lock()
+""" Minimum interval between progress line updates in seconds """
+PROGRESS_INTERVAL: float = 1.0
+
+""" Files to hash while scanning (see --pipeline argument): (file name, file stat) tuples, None at the end of scan """
+PREFETCH_QUEUE: queue.Queue | None = None
+""" Max. number of files waiting in PREFETCH_QUEUE. When the queue is full, the scan waits for hashing """
+PREFETCH_QUEUE_SIZE: int = 4096
+""" First found file of each size (None after the second file of this size is found), used by schedule_prefetch() """
+FIRST_FILE_BY_SIZE: dict[int, tuple[str, FileStat] | None] = {}
+""" Hashes of the first stage calculated while scanning: (device, inode, hash kind) -> (file stat, hash, is cached) """
+PREFETCHED_HASHES: dict[tuple[int, int, str], tuple[FileStat, bytes, bool]] = {}
+""" Max. number of entries in PREFETCHED_HASHES, unless --memory-limit allows less, see get_prefetch_limit() """
+PREFETCHED_HASHES_MAX: int = 1000000
+
+
+def main() -> None:
+    """
+    Parses arguments and runs the program, under cProfile if --profile argument is given.
+    """
+    global ARGS
+    ARGS = process_args()
+
+    if ARGS.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run)
+        finally:
+            profiler.dump_stats(ARGS.profile)
+            print_verbose1(f"Profile saved to {ARGS.profile}, see python3 -m pstats {ARGS.profile}")
+    else:
+        run()
+
+
+def run() -> None:
+    """
+    Main functionality:
+    1. obtains paths to scan,
+    2. adds all files in these paths into global tables above,
+    3. finds and reports duplicates (or writes a manifest or a reference index, or queries a reference index)
+    """
+    if ARGS.hash == "auto":
+        ARGS.hash = choose_hash_engine()
+
+    if ARGS.merge:
+        merge_manifests(ARGS.merge)
+        return
+
+    if ARGS.io_stats:
+        IO_STATS["start_read_bytes"] = get_disk_read_bytes() or 0
+
+    paths = get_paths()
+    compile_path_filters()
+
+    if ARGS.cache:
+        open_hash_cache(ARGS.cache)
+
+    index = open_index(ARGS.build_index or ARGS.against, ARGS.build_index is not None) \
+        if ARGS.build_index or ARGS.against else None
+
+    if ARGS.watch:
+        start_watch()
+
+    stage_start = start_stage()
+    if ARGS.pipeline:
+        scan_and_prefetch(paths)
+    else:
+        scan_paths(paths)
+    add_stage_stats("scan", stage_start, len(FILE_TABLE), len(FILE_TABLE))
+
+    if ARGS.write_manifest:
+        write_manifest(ARGS.write_manifest)
+    elif ARGS.build_index:
+        build_index(index)
+    elif ARGS.against:
+        query_index(index)
+    elif ARGS.watch:
+        init_watched_files()
+        find_duplicates()
+        watch()
+    else:
+        chunk_files = collect_chunk_files() if ARGS.chunks else None
+        find_duplicates()
+        if ARGS.chunks:
+            find_shared_chunks(chunk_files)
+
+    if index:
+        index.commit()
+        index.close()
+
+    if HASH_EXECUTOR:
+        HASH_EXECUTOR.shutdown()
+
+    if ARGS.io_stats:
+        report_io_stats()
+
+    if ARGS.progress:
+        report_progress(final=True)
+
+    if ARGS.stats:
+        report_stats()
+
+    if HASH_CACHE:
+        close_hash_cache()
+
+
+def scan_paths(paths: list[str]) -> None:
+    """
+    Adds all files in the given paths into global tables, see add_files().
+
+    :param paths: Filesystem paths to scan
+    """
+    for path in paths:
+        save_cluster_size(path)
+        add_files(path)
+
+
+def scan_and_prefetch(paths: list[str]) -> None:
+    """
+    Scans the given paths in a separate thread, and meanwhile calculates hashes of the first stage (see --stages)
+    for the files which already have a file of the same size found (see schedule_prefetch()), so that reading files
+    overlaps with the scan. The hashes are saved in PREFETCHED_HASHES and picked up by get_file_hashes() later.
+
+    :param paths: Filesystem paths to scan
+    """
+    global PREFETCH_QUEUE
+
+    PREFETCH_QUEUE = queue.Queue(PREFETCH_QUEUE_SIZE)
+    scan_errors = []
+
+    def scan() -> None:
+        try:
+            scan_paths(paths)
+        except BaseException as ex:
+            scan_errors.append(ex)
+        finally:
+            PREFETCH_QUEUE.put(None)
+
+    scanner = threading.Thread(target=scan, name="scanner")
+    scanner.start()
+
+    prefetched_count = 0
+    prefetched_size = 0
+    batch_size = max(ARGS.jobs, 1) * 4
+    scan_finished = False
+    while not scan_finished:
+        batch = [PREFETCH_QUEUE.get()]
+        while len(batch) < batch_size and batch[-1] is not None:
+            try:
+                batch.append(PREFETCH_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+
+        if batch[-1] is None:
+            batch.pop()
+            scan_finished = True
+
+        count, size = prefetch_hashes(batch)
+        prefetched_count += count
+        prefetched_size += size
+
+    scanner.join()
+    PREFETCH_QUEUE = None
+    FIRST_FILE_BY_SIZE.clear()
+    if scan_errors:
+        raise scan_errors[0]
+
+    print_verbose1(f"Hashed {prefetched_count} files ({humanize.naturalsize(prefetched_size)}) while scanning")
+
+
+def schedule_prefetch(file_name: str, stat: FileStat) -> None:
+    """
+    Queues the file for hashing while scanning, if another file of the same size has already been found.
+    The first found file of the size is queued together with the second one.
+
+    :param file_name: File name
+    :param stat: File metadata as collected by add_file()
+    """
+    first_file = FIRST_FILE_BY_SIZE.get(stat.size, ())
+    if first_file == ():
+        FIRST_FILE_BY_SIZE[stat.size] = (file_name, stat)
+        return
+
+    if first_file:
+        PREFETCH_QUEUE.put(first_file)
+        FIRST_FILE_BY_SIZE[stat.size] = None
+
+    PREFETCH_QUEUE.put((file_name, stat))
+
+
+def prefetch_hashes(batch: list[tuple[str, FileStat]]) -> tuple[int, int]:
+    """
+    Calculates (or looks up in the hash cache) hashes of the first stage for the files queued by schedule_prefetch()
+    and saves them into PREFETCHED_HASHES. Hard links to the same file are hashed only once. If a file of the batch
+    cannot be read, the others are hashed one by one, and the file is skipped: find_duplicates() will read it again.
+    When PREFETCHED_HASHES is full (see get_prefetch_limit()), the files are left for find_duplicates() too.
+
+    :param batch: list of (file name, file stat) tuples
+    :return: Tuple of (number of hashed files, number of bytes hashed)
+    """
+    stage = ARGS.stages[0]
+    prefetch_limit = get_prefetch_limit()
+    requests_by_key = {}
+    for file_name, stat in batch:
+        kind = get_stage_kind(stage, stat.size)
+        key = (stat.dev, stat.ino, kind)
+        if key in PREFETCHED_HASHES or key in requests_by_key:
+            continue
+        if len(PREFETCHED_HASHES) + len(requests_by_key) >= prefetch_limit:
+            break
+
+        ranges = get_stage_ranges(stage, stat.size)
+        if HASH_CACHE:
+            file_hash = get_cached_hash(stat, kind)
+            if file_hash is not None:
+                HASH_CACHE_STATS["bytes_saved"] += sum(length for offset, length in ranges) if ranges else stat.size
+                PREFETCHED_HASHES[key] = (stat, file_hash, True)
+                continue
+
+        requests_by_key[key] = ((file_name, kind, ranges), stat)
+
+    requests = [request for request, stat in requests_by_key.values()]
+    stats = [stat for request, stat in requests_by_key.values()]
+    try:
+        file_hashes = calc_file_hashes(requests, stats)
+    except OSError:
+        file_hashes = []
+        for request, stat in zip(requests, stats):
+            try:
+                file_hashes.append(calc_file_hashes([request], [stat])[0])
+            except OSError as ex:
+                print_verbose2(f"    Cannot hash {request[0]} while scanning: {ex.strerror}")
+                file_hashes.append(None)
+
+    hashed_size = 0
+    for key, ((file_name, kind, ranges), stat), file_hash in zip(requests_by_key, requests_by_key.values(),
+                                                                 file_hashes):
+        if file_hash is not None:
+            PREFETCHED_HASHES[key] = (stat, file_hash, False)
+            hashed_size += sum(length for offset, length in ranges) if ranges else stat.size
+
+    return sum(file_hash is not None for file_hash in file_hashes), hashed_size
+
+
+def get_prefetch_limit() -> int:
+    """
+    Returns the maximum number of hashes kept in PREFETCHED_HASHES: PREFETCHED_HASHES_MAX, or less if --memory-limit
+    is given, so that the hashes take no more than half of the limit.
+
+    :return: Maximum number of entries
+    """
+    if ARGS.memory_limit > 0:
+        return min(PREFETCHED_HASHES_MAX, ARGS.memory_limit // 2 // CANDIDATE_MEMORY_OVERHEAD)
+
+    return PREFETCHED_HASHES_MAX
+
+
+def pop_prefetched_hash(stat: FileStat, kind: str) -> bytes | None:
+    """
+    Takes a hash calculated while scanning from PREFETCHED_HASHES. Stores it into the persistent hash cache
+    (if enabled by --cache argument) unless it has been taken from there.
+
+    :param stat: File metadata as collected by add_file()
+    :param kind: Hash kind, see get_stage_kind()
+    :return: Hash or None if it has not been calculated
+    """
+    prefetched = PREFETCHED_HASHES.pop((stat.dev, stat.ino, kind), None)
+    if not prefetched or prefetched[0] != stat:
+        return None
+
+    prefetched_stat, file_hash, is_cached = prefetched
+    if HASH_CACHE and not is_cached:
+        put_cached_hash(stat, kind, file_hash)
+
+    return file_hash
+
+
+def get_paths() -> list[str]:
+    """
+    Extracts list of directory paths to scan from argument file or stdin (--paths option) plus command-line arguments.
+
+    :return: List of directory paths to scan, or emtpy list if none
+    """
+    dirlist = []
+    if ARGS.paths_file:
+        dirlist.extend([line.strip() for line in ARGS.paths_file])
+
+    if ARGS.paths:
+        dirlist.extend(ARGS.paths)
+
+    return dirlist
+
+
+def add_files(path: str) -> None:
+    """
+    Scans the path for the subdirectories and files using os.scandir(), visiting each directory exactly once.
+    Adds files to the global list of candidate files. If the path does not exist, just does nothing.
+    File type and metadata are taken from directory entries, so that no extra stat() calls are needed where the OS
+    provides this info while listing directories. Symbolic links are followed only if --follow-symlinks is given.
+    Excluded directories (see get_dir_exclusion()) are not scanned at all.
+    Entries which vanish or cannot be accessed during the scan are reported in verbose mode and skipped.
+
+    :param path: Filesystem path to scan.
+    """
+    print_verbose1(f"Scanning {path}:")
+
+    if not os.path.isdir(path):
+        if os.path.isfile(path):
+            add_file(path)
+        return
+
+    follow_symlinks = ARGS.follow_symlinks
+    start_time = time.monotonic()
+    dir_count = 0
+    file_count = 0
+    pending_dirs = [path]
+    visited_dirs = set()
+
+    if follow_symlinks:
+        stat = os.stat(path)
+        visited_dirs.add((stat.st_dev, stat.st_ino))
+
+    while pending_dirs:
+        dir_path = pending_dirs.pop()
+        sub_dirs = []
+
+        if WATCH_FD is not None:
+            add_watch(dir_path)
+
+        try:
+            with os.scandir(dir_path) as entries:
+                dir_count += 1
+
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            exclusion = get_dir_exclusion(entry.path)
+                            if exclusion:
+                                print_verbose2("    SKIPPED: %s%s: excluded via %s", entry.path, os.sep, exclusion)
+                                continue
+
+                            if follow_symlinks:
+                                # Symbolic links may form loops, so make sure every directory is visited only once
+                                stat = entry.stat()
+                                if (stat.st_dev, stat.st_ino) in visited_dirs:
+                                    continue
+                                visited_dirs.add((stat.st_dev, stat.st_ino))
+
+                            sub_dirs.append(entry.path)
+
+                        elif entry.is_file(follow_symlinks=follow_symlinks):
+                            file_count += 1
+                            add_file(entry.path, entry)
+
+                    except OSError as ex:
+                        print_verbose1(f"    SKIPPED: {entry.path}: {ex.strerror}")
+
+        except OSError as ex:
+            print_verbose1(f"    SKIPPED: {dir_path}: {ex.strerror}")
+
+        # Keep the directory listing order: the stack is popped from its end
+        pending_dirs.extend(reversed(sub_dirs))
+
+    elapsed_time = max(time.monotonic() - start_time, 1e-9)
+    print_verbose1(f"Scanned {dir_count} directories and {file_count} files in {elapsed_time:.3f} s "
+                   f"({dir_count / elapsed_time:.0f} directories/s)")
+
+
+def save_cluster_size(path: str) -> None:
+    """
+    Saves cluster size of the filesystem of the given path into a global variable CLUSTER_SIZE_BY_DEV.
+    Cluster size is used to calculate wasted disk space due to duplicates. Exceptions are silently ignored.
+
+    :param path: Path to find cluster size for
+    """
+    try:
+        cluster_size = get_cluster_size(path, os.stat(path).st_dev)
+        if cluster_size:
+            print_verbose2(f"Cluster size: {humanize.naturalsize(cluster_size)}")
+
+    except OSError as ex:
+        print_verbose3(f"Error obtaining cluster size for {path}: {ex}")
+
+
+def add_file(file_name: str, entry: os.DirEntry = None) -> None:
+    """
+    Adds a file to global table of found files (FILE_TABLE).
+    File is not added if it is excluded or not included by the name (-x, -X, -I), its size is out of the range
+    (-m, -M) or it was modified out of the time range (--modified-after, --modified-before). Name filters are checked
+    first, so excluded files are not even stat()'ed.
+
+    :param file_name: File name to add
+    :param entry: Directory entry of the file, if it was found by scanning a directory, to reuse its metadata
+    """
+    exclusion = get_file_exclusion(file_name)
+    if exclusion:
+        print_verbose2("    SKIPPED: %s: %s", file_name, exclusion)
+        return
+
+    stat = entry.stat(follow_symlinks=ARGS.follow_symlinks) if entry else os.stat(file_name)
+    file_stat = FileStat(stat.st_size, stat.st_dev, stat.st_ino, stat.st_mtime_ns, getattr(stat, "st_blocks", -1))
+
+    if ARGS.archives and file_name.lower().endswith(ARCHIVE_EXTENSIONS):
+        add_archive_members(file_name, file_stat)
+
+    exclusion = get_stat_exclusion(file_stat)
+    if exclusion:
+        print_verbose2("    SKIPPED: %s: %s", file_name, exclusion)
+        return
+
+    print_verbose2("    %s: %d bytes", file_name, file_stat.size)
+    FILE_TABLE.add(file_name, file_stat)
+
+    if ARGS.progress:
+        PROGRESS["files_scanned"] += 1
+        PROGRESS["bytes_scanned"] += file_stat.size
+        report_progress()
+
+    if PREFETCH_QUEUE:
+        schedule_prefetch(file_name, file_stat)
+
+
+def get_stat_exclusion(stat: FileStat) -> str | None:
+    """
+    Checks if a file is out of the size range (-m, -M) or out of the modification time range (--modified-after,
+    --modified-before).
+
+    :param stat: File metadata
+    :return: Reason of the exclusion, or None if the file is not excluded
+    """
+    if stat.size < ARGS.min_file_size:
+        return f"{stat.size} bytes (too small)"
+
+    if ARGS.max_file_size is not None and stat.size > ARGS.max_file_size:
+        return f"{stat.size} bytes (too large)"
+
+    if ARGS.modified_after is not None and stat.mtime_ns <= ARGS.modified_after:
+        return "modified too long ago"
+
+    if ARGS.modified_before is not None and stat.mtime_ns >= ARGS.modified_before:
+        return "modified too recently"
+
+    return None
+
+
+def add_archive_members(archive_name: str, archive_stat: FileStat) -> None:
+    """
+    Adds regular files inside a zip or tar archive to FILE_TABLE as virtual files named "<archive>!<member>"
+    (see --archives argument), applying the same filters as to other files. Only the archive index is read here,
+    member contents are read when they are hashed, see open_archive_member().
+    Members get a virtual device number ARCHIVE_MEMBER_DEV and virtual inode numbers, which are the same for all
+    hard links to the archive, so the members of such archives are hard links to each other, not duplicates.
+    Members take no disk space of their own, so they never count as wasted space.
+
+    :param archive_name: Archive file name
+    :param archive_stat: Archive file metadata
+    """
+    global ARCHIVE_MEMBER_NEXT_INO
+
+    try:
+        if zipfile.is_zipfile(archive_name):
+            with zipfile.ZipFile(archive_name) as archive:
+                members = [(info.filename, info.file_size,
+                            int(datetime.datetime(*info.date_time).timestamp() * 1e9))
+                           for info in archive.infolist() if not info.is_dir()]
+        else:
+            with tarfile.open(archive_name) as archive:
+                members = [(info.name, info.size, int(info.mtime * 1e9)) for info in archive if info.isfile()]
+
+    except (OSError, ValueError, zipfile.BadZipFile, tarfile.TarError) as ex:
+        print_verbose1("    SKIPPED: %s: not a readable archive: %s", archive_name, ex)
+        return
+
+    first_ino = ARCHIVE_MEMBER_INOS.get((archive_stat.dev, archive_stat.ino))
+    if first_ino is None:
+        first_ino = ARCHIVE_MEMBER_INOS[(archive_stat.dev, archive_stat.ino)] = ARCHIVE_MEMBER_NEXT_INO
+        ARCHIVE_MEMBER_NEXT_INO += len(members)
+
+    for i, (member_name, size, mtime_ns) in enumerate(members):
+        file_name = f"{archive_name}{ARCHIVE_SEPARATOR}{member_name}"
+        stat = FileStat(size, ARCHIVE_MEMBER_DEV, first_ino + i, mtime_ns, 0)
+        exclusion = get_file_exclusion(file_name) or get_stat_exclusion(stat)
+        if exclusion:
+            print_verbose2("    SKIPPED: %s: %s", file_name, exclusion)
+            continue
+
+        print_verbose2("    %s: %d bytes", file_name, size)
+        FILE_TABLE.add(file_name, stat)
+
+
+def split_archive_member(file_name: str) -> tuple[str, str] | None:
+    """
+    Splits a virtual file name created by add_archive_members() into archive and member names. A name is virtual
+    if it contains ARCHIVE_SEPARATOR and no such file exists, and the part before one of the separators is a file.
+
+    :param file_name: File name
+    :return: Tuple of (archive name, member name), or None if the name is not virtual
+    """
+    if ARCHIVE_SEPARATOR not in file_name or os.path.lexists(file_name):
+        return None
+
+    offset = file_name.find(ARCHIVE_SEPARATOR)
+    while offset >= 0:
+        if os.path.isfile(file_name[:offset]):
+            return file_name[:offset], file_name[offset + len(ARCHIVE_SEPARATOR):]
+        offset = file_name.find(ARCHIVE_SEPARATOR, offset + 1)
+
+    return None
+
+
+def open_archive_member(archive_name: str, member_name: str) -> BinaryIO:
+    """
+    Opens a member of a zip or tar archive for streaming reading, without extracting it. The archive stays open
+    in the current thread for the next member, until a member of another archive is opened. Seeking inside
+    a member of a compressed tar archive decompresses it from the beginning, so zip and uncompressed tar archives
+    are hashed faster.
+
+    :param archive_name: Archive file name
+    :param member_name: Member name
+    :return: Member file opened for reading in binary mode
+    """
+    archive_key = (archive_name, os.stat(archive_name).st_mtime_ns)
+    cached = getattr(OPEN_ARCHIVE, "archive", None)
+    if not cached or cached[0] != archive_key:
+        if cached:
+            cached[1].close()
+        OPEN_ARCHIVE.archive = None
+
+        try:
+            archive = zipfile.ZipFile(archive_name) if zipfile.is_zipfile(archive_name) else tarfile.open(archive_name)
+        except (zipfile.BadZipFile, tarfile.TarError) as ex:
+            raise OSError(errno.EINVAL, f"not a readable archive: {ex}", archive_name)
+        cached = OPEN_ARCHIVE.archive = (archive_key, archive)
+
+    archive = cached[1]
+    try:
+        f = archive.open(member_name) if isinstance(archive, zipfile.ZipFile) else archive.extractfile(member_name)
+    except KeyError:
+        f = None
+
+    if f is None:
+        raise OSError(errno.ENOENT, "no such member in archive", f"{archive_name}{ARCHIVE_SEPARATOR}{member_name}")
+
+    return f
+
+
+def open_file(file_name: str) -> BinaryIO:
+    """
+    Opens a file or an archive member (see --archives argument) for reading in binary mode, unbuffered.
+
+    :param file_name: File name
+    :return: File opened for reading
+    """
+    member = split_archive_member(file_name)
+    return open_archive_member(*member) if member else open(file_name, 'rb', buffering=0)
+
+
+def collect_candidates() -> Iterator[None]:
+    """
+    Groups files from FILE_TABLE by size into FILES_BY_SIZE and STAT_BY_FILE global tables, skipping files
+    with unique sizes, which cannot have duplicates.
+    If --memory-limit is given, candidates are collected in batches of whole size groups, each batch taking
+    no more than --memory-limit. The caller processes each batch, after which the tables are cleared for the next one.
+
+    :return: Iterator which yields each time a batch of candidates is ready
+    """
+    file_count = len(FILE_TABLE)
+    if file_count:
+        memory_usage = FILE_TABLE.memory_usage()
+        print_verbose1(f"File table: {file_count} files, {humanize.naturalsize(memory_usage)} "
+                       f"({humanize.naturalsize(memory_usage * 1000000 // file_count)} per million files)"
+                       + (f", {len(FILE_TABLE.runs)} run files spilled to disk" if FILE_TABLE.runs else ""))
+
+    stage_start = start_stage()
+    batch_memory_usage = 0
+    for size, group in FILE_TABLE.iter_size_groups():
+        group_memory_usage = sum(sys.getsizeof(file_name) + CANDIDATE_MEMORY_OVERHEAD for file_name, _ in group)
+        if ARGS.memory_limit > 0 and FILES_BY_SIZE and batch_memory_usage + group_memory_usage > ARGS.memory_limit:
+            add_stage_stats("size", stage_start, file_count, len(STAT_BY_FILE))
+            file_count = 0
+            yield from yield_candidates()
+            stage_start = start_stage()
+            batch_memory_usage = 0
+
+        FILES_BY_SIZE[size] = [file_name for file_name, _ in group]
+        STAT_BY_FILE.update(group)
+        batch_memory_usage += group_memory_usage
+
+    add_stage_stats("size", stage_start, file_count, len(STAT_BY_FILE))
+    yield from yield_candidates()
+
+
+def yield_candidates() -> Iterator[None]:
+    """
+    Yields a batch of candidates collected by collect_candidates() and clears it after it has been processed.
+
+    :return: Iterator which yields once
+    """
+    print_verbose1(f"Candidates: {len(STAT_BY_FILE)} files in {len(FILES_BY_SIZE)} groups of the same size")
+    yield
+    FILES_BY_SIZE.clear()
+    STAT_BY_FILE.clear()
+    HARD_LINKS_BY_FILE.clear()
+
+
+def compile_path_filters() -> None:
+    """
+    Compiles -x, -X, -I and --exclude-dir patterns into PATH_FILTERS global variable, combining the patterns
+    of each kind into a single regular expression, so that each path is matched just once per kind.
+    """
+    PATH_FILTERS["exclude"] = combine_patterns([fnmatch.translate(glob) for glob in ARGS.exclude or []])
+    PATH_FILTERS["include"] = combine_patterns([fnmatch.translate(glob) for glob in ARGS.include or []])
+    PATH_FILTERS["exclude_dir"] = combine_patterns([fnmatch.translate(glob) for glob in ARGS.exclude_dir or []])
+
+    # A glob ending with "*" matching "<dir>/" matches all paths inside the directory as well, since the last "*"
+    # can match the rest of any such path. So the directory can be skipped entirely.
+    PATH_FILTERS["exclude_subtree"] = combine_patterns([fnmatch.translate(glob) for glob in ARGS.exclude or []
+                                                        if glob.endswith("*")])
+
+    # Combining would renumber the groups, breaking backreferences, and global flags like "(?i)" are allowed only
+    # at the start of a regular expression. So such regular expressions are kept separate.
+    default_flags = re.compile("").flags
+    regexes = [re.compile(regex) for regex in ARGS.exclude_re or []]
+    separate_regexes = [regex for regex in regexes if regex.groups or regex.flags != default_flags]
+    combined_regex = combine_patterns([regex.pattern for regex in regexes if regex not in separate_regexes])
+    PATH_FILTERS["exclude_re"] = ([combined_regex] if combined_regex else []) + separate_regexes
+
+
+def combine_patterns(patterns: list[str]) -> re.Pattern | None:
+    """
+    Combines regular expressions into one, matching if any of them matches.
+
+    :param patterns: Regular expressions
+    :return: Combined regular expression, or None if there are no patterns
+    """
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns)) if patterns else None
+
+
+def get_file_exclusion(file_name: str) -> str | None:
+    """
+    Checks if a file is excluded by -x or -X or not included by -I arguments.
+
+    :param file_name: File name
+    :return: Human-readable reason of the exclusion, or None if the file is not excluded
+    """
+    # fnmatch.fnmatch() normalizes the case on case-insensitive systems, so do the same here
+    normalized_file_name = os.path.normcase(file_name)
+
+    if PATH_FILTERS["exclude"] and PATH_FILTERS["exclude"].match(normalized_file_name):
+        return "excluded via -x"
+
+    if any(regex.match(file_name) for regex in PATH_FILTERS["exclude_re"]):
+        return "excluded via -X"
+
+    if PATH_FILTERS["include"] and not PATH_FILTERS["include"].match(normalized_file_name):
+        return "not included via -I"
+
+    return None
+
+
+def get_dir_exclusion(dir_name: str) -> str | None:
+    """
+    Checks if a directory should not be scanned: either its base name matches --exclude-dir, or a -x glob
+    excludes every path inside it.
+
+    :param dir_name: Directory path
+    :return: Argument which excludes the directory, or None if the directory is not excluded
+    """
+    if PATH_FILTERS["exclude_dir"] and PATH_FILTERS["exclude_dir"].match(os.path.normcase(os.path.basename(dir_name))):
+        return "--exclude-dir"
+
+    if PATH_FILTERS["exclude_subtree"] and PATH_FILTERS["exclude_subtree"].match(
+            os.path.normcase(os.path.join(dir_name, ""))):
+        return "-x"
+
+    return None
+
+
+def find_duplicates() -> None:
+    """
+    Searches for duplicates and prints them and/or executes a scripts. Calculates and reports wasted space.
+    Files are grouped first by size (in collect_candidates() function, in batches if --memory-limit is given),
+    within groups, hashes are calculated for file prefix (see --prefix argument), creating more groups if necessary.
+    After that in each group, hashes are calculated for the full file contents, creating even more groups, if needed.
+    More stages (file suffix, sampled blocks) can be inserted before the full file hash with --stages argument,
+    each processing only the groups of files which are still identical after the previous stage.
+    So far all comparisons have been of O(n) complexity. However, if user specified --paranoid program argument,
+    within the groups from the last step, we compare the contents of the files byte-by-byte to create even more groups
+    if needed (O(n^2) complexity). Normally --paranoid should not be needed, as having a collision in two hashes
+    (crc32 and mmh3) are rare. If user is still not satisfied, it is perhaps a time to seek a spiritual teacher :)
+
+    Total number of duplicate files (minus original ones!) and wasted space (again, minus the original one)
+    is calculated. "Original" file is selected as the first in the alphabetical list of full paths.
+    Hard links to the same file are hashed once and reported separately, since they do not waste disk space.
+    """
+    print_verbose1("Finding duplicates...")
+    total_wasted_disk_space = 0
+    total_duplicates = 0
+    hard_link_count = 0
+
+    for _ in collect_candidates():
+        wasted_disk_space, duplicate_count = find_duplicates_in_candidates()
+        total_wasted_disk_space += wasted_disk_space
+        total_duplicates += duplicate_count
+        hard_link_count += report_hard_links()
+
+    finish_commands()
+
+    if ARGS.action:
+        report_actions()
+
+    print_summary(f"Total wasted disk space in {str(total_duplicates)} files: "
+                  f"{humanize.naturalsize(total_wasted_disk_space)}")
+
+    if hard_link_count:
+        print_summary(f"Hard links to already counted files (no space wasted): {hard_link_count}")
+
+
+def find_duplicates_in_candidates() -> tuple[int, int]:
+    """
+    Searches for duplicates among the current batch of candidates (FILES_BY_SIZE), prints them and/or executes
+    a script for them.
+
+    :return: Tuple of (wasted disk space, number of duplicates) in this batch
+    """
+    total_wasted_disk_space = 0
+    total_duplicates = 0
+
+    for file_names_by_size in iter_hash_windows():
+        file_by_hash_by_size = {size: {b"": file_names} for size, file_names in file_names_by_size.items()}
+        for stage in ARGS.stages:
+            file_by_hash_by_size = group_by_stage_hash(stage, file_by_hash_by_size)
+
+        for size, file_by_hash in file_by_hash_by_size.items():
+            file_groups = group_by_hash_or_contents(file_by_hash)
+
+            for group_hash, groups_by_hash in file_groups.items():
+                for group in groups_by_hash:
+                    if len(group) < 2:
+                        continue
+
+                    total_wasted_disk_space += report_duplicates(group_hash, size, group)
+                    total_duplicates += len(group) - 1
+
+    return total_wasted_disk_space, total_duplicates
+
+
+def iter_hash_windows() -> Iterator[dict[int, list[str]]]:
+    """
+    Splits the current batch of candidates (FILES_BY_SIZE) into windows of consecutive size groups, each having
+    no more than HASH_WINDOW_FILES files and HASH_WINDOW_BYTES bytes, unless a single size group is larger.
+    All stages of a window are hashed before the next window, so that duplicates are reported (and --exec commands
+    are started) while the rest of the files are still being hashed, and the files of all groups of a window
+    are still hashed in parallel (see --jobs argument) and in --io-order.
+
+    :return: Iterator over dicts: size -> names of the files representing distinct inodes, see collapse_hard_links()
+    """
+    window = {}
+    window_files = 0
+    window_bytes = 0
+    for size, file_names in FILES_BY_SIZE.items():
+        file_names = collapse_hard_links(file_names)
+        if len(file_names) < 2:
+            continue
+
+        if window and (window_files + len(file_names) > HASH_WINDOW_FILES or
+                       window_bytes + size * len(file_names) > HASH_WINDOW_BYTES):
+            yield window
+            window = {}
+            window_files = 0
+            window_bytes = 0
+
+        window[size] = file_names
+        window_files += len(file_names)
+        window_bytes += size * len(file_names)
+
+    if window:
+        yield window
+
+
+def report_duplicates(group_hash: bytes, size: int, group: list[str]) -> int:
+    """
+    Prints a group of identical files, performs --action and executes --exec command for it.
+
+    :param group_hash: Hash digest for this group of files
+    :param size: Size of each file
+    :param group: Names of the identical files, sorted alphabetically. Their stats must be in STAT_BY_FILE
+    :return: Wasted disk space: space allocated for all files but the first one
+    """
+    wasted_disk_space = 0
+    for cur_file_name in group[1:]:
+        wasted_disk_space += get_allocated_size(cur_file_name, STAT_BY_FILE[cur_file_name])
+
+    print_normal(f"Duplicates ({size} bytes each, wasted {humanize.naturalsize(wasted_disk_space)}):\n"
+                 f"    {'\n    '.join(group)}")
+
+    if ARGS.action:
+        act_on_identical_files(group)
+
+    execute_command_on_identical_files(group_hash, group)
+
+    if ARGS.stats:
+        add_largest_group(wasted_disk_space, size, group)
+
+    return wasted_disk_space
+
+
+def collapse_hard_links(file_names: list[str]) -> list[str]:
+    """
+    Groups files of the same size by device and inode numbers, so that each inode is hashed and reported only once.
+    The alphabetically first name represents the inode, other names are saved into HARD_LINKS_BY_FILE.
+
+    :param file_names: Names of the files having the same size
+    :return: Sorted names of the files representing distinct inodes
+    """
+    # Sorting makes the order of hashing and therefore the order of found groups deterministic
+    sorted_file_names = sorted(file_names)
+
+    file_names_by_inode = {}
+    for file_name in sorted_file_names:
+        stat = STAT_BY_FILE[file_name]
+        file_names_by_inode.setdefault((stat.dev, stat.ino), []).append(file_name)
+
+    if len(file_names_by_inode) == len(sorted_file_names):
+        return sorted_file_names
+
+    for linked_file_names in file_names_by_inode.values():
+        if len(linked_file_names) > 1:
+            HARD_LINKS_BY_FILE[linked_file_names[0]] = linked_file_names[1:]
+
+    return [linked_file_names[0] for linked_file_names in file_names_by_inode.values()]
+
+
+def report_hard_links() -> int:
+    """
+    Prints sets of hard links to the same files, if --hard-links argument is given.
+
+    :return: Number of hard links, not counting one name per file
+    """
+    hard_link_count = 0
+
+    for file_name, linked_file_names in HARD_LINKS_BY_FILE.items():
+        if ARGS.hard_links:
+            print_normal(f"Hard links ({STAT_BY_FILE[file_name].size} bytes each, no space wasted):\n"
+                         f"    {'\n    '.join([file_name] + linked_file_names)}")
+
+        hard_link_count += len(linked_file_names)
+
+    return hard_link_count
+
+
+def group_by_stage_hash(stage: str, file_by_hash_by_size: dict[int, dict[bytes, list[str]]]) \
+        -> dict[int, dict[bytes, list[str]]]:
+    """
+    For each dict value given in the argument calculates hash (see --hash argument) of the file part defined by
+    the stage (see get_stage_ranges()) and groups the file names by the hash. Skips an entry if there are just one or no files
+    in it. Hashes for all size groups are calculated in one batch, so that they can be calculated in parallel
+    (see --jobs argument). Prints how many files were eliminated by the stage in verbose mode.
+
+    :param stage: Stage name: "prefix", "suffix", "samples" or "full"
+    :param file_by_hash_by_size: An output from the previous stage: a dict: size -> hash -> [names of the files
+           with the same hash]
+    :return: a dict: size -> hash -> [names of the files with the same hash (of the file part defined by the stage)]
+    """
+    stage_start = start_stage()
+    file_names_by_size = {}
+    for size, file_by_hash in file_by_hash_by_size.items():
+        for same_hash_file_names in file_by_hash.values():
+            if len(same_hash_file_names) < 2:
+                continue
+
+            if is_verbose(2):
+                print_verbose2("Processing identical hash group:\n    %s\n", "\n    ".join(same_hash_file_names))
+            file_names_by_size.setdefault(size, []).extend(same_hash_file_names)
+
+    mock_hash = ARGS.mock_prefix_hash if stage == "prefix" else ARGS.mock_full_hash if stage == "full" else None
+    mock_hash = mock_hash.encode() if mock_hash else None
+    if mock_hash:
+        requests = []
+    else:
+        requests = [(file_name, get_stage_kind(stage, size), get_stage_ranges(stage, size))
+                    for size, file_names in file_names_by_size.items() for file_name in file_names]
+    file_hashes = iter(get_file_hashes(requests))
+
+    file_by_stage_hash_by_size = {}
+    for size, file_names in file_names_by_size.items():
+        file_by_stage_hash = file_by_stage_hash_by_size.setdefault(size, {})
+        for file_name in file_names:
+            file_hash = mock_hash or next(file_hashes)
+            file_by_stage_hash.setdefault(file_hash, []).append(file_name)
+            if ARGS.watch and stage == "full":
+                WATCH_HASHES[file_name] = file_hash
+
+    report_stage(stage, file_names_by_size, file_by_stage_hash_by_size)
+    add_stage_stats(stage, stage_start, sum(map(len, file_names_by_size.values())),
+                    sum(len(file_names) for file_by_stage_hash in file_by_stage_hash_by_size.values()
+                        for file_names in file_by_stage_hash.values() if len(file_names) >= 2))
+
+    return file_by_stage_hash_by_size
+
+
+def get_stage_ranges(stage: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Returns the parts of a file which are hashed at a given stage:
+    "prefix" - first --prefix-size bytes,
+    "suffix" - last --suffix-size bytes,
+    "samples" - --sample-count blocks of --sample-size bytes evenly spread over the file (first and last included),
+    "full" - entire file.
+
+    :param stage: Stage name
+    :param size: File size
+    :return: list of (offset, length) tuples, or None if the entire file is hashed
+    """
+    if stage == "prefix" and ARGS.prefix_size < size:
+        return [(0, ARGS.prefix_size)]
+
+    if stage == "suffix" and ARGS.suffix_size < size:
+        return [(size - ARGS.suffix_size, ARGS.suffix_size)]
+
+    if stage == "samples" and ARGS.sample_count * ARGS.sample_size < size:
+        if ARGS.sample_count == 1:
+            return [(0, ARGS.sample_size)]
+        step = (size - ARGS.sample_size) // (ARGS.sample_count - 1)
+        return [(i * step, ARGS.sample_size) for i in range(ARGS.sample_count)]
+
+    return None
+
+
+def get_stage_kind(stage: str, size: int) -> str:
+    """
+    Returns hash kind used as a hash cache key, e.g. "<hash>:prefix:<size>", "<hash>:samples:<count>x<size>" or
+    "<hash>:full", where <hash> is the hash engine name. Stages covering the whole file are the same as the entire
+    file.
+
+    :param stage: Stage name
+    :param size: File size
+    :return: Hash kind
+    """
+    if get_stage_ranges(stage, size) is None:
+        return f"{ARGS.hash}:full"
+
+    if stage == "samples":
+        return f"{ARGS.hash}:samples:{ARGS.sample_count}x{ARGS.sample_size}"
+
+    return f"{ARGS.hash}:{stage}:{ARGS.prefix_size if stage == 'prefix' else ARGS.suffix_size}"
+
+
+def report_stage(stage: str, file_names_by_size: dict[int, list[str]],
+                 file_by_stage_hash_by_size: dict[int, dict[bytes, list[str]]]) -> None:
+    """
+    Prints how many files and bytes were eliminated from further comparison by a stage, in verbose mode.
+
+    :param stage: Stage name
+    :param file_names_by_size: Files processed by the stage, grouped by size
+    :param file_by_stage_hash_by_size: Output of the stage
+    """
+    files_in = sum(len(file_names) for file_names in file_names_by_size.values())
+    bytes_in = sum(size * len(file_names) for size, file_names in file_names_by_size.items())
+    files_eliminated = 0
+    bytes_eliminated = 0
+
+    for size, file_by_stage_hash in file_by_stage_hash_by_size.items():
+        for file_names in file_by_stage_hash.values():
+            if len(file_names) < 2:
+                files_eliminated += 1
+                bytes_eliminated += size
+
+    print_verbose1(f"Stage {stage}: {files_in} files ({humanize.naturalsize(bytes_in)}) in, "
+                   f"{files_eliminated} files ({humanize.naturalsize(bytes_eliminated)}) eliminated")
+
+
+def get_file_hashes(requests: list[tuple[str, str, list[tuple[int, int]] | None]]) -> list[bytes]:
+    """
+    Returns hashes of the given parts of the files. Takes hashes calculated while scanning (see --pipeline argument)
+    and consults the persistent hash cache (if enabled by --cache argument) first, and stores newly calculated hashes
+    in the cache.
+
+    :param requests: list of (file name, hash kind, list of (offset, length) tuples or None for the entire file)
+    :return: list of hashes in the same order as requests
+    """
+    if not HASH_CACHE and not PREFETCHED_HASHES:
+        return calc_file_hashes(requests, [STAT_BY_FILE[file_name] for file_name, kind, ranges in requests])
+
+    file_hashes = []
+    missing_indexes = []
+    for file_name, kind, ranges in requests:
+        stat = STAT_BY_FILE[file_name]
+
+        file_hash = pop_prefetched_hash(stat, kind) if PREFETCHED_HASHES else None
+        if file_hash is None and HASH_CACHE and stat.dev != ARCHIVE_MEMBER_DEV:
+            file_hash = get_cached_hash(stat, kind)
+            if file_hash is not None:
+                if is_verbose(3):
+                    print_verbose3("Cached hash for %s of %s: %s", kind, file_name, format_hash(file_hash))
+                HASH_CACHE_STATS["bytes_saved"] += sum(length for offset, length in ranges) if ranges else stat.size
+
+        if file_hash is None:
+            missing_indexes.append(len(file_hashes))
+
+        file_hashes.append(file_hash)
+
+    missing_requests = [requests[i] for i in missing_indexes]
+    missing_stats = [STAT_BY_FILE[file_name] for file_name, kind, ranges in missing_requests]
+    for i, (file_name, kind, ranges), stat, file_hash in zip(missing_indexes, missing_requests, missing_stats,
+                                                             calc_file_hashes(missing_requests, missing_stats)):
+        if HASH_CACHE and stat.dev != ARCHIVE_MEMBER_DEV:
+            put_cached_hash(stat, kind, file_hash)
+        file_hashes[i] = file_hash
+
+    return file_hashes
+
+
+def calc_file_hashes(requests: list[tuple[str, str, list[tuple[int, int]] | None]], stats: list[FileStat]) \
+        -> list[bytes]:
+    """
+    Calculates hashes of the given parts of the files. If --jobs argument is
+    greater than 1, hashes are calculated in parallel with worker threads or processes (see --jobs-backend).
+    No more than --device-jobs files are read simultaneously from the same device (st_dev), and the devices are
+    served in a round-robin fashion. Read buffers of all workers together do not exceed --buffer-memory.
+    Files of each device are read in the order given in --io-order argument (see get_io_order()).
+
+    :param requests: list of (file name, hash kind, list of (offset, length) tuples or None for the entire file)
+    :param stats: list of metadata of the files in the same order as requests
+    :return: list of hashes in the same order as requests
+    """
+    file_hashes = [None] * len(requests)
+    io_order = get_io_order(requests, stats)
+    request_sizes = [sum(length for offset, length in ranges) if ranges else stat.size
+                     for (file_name, kind, ranges), stat in zip(requests, stats)]
+    IO_STATS["requested_bytes"] += sum(request_sizes)
+
+    if ARGS.progress:
+        if not PROGRESS["bytes_to_hash"]:
+            PROGRESS["hash_start_time"] = time.monotonic()
+        PROGRESS["bytes_to_hash"] += sum(request_sizes)
+
+    if ARGS.jobs <= 1 or len(requests) < 2:
+        for n, i in enumerate(io_order):
+            if ARGS.read_policy == "fadvise" and n + 1 < len(io_order):
+                prefetch_file(*requests[io_order[n + 1]][::2])
+
+            file_name, kind, ranges = requests[i]
+            file_hashes[i] = calc_file_hash(file_name, ranges)
+
+            if ARGS.progress:
+                PROGRESS["bytes_hashed"] += request_sizes[i]
+                report_progress()
+        return file_hashes
+
+    pending_by_dev = {}
+    for i in io_order:
+        pending_by_dev.setdefault(stats[i].dev, collections.deque()).append(i)
+
+    running_by_dev = dict.fromkeys(pending_by_dev, 0)
+    device_jobs = ARGS.device_jobs or ARGS.jobs
+    executor = get_hash_executor()
+    futures = {}
+    buffer_memory = 0
+
+    while pending_by_dev or futures:
+        submitted = True
+        while submitted and len(futures) < ARGS.jobs:
+            submitted = False
+            for dev, pending in list(pending_by_dev.items()):
+                if len(futures) >= ARGS.jobs:
+                    break
+                if running_by_dev[dev] >= device_jobs:
+                    continue
+
+                file_name, kind, ranges = requests[pending[0]]
+                job_buffer_memory = min(INTERNAL_FILE_BUFFER_SIZE, request_sizes[pending[0]])
+                if futures and buffer_memory + job_buffer_memory > ARGS.buffer_memory:
+                    continue
+
+                i = pending.popleft()
+                if not pending:
+                    del pending_by_dev[dev]
+                elif ARGS.read_policy == "fadvise":
+                    prefetch_file(*requests[pending[0]][::2])
+
+                futures[executor.submit(calc_file_hash, file_name, ranges)] = (i, dev, job_buffer_memory)
+                running_by_dev[dev] += 1
+                buffer_memory += job_buffer_memory
+                submitted = True
+
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            i, dev, job_buffer_memory = futures.pop(future)
+            running_by_dev[dev] -= 1
+            buffer_memory -= job_buffer_memory
+            file_hashes[i] = future.result()
+
+            if ARGS.progress:
+                PROGRESS["bytes_hashed"] += request_sizes[i]
+                report_progress()
+
+    return file_hashes
+
+
+def get_io_order(requests: list[tuple[str, str, list[tuple[int, int]] | None]], stats: list[FileStat]) -> list[int]:
+    """
+    Orders reads to minimize disk seeks, according to --io-order argument: by device and then by physical location
+    of the first block to read (see get_physical_offset()), falling back to inode number for the files which
+    location is unknown, or by device and inode number only, or keeps the original order.
+    Inode numbers roughly follow the order of file creation and allocation on most filesystems.
+    With "physical" order, prints an estimate of total seek distance in verbose mode.
+
+    :param requests: list of (file name, hash kind, list of (offset, length) tuples or None for the entire file)
+    :param stats: list of metadata of the files in the same order as requests
+    :return: list of indexes of the requests in the order of reading
+    """
+    if ARGS.io_order == "none" or len(requests) < 2:
+        return list(range(len(requests)))
+
+    if ARGS.io_order == "inode":
+        return sorted(range(len(requests)), key=lambda i: (stats[i].dev, stats[i].ino))
+
+    physical_offsets = [get_physical_offset(file_name, ranges[0][0] if ranges else 0, stat.dev)
+                        for (file_name, kind, ranges), stat in zip(requests, stats)]
+    io_order = sorted(range(len(requests)), key=lambda i: (stats[i].dev, physical_offsets[i] is None,
+                                                           physical_offsets[i] or stats[i].ino))
+
+    def seek_distance(order: list[int]) -> int:
+        located = [(stats[i].dev, physical_offsets[i]) for i in order if physical_offsets[i] is not None]
+        return sum(abs(offset2 - offset1) for (dev1, offset1), (dev2, offset2) in zip(located, located[1:])
+                   if dev1 == dev2)
+
+    print_verbose2(f"Physical read order: {sum(offset is not None for offset in physical_offsets)} of "
+                   f"{len(requests)} files located, estimated seek distance "
+                   f"{humanize.naturalsize(seek_distance(io_order))} instead of "
+                   f"{humanize.naturalsize(seek_distance(list(range(len(requests)))))}")
+    return io_order
+
+
+def get_physical_offset(file_name: str, offset: int, dev: int) -> int | None:
+    """
+    Finds physical location of file data on the device using FIEMAP ioctl (Linux only).
+
+    :param file_name: File name
+    :param offset: Offset in the file
+    :param dev: Device number of the file (st_dev), to skip devices which do not support FIEMAP
+    :return: Physical offset of the data in bytes, or None if it cannot be found
+    """
+    if not fcntl or dev == ARCHIVE_MEMBER_DEV or dev in FIEMAP_UNSUPPORTED_DEVS:
+        return None
+
+    buffer = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(buffer, 0, offset, 2 ** 64 - 1 - offset, 0, 0, 1, 0)
+    try:
+        with open(file_name, 'rb', buffering=0) as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buffer)
+    except OSError as ex:
+        if ex.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL):
+            print_verbose3("FIEMAP is not supported for %s: %s", file_name, ex.strerror)
+            FIEMAP_UNSUPPORTED_DEVS.add(dev)
+        return None
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(buffer)[3]
+    if not mapped_extents:
+        return None
+
+    logical, physical, length, _, _, flags, _, _, _ = FIEMAP_EXTENT.unpack_from(buffer, FIEMAP_HEADER.size)
+    if flags & FIEMAP_EXTENT_NOT_LOCATED:
+        return None
+
+    return physical + max(offset - logical, 0)
+
+
+def get_hash_executor() -> concurrent.futures.Executor:
+    """
+    Returns the pool of hashing workers, creating it on the first use. See --jobs and --jobs-backend arguments.
+
+    :return: Thread or process pool executor
+    """
+    global HASH_EXECUTOR
+
+    if not HASH_EXECUTOR:
+        if ARGS.jobs_backend == "process":
+            # Only the arguments used by calc_file_hash() and calc_file_chunks() are passed, since some others
+            # cannot be pickled
+            worker_args = Namespace(quiet=ARGS.quiet, verbose=ARGS.verbose, io_method=ARGS.io_method,
+                                    read_policy=ARGS.read_policy, hash=ARGS.hash, chunk_size=ARGS.chunk_size)
+            HASH_EXECUTOR = concurrent.futures.ProcessPoolExecutor(ARGS.jobs, initializer=init_hash_worker,
+                                                                   initargs=(worker_args,))
+        else:
+            HASH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(ARGS.jobs, thread_name_prefix="hash")
+
+    return HASH_EXECUTOR
+
+
+def init_hash_worker(args: Namespace) -> None:
+    """
+    Initializes a hashing worker process.
+
+    :param args: Program arguments needed for hashing
+    """
+    global ARGS
+    ARGS = args
+
+
+def calc_file_hash(file_name: str, ranges: list[tuple[int, int]] = None) -> bytes:
+    """
+    Calculates hash of the given parts of the file_name or entire file if ranges is None, using hash engine
+    given in --hash argument.
+
+    Reads file contents into a limited buffer in order to keep memory consumption moderate.
+    The hash is calculated in blocks of INTERNAL_FILE_BUFFER_SIZE, so it does not depend on --io-method
+    or --read-policy.
+    Can be called from hashing worker threads and processes, so it must not rely on global tables.
+
+    :param file_name File to calculate the hash for
+    :param ranges List of (offset, length) tuples to include into hash, or None to calculate for the entire file
+    :return: Binary hash digest
+    """
+    hasher = HASH_ENGINES[ARGS.hash]()
+    ranges = ranges or [(0, None)]
+    member = split_archive_member(file_name)
+    f, is_direct = (open_archive_member(*member), False) if member else open_for_hashing(file_name)
+    with f:
+        if is_direct:
+            blocks = read_direct_blocks(f, ranges, INTERNAL_FILE_BUFFER_SIZE)
+        else:
+            blocks = read_file_blocks(f, ranges, INTERNAL_FILE_BUFFER_SIZE)
+
+        for block in blocks:
+            hasher.update(block)
+
+        if ARGS.read_policy == "fadvise" and not member:
+            for offset, length in ranges:
+                os.posix_fadvise(f.fileno(), offset, length or 0, os.POSIX_FADV_DONTNEED)
+
+    file_hash = hasher.digest()
+    if is_verbose(3):
+        print_verbose3("Calculated hash for %s of %s: %s", ranges if ranges != [(0, None)] else "entire file",
+                       file_name, format_hash(file_hash))
+    return file_hash
+
+
+class Crc32Mmh3Hasher:
+    """
+    The original findup hash: CRC32 and 32-bit MurmurHash3, both chained over blocks of INTERNAL_FILE_BUFFER_SIZE
+    bytes (MurmurHash3 of each block is seeded with the hash of the previous blocks). The block size affects
+    MurmurHash3 value, so all blocks except the last one must be of exactly that size.
+    """
+    def __init__(self):
+        self.crc32 = 0
+        self.mmh3 = 0
+
+    def update(self, block: bytes | memoryview) -> None:
+        self.crc32 = zlib.crc32(block, self.crc32)
+        self.mmh3 = mmh3.mmh3_32_uintdigest(block, self.mmh3)
+
+    def digest(self) -> bytes:
+        return struct.pack(">II", self.crc32, self.mmh3)
+
+
+""" Hash engines (see --hash argument): factories of hashlib-like objects with update() and digest() methods """
+HASH_ENGINES: dict[str, Callable[[], Any]] = {
+    "crc32+mmh3": Crc32Mmh3Hasher,
+    "mmh3-128": mmh3.mmh3_x64_128,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash:
+    HASH_ENGINES["xxh3-128"] = xxhash.xxh3_128
+
+
+def format_hash(file_hash: bytes) -> str:
+    """
+    Formats a hash digest for printing and for --exec-hash-arg. The original crc32+mmh3 hash is formatted
+    as two decimal numbers, as it always was, others as hex strings.
+
+    :param file_hash: Binary hash digest
+    :return: Printable hash
+    """
+    if ARGS.hash == "crc32+mmh3" and len(file_hash) == 8:
+        crc32_hash, mmh3_hash = struct.unpack(">II", file_hash)
+        return f"{crc32_hash}_{mmh3_hash}"
+
+    return file_hash.hex()
+
+
+def benchmark_hash_engines() -> dict[str, float]:
+    """
+    Measures the speed of all available hash engines on the current CPU by hashing random in-memory data.
+
+    :return: dict: engine name -> speed in bytes per second, fastest first
+    """
+    block = os.urandom(INTERNAL_FILE_BUFFER_SIZE)
+    block_count = 4
+    speed_by_engine = {}
+
+    for name, engine in HASH_ENGINES.items():
+        best_time = math.inf
+        for _ in range(3):
+            start_time = time.perf_counter()
+            hasher = engine()
+            for _ in range(block_count):
+                hasher.update(block)
+            hasher.digest()
+            best_time = min(best_time, time.perf_counter() - start_time)
+
+        speed_by_engine[name] = block_count * len(block) / max(best_time, 1e-9)
+
+    return dict(sorted(speed_by_engine.items(), key=lambda item: item[1], reverse=True))
+
+
+def choose_hash_engine() -> str:
+    """
+    Chooses the fastest hash engine for --hash=auto argument, see benchmark_hash_engines().
+
+    :return: Hash engine name
+    """
+    speed_by_engine = benchmark_hash_engines()
+
+    for name, speed in speed_by_engine.items():
+        print_verbose1(f"Hash engine {name}: {humanize.naturalsize(speed)}/s")
+
+    fastest_engine = next(iter(speed_by_engine))
+    print_verbose1(f"Using hash engine {fastest_engine}")
+    return fastest_engine
+
+
+def read_file_blocks(f: BinaryIO, ranges: list[tuple[int, int | None]], block_size: int) \
+        -> Iterator[bytes | memoryview]:
+    """
+    Reads given parts of a file in blocks using the method given in --io-method argument:
+    "read" - each block is a new bytes object,
+    "readinto" - blocks are read into a reusable buffer, not larger than the parts to read (see get_read_buffer_size()),
+    "mmap" - blocks are views of the memory-mapped file.
+    Blocks returned as memoryview objects are valid only until the next block is requested.
+    Archive members cannot be memory-mapped, they are read with "read" method instead of "mmap".
+
+    :param f: File opened for reading in binary mode
+    :param ranges: List of (offset, length) tuples, where length is None for reading up to the end of file
+    :param block_size: Maximum block size. All blocks but the last one in each range have exactly this size
+    :return: Iterator over blocks
+    """
+    if ARGS.io_method == "mmap" and isinstance(f, io.FileIO):
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            for offset, length in ranges:
+                end = size if length is None else min(size, offset + length)
+                for block_offset in range(offset, end, block_size):
+                    with view[block_offset:min(end, block_offset + block_size)] as block:
+                        yield block
+        return
+
+    buffer = acquire_read_buffer(get_read_buffer_size(f, ranges, block_size)) if ARGS.io_method == "readinto" else None
+    try:
+        for offset, length in ranges:
+            f.seek(offset)
+            while length is None or length > 0:
+                read_size = block_size if length is None else min(block_size, length)
+                if buffer is None:
+                    block = read_fully(f, read_size)
+                else:
+                    block = buffer[:readinto_fully(f, buffer[:read_size])]
+                if not block:
+                    break
+                yield block
+                if length is not None:
+                    length -= len(block)
+    finally:
+        if buffer is not None:
+            release_read_buffer(buffer)
+
+
+def get_read_buffer_size(f: BinaryIO, ranges: list[tuple[int, int | None]], block_size: int) -> int:
+    """
+    Calculates the size of the buffer needed for reading given parts of a file in blocks, so that reading a small file
+    or a short part of a file takes no more memory than it is charged by calc_file_hashes() against --buffer-memory.
+
+    :param f: File opened for reading in binary mode
+    :param ranges: List of (offset, length) tuples, where length is None for reading up to the end of file
+    :param block_size: Maximum block size
+    :return: Buffer size
+    """
+    if all(length is not None for offset, length in ranges):
+        return max(1, min(block_size, max((length for offset, length in ranges), default=0)))
+
+    if isinstance(f, io.FileIO):
+        return max(1, min(block_size, os.fstat(f.fileno()).st_size))
+
+    return block_size
+
+
+def open_for_hashing(file_name: str) -> tuple[BinaryIO, bool]:
+    """
+    Opens a file for reading according to --read-policy argument: with O_DIRECT ("direct" policy, Linux only),
+    which bypasses the page cache, or with a sequential access hint ("fadvise" policy), or just opens it.
+    If the file cannot be opened with O_DIRECT (e.g. the filesystem does not support it), it is opened as usual.
+
+    :param file_name: File name
+    :return: Tuple of (unbuffered file opened for reading in binary mode, whether it is opened with O_DIRECT)
+    """
+    if ARGS.read_policy == "direct" and hasattr(os, "O_DIRECT"):
+        try:
+            return open(os.open(file_name, os.O_RDONLY | os.O_DIRECT), 'rb', buffering=0), True
+        except OSError as ex:
+            if ex.errno != errno.EINVAL:
+                raise
+            print_verbose3("O_DIRECT is not supported for %s, reading via page cache", file_name)
+
+    f = open(file_name, 'rb', buffering=0)
+    if ARGS.read_policy == "fadvise":
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return f, False
+
+
+def prefetch_file(file_name: str, ranges: list[tuple[int, int]] | None) -> None:
+    """
+    Asks the OS to start reading the first block of each given part of the file into the page cache in background,
+    so that the file is ready when it is hashed next ("fadvise" policy of --read-policy argument).
+    Errors are ignored: the file will be read anyway.
+
+    :param file_name: File name
+    :param ranges: List of (offset, length) tuples, or None for the entire file
+    """
+    try:
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            for offset, length in ranges or [(0, None)]:
+                os.posix_fadvise(fd, offset, min(length or INTERNAL_FILE_BUFFER_SIZE, INTERNAL_FILE_BUFFER_SIZE),
+                                 os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    except OSError as ex:
+        print_verbose3("Cannot prefetch %s: %s", file_name, ex.strerror)
+
+
+def read_direct_blocks(f: BinaryIO, ranges: list[tuple[int, int | None]], block_size: int) -> Iterator[memoryview]:
+    """
+    Reads given parts of a file opened with O_DIRECT in the same blocks as read_file_blocks() does. O_DIRECT requires
+    file offsets, read sizes and buffer addresses aligned to DIRECT_IO_ALIGNMENT, so an aligned window around each
+    block is read into a page-aligned buffer, and the block is returned as a view of its part.
+    Blocks are valid only until the next block is requested.
+
+    :param f: File opened for reading with O_DIRECT
+    :param ranges: List of (offset, length) tuples, where length is None for reading up to the end of file
+    :param block_size: Maximum block size. All blocks but the last one in each range have exactly this size
+    :return: Iterator over blocks
+    """
+    fd = f.fileno()
+    size = os.fstat(fd).st_size
+    with mmap.mmap(-1, block_size + 2 * DIRECT_IO_ALIGNMENT) as buffer, memoryview(buffer) as view:
+        for offset, length in ranges:
+            end = size if length is None else min(size, offset + length)
+            for block_offset in range(offset, end, block_size):
+                block_end = min(end, block_offset + block_size)
+                aligned_offset = block_offset - block_offset % DIRECT_IO_ALIGNMENT
+                aligned_size = -(-(block_end - aligned_offset) // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+
+                count = 0
+                while count < aligned_size:
+                    read_count = os.preadv(fd, [view[count:aligned_size]], aligned_offset + count)
+                    count += read_count
+                    # A short read happens at the end of file, and the next read would not be aligned anyway
+                    if read_count % DIRECT_IO_ALIGNMENT or not read_count:
+                        break
+
+                with view[block_offset - aligned_offset:min(block_end - aligned_offset, count)] as block:
+                    yield block
+
+
+def start_stage() -> tuple[float, float, int]:
+    """
+    Takes a snapshot of counters at the start of a stage, to be passed to add_stage_stats() at the end of the stage.
+
+    :return: Tuple of (wall time, CPU time, number of bytes read from files)
+    """
+    return time.perf_counter(), time.process_time(), IO_STATS["requested_bytes"]
+
+
+def add_stage_stats(stage: str, stage_start: tuple[float, float, int], files_in: int, files_out: int) -> None:
+    """
+    Adds time, number of bytes read and number of files processed by a stage to STAGE_STATS. Statistics of a stage
+    which is run multiple times (e.g. for each batch of candidates, see --memory-limit) are summed up.
+    CPU time includes all threads of the process, but not hashing worker processes (see --jobs-backend).
+
+    :param stage: Stage name
+    :param stage_start: Counters at the start of the stage, see start_stage()
+    :param files_in: Number of files processed by the stage
+    :param files_out: Number of files left for the next stage
+    """
+    wall_time, cpu_time, bytes_read = stage_start
+    stats = STAGE_STATS.setdefault(stage, dict.fromkeys(("wall_seconds", "cpu_seconds", "files_in", "files_out",
+                                                         "bytes_read"), 0))
+    stats["wall_seconds"] += time.perf_counter() - wall_time
+    stats["cpu_seconds"] += time.process_time() - cpu_time
+    stats["files_in"] += files_in
+    stats["files_out"] += files_out
+    stats["bytes_read"] += IO_STATS["requested_bytes"] - bytes_read
+
+
+def add_largest_group(wasted_disk_space: int, size: int, group: list[str]) -> None:
+    """
+    Remembers a duplicate group if it is one of LARGEST_GROUP_COUNT groups wasting the most disk space so far.
+
+    :param wasted_disk_space: Disk space wasted by the group
+    :param size: File size
+    :param group: Names of the files in the group
+    """
+    entry = (wasted_disk_space, size, len(group), group[0])
+    if len(LARGEST_GROUPS) < LARGEST_GROUP_COUNT:
+        heapq.heappush(LARGEST_GROUPS, entry)
+    else:
+        heapq.heappushpop(LARGEST_GROUPS, entry)
+
+
+def report_stats() -> None:
+    """
+    Prints statistics of the stages of the run and the largest duplicate groups (see --stats argument): in plain
+    text (unless --quiet is given) or as a JSON object (always).
+    """
+    largest_groups = [{"wasted": wasted_disk_space, "size": size, "files": file_count, "file": file_name}
+                      for wasted_disk_space, size, file_count, file_name in sorted(LARGEST_GROUPS, reverse=True)]
+
+    if ARGS.stats == "json":
+        print(json.dumps({"stages": [{"stage": stage, **stats} for stage, stats in STAGE_STATS.items()],
+                          "largest_groups": largest_groups}))
+        return
+
+    print_normal("Statistics:")
+    for stage, stats in STAGE_STATS.items():
+        line = (f"    Stage {stage}: {stats['wall_seconds']:.3f} s, CPU {stats['cpu_seconds']:.3f} s, "
+                f"{stats['files_in']} files in, {stats['files_out']} files out")
+        if stats["files_in"] and stage != "scan":
+            line += f" ({100 * (1 - stats['files_out'] / stats['files_in']):.1f}% eliminated)"
+        if stats["bytes_read"]:
+            line += (f", {humanize.naturalsize(stats['bytes_read'])} read, "
+                     f"{humanize.naturalsize(stats['bytes_read'] / max(stats['wall_seconds'], 1e-9))}/s")
+        print_normal(line)
+
+    if largest_groups:
+        print_normal("Largest duplicate groups:")
+        for group in largest_groups:
+            print_normal(f"    {group['files']} files of {group['size']} bytes, wasted "
+                         f"{humanize.naturalsize(group['wasted'])}: {group['file']}")
+
+
+def get_disk_read_bytes() -> int | None:
+    """
+    Returns the number of bytes this process has caused to be fetched from storage (Linux only).
+
+    :return: Number of bytes or None if not available
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name == "read_bytes":
+                    return int(value)
+    except OSError:
+        pass
+
+    return None
+
+
+def report_io_stats() -> None:
+    """
+    Prints how many bytes were requested from files for hashing and comparison, and how many of them were read
+    from disk and from the page cache (see --io-stats argument). Disk reads are counted for the whole process
+    (Linux only), and do not include reads by hashing worker processes (see --jobs-backend).
+    """
+    requested_bytes = IO_STATS["requested_bytes"]
+    disk_read_bytes = get_disk_read_bytes()
+    if disk_read_bytes is None or ARGS.jobs_backend == "process" and HASH_EXECUTOR:
+        print_normal(f"I/O: {humanize.naturalsize(requested_bytes)} read from files")
+        return
+
+    disk_read_bytes = min(disk_read_bytes - IO_STATS["start_read_bytes"], requested_bytes)
+    print_normal(f"I/O: {humanize.naturalsize(requested_bytes)} read from files, "
+                 f"{humanize.naturalsize(disk_read_bytes)} from disk, "
+                 f"{humanize.naturalsize(requested_bytes - disk_read_bytes)} from page cache")
+
+
+def read_fully(f: BinaryIO, size: int) -> bytes:
+    """
+    Reads exactly size bytes from a file, unless the end of file is reached. Unbuffered files may return less
+    data than requested from a single read() call.
+
+    :param f: File to read
+    :param size: Number of bytes to read
+    :return: Data read from the file
+    """
+    data = f.read(size)
+    while data and len(data) < size:
+        more_data = f.read(size - len(data))
+        if not more_data:
+            break
+        data += more_data
+    return data
+
+
+def readinto_fully(f: BinaryIO, buffer: memoryview) -> int:
+    """
+    Fills the buffer with the data read from a file, unless the end of file is reached.
+
+    :param f: File to read
+    :param buffer: Buffer to fill
+    :return: Number of bytes read
+    """
+    total = 0
+    while total < len(buffer):
+        count = f.readinto(buffer[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def acquire_read_buffer(size: int) -> memoryview:
+    """
+    Returns a buffer for reading file blocks. Buffers of INTERNAL_FILE_BUFFER_SIZE bytes are reused via
+    READ_BUFFER_POOL, smaller ones are allocated for each call.
+
+    :param size: Buffer size
+    :return: Buffer
+    """
+    if size == INTERNAL_FILE_BUFFER_SIZE:
+        with READ_BUFFER_POOL_LOCK:
+            if READ_BUFFER_POOL:
+                return READ_BUFFER_POOL.pop()
+
+    return memoryview(bytearray(size))
+
+
+def release_read_buffer(buffer: memoryview) -> None:
+    """
+    Returns a buffer obtained from acquire_read_buffer() for reuse.
+
+    :param buffer: Buffer
+    """
+    if len(buffer) == INTERNAL_FILE_BUFFER_SIZE:
+        with READ_BUFFER_POOL_LOCK:
+            READ_BUFFER_POOL.append(buffer)
+
+
+def group_by_hash_or_contents(file_by_hash: dict[bytes, list[str]]) -> dict[bytes, list[list[str]]]:
+    """
+    If user has specified --paranoid argument, this method will perform binary file comparisons inside groups,
+    adding more groups when needed. If no such argument provided, output is basically the input with
+    groups sorted alphabetically
+
+    :param file_by_hash: Files already grouped by hash
+    :return: Files grouped by exact contents, sorted alphabetically within group
+    """
+    file_groups = {}
+
+    for group_hash, cur_file_names in file_by_hash.items():
+        if len(cur_file_names) < 2:
+            continue
+
+        sorted_file_names = sorted(list(cur_file_names))
+
+        if ARGS.paranoid:
+            stage_start = start_stage()
+            compared_file_groups = paranoid_compare_files(sorted_file_names)
+            add_stage_stats("paranoid", stage_start, len(sorted_file_names),
+                            sum(len(group) for group in compared_file_groups if len(group) >= 2))
+            file_groups.setdefault(group_hash, list()).extend(compared_file_groups)
+        else:
+            file_groups.setdefault(group_hash, list()).append(sorted_file_names)
+
+    return file_groups
+
+
+def paranoid_compare_files(sorted_file_names: list[str]) -> list[list[str]]:
+    """
+    Compares files byte-by-byte and groups them into file having exactly the same contents.
+    All files are read simultaneously chunk by chunk ("in lockstep"). After each chunk, a group of files is split
+    into subgroups having the same chunk contents, and files which do not have a pair any more are not read further.
+    So, each file is read only once and sequentially. Read buffers of all files together are sized to fit into
+    --buffer-memory, but each of them is at least 64 KiB, so a group of more than --buffer-memory / 64 KiB files
+    uses more memory than that. No more than --max-open-files files are kept open at the same time. Unless
+    --io-method is "read", each file gets a preallocated buffer which is reused for all its chunks.
+
+    Called for files having the same hash when --paranoid argument is given.
+
+    :param sorted_file_names: list of names of the files to compare
+    :return: list of groups. Each group is the list of files having exactly the same content
+    """
+    file_groups = []
+    pending_groups = [sorted_file_names]
+    chunk_size = max(64 * 1024, min(INTERNAL_FILE_BUFFER_SIZE, ARGS.buffer_memory // len(sorted_file_names)))
+    open_files = {}
+    buffers = {}
+    offset = 0
+
+    print_verbose1(f"Binary comparing {len(sorted_file_names)} files in chunks of {humanize.naturalsize(chunk_size)}")
+
+    try:
+        while pending_groups:
+            next_pending_groups = []
+
+            for group in pending_groups:
+                # Chunks are compared with each other directly: there are almost always just one or two
+                # different chunks, and buffers reused between chunks cannot be used as dict keys
+                file_names_by_chunk = []
+                for file_name in group:
+                    chunk = read_file_chunk(file_name, offset, chunk_size, open_files, buffers)
+                    for same_chunk, same_chunk_file_names in file_names_by_chunk:
+                        if chunk == same_chunk:
+                            same_chunk_file_names.append(file_name)
+                            break
+                    else:
+                        file_names_by_chunk.append((chunk, [file_name]))
+
+                if len(file_names_by_chunk) > 1:
+                    difference_offset = offset + find_first_difference(file_names_by_chunk[0][0],
+                                                                       file_names_by_chunk[1][0])
+                    print_verbose1(f"    difference found at offset {difference_offset}")
+
+                for chunk, same_chunk_file_names in file_names_by_chunk:
+                    if chunk and len(same_chunk_file_names) > 1:
+                        next_pending_groups.append(same_chunk_file_names)
+                    else:
+                        file_groups.append(same_chunk_file_names)
+                        for file_name in same_chunk_file_names:
+                            buffers.pop(file_name, None)
+                            if file_name in open_files:
+                                open_files.pop(file_name).close()
+
+            pending_groups = next_pending_groups
+            offset += chunk_size
+
+    finally:
+        for f in open_files.values():
+            f.close()
+
+    return sorted(file_groups)
+
+
+def read_file_chunk(file_name: str, offset: int, size: int, open_files: dict[str, BinaryIO],
+                    buffers: dict[str, bytearray]) -> bytes | bytearray:
+    """
+    Reads a chunk of a file for lockstep comparison. Keeps the file open for reading the next chunk, unless
+    --max-open-files files are already open: in this case the file is opened just for reading this chunk.
+
+    :param file_name: File name
+    :param offset: Chunk offset
+    :param size: Chunk size
+    :param open_files: Files already opened for reading, per file name
+    :param buffers: Reusable buffers per file name (not used with --io-method=read)
+    :return: Chunk contents, empty at the end of file. A reused buffer is overwritten by the next chunk
+    """
+    f = open_files.get(file_name)
+    if not f:
+        f = open_file(file_name)
+        f.seek(offset)
+        if len(open_files) < ARGS.max_open_files:
+            open_files[file_name] = f
+
+    try:
+        if ARGS.io_method == "read":
+            chunk = read_fully(f, size)
+            IO_STATS["requested_bytes"] += len(chunk)
+            return chunk
+
+        buffer = buffers.get(file_name)
+        if buffer is None:
+            buffer = buffers[file_name] = bytearray(size)
+
+        count = readinto_fully(f, memoryview(buffer))
+        IO_STATS["requested_bytes"] += count
+        return buffer if count == size else buffer[:count]
+
+    finally:
+        if file_name not in open_files:
+            f.close()
+
+
+def find_first_difference(data1: bytes | bytearray, data2: bytes | bytearray) -> int:
+    """
+    Finds the offset of the first differing byte of two buffers without looping over the bytes in Python:
+    the buffers are converted to little-endian integers, so that the lowest set bit of their XOR
+    is the first differing bit.
+
+    :param data1: A buffer to compare
+    :param data2: The other buffer to compare
+    :return: Offset of the first differing byte, or the length of the shorter buffer if it is a prefix of the other
+    """
+    length = min(len(data1), len(data2))
+    difference = (int.from_bytes(memoryview(data1)[:length], 'little') ^
+                  int.from_bytes(memoryview(data2)[:length], 'little'))
+
+    if not difference:
+        return length
+
+    return ((difference & -difference).bit_length() - 1) // 8
+
+
+def collect_chunk_files() -> list[tuple[str, FileStat]]:
+    """
+    Collects files for content-defined chunking (see --chunks argument) from FILE_TABLE before find_duplicates()
+    consumes it: files of at least --chunk-size bytes, one name per inode. Unless --chunk-max-size-ratio is 0,
+    a file is collected only if another collected file is at most that many times larger or smaller than it,
+    so that files of outstanding size are not read entirely for nothing.
+
+    :return: List of (file name, file stat) tuples
+    """
+    files_by_inode = {}
+    for file_name, stat in FILE_TABLE.iter_files():
+        if stat.size >= ARGS.chunk_size:
+            files_by_inode.setdefault((stat.dev, stat.ino), (file_name, stat))
+
+    files = sorted(files_by_inode.values(), key=lambda file: file[1].size)
+    if ARGS.chunk_max_size_ratio > 0:
+        # In the list sorted by size, the nearest sizes are those of the neighbours
+        sizes = [stat.size for file_name, stat in files]
+        files = [file for i, file in enumerate(files)
+                 if i > 0 and sizes[i] <= sizes[i - 1] * ARGS.chunk_max_size_ratio or
+                 i + 1 < len(files) and sizes[i + 1] <= sizes[i] * ARGS.chunk_max_size_ratio]
+
+    return sorted(files)
+
+
+def find_shared_chunks(files: list[tuple[str, FileStat]]) -> None:
+    """
+    Splits files into content-defined chunks (see calc_file_chunks()) and builds an index of chunk hashes to find
+    files which share a part of their contents, e.g. disk images or rotated logs which differ by a few bytes.
+    Prints pairs of such files with the number of shared bytes, most shared first, and the total space which
+    block-level deduplication would save: all bytes of the chunks which occur more than once, also within
+    a file or in identical files. Identical files are not paired again, see find_duplicates().
+    Chunks found in more than --chunk-max-files files (e.g. a common header or zero-filled blocks) are counted
+    as deduplicable, but do not pair the files, since pairing takes quadratic time. No more than --chunk-max-pairs
+    pairs are printed. All chunk hashes are kept in memory, about 100 bytes per chunk.
+
+    :param files: Files to split, see collect_chunk_files()
+    """
+    print_verbose1("Splitting %d files into chunks...", len(files))
+    stage_start = start_stage()
+    file_names = [file_name for file_name, stat in files]
+
+    chunk_futures = None
+    if ARGS.jobs > 1 and len(files) > 1:
+        chunk_futures = [get_hash_executor().submit(calc_file_chunks, file_name) for file_name in file_names]
+
+    # chunk hash -> (chunk length, indexes of the files which contain the chunk)
+    files_by_chunk: dict[bytes, tuple[int, list[int]]] = {}
+    file_fingerprints = []
+    chunk_count = 0
+    total_bytes = 0
+    unique_bytes = 0
+    chunked_file_count = 0
+    for i, file_name in enumerate(file_names):
+        try:
+            chunks = chunk_futures[i].result() if chunk_futures else calc_file_chunks(file_name)
+        except OSError as ex:
+            print_verbose1(f"    SKIPPED: {file_name}: {ex.strerror}")
+            file_fingerprints.append(None)
+            continue
+
+        IO_STATS["requested_bytes"] += files[i][1].size
+        chunked_file_count += 1
+        chunk_count += len(chunks)
+        file_fingerprints.append(hashlib.blake2b(b"".join(chunk_hash for chunk_hash, length in chunks)).digest())
+        for chunk_hash, length in chunks:
+            total_bytes += length
+            chunk = files_by_chunk.get(chunk_hash)
+            if chunk is None:
+                files_by_chunk[chunk_hash] = (length, [i])
+                unique_bytes += length
+            elif chunk[1][-1] != i:
+                chunk[1].append(i)
+
+    shared_bytes_by_pair = collections.Counter()
+    common_chunk_count = 0
+    for length, file_indexes in files_by_chunk.values():
+        if len(file_indexes) > ARGS.chunk_max_files:
+            common_chunk_count += 1
+            continue
+        for pair in itertools.combinations(file_indexes, 2):
+            shared_bytes_by_pair[pair] += length
+
+    if common_chunk_count:
+        print_verbose1("Not pairing files by %d chunks found in more than %d files each", common_chunk_count,
+                       ARGS.chunk_max_files)
+
+    # Of identical files, only the first one is paired with others, the rest are reported by find_duplicates()
+    first_file_by_fingerprint = {}
+    for i, fingerprint in enumerate(file_fingerprints):
+        if fingerprint is not None:
+            first_file_by_fingerprint.setdefault(fingerprint, i)
+
+    shared_files = set()
+    pair_count = 0
+    for (i, j), shared_bytes in shared_bytes_by_pair.most_common():
+        if first_file_by_fingerprint[file_fingerprints[i]] != i or first_file_by_fingerprint[file_fingerprints[j]] != j:
+            continue
+
+        shared_files.update((i, j))
+        pair_count += 1
+        if pair_count > ARGS.chunk_max_pairs > 0:
+            continue
+
+        print_normal("Shared chunks (%s, %.1f%% and %.1f%% of the files):\n    %s\n    %s",
+                     humanize.naturalsize(shared_bytes), shared_bytes * 100 / files[i][1].size,
+                     shared_bytes * 100 / files[j][1].size, file_names[i], file_names[j])
+
+    if pair_count > ARGS.chunk_max_pairs > 0:
+        print_normal("%d more pairs of files sharing less data are not shown, see --chunk-max-pairs",
+                     pair_count - ARGS.chunk_max_pairs)
+
+    add_stage_stats("chunks", stage_start, len(files), len(shared_files))
+    print_summary("Deduplicable block space in %d chunks of %d files: %s of %s (%.1f%%)", chunk_count,
+                  chunked_file_count, humanize.naturalsize(total_bytes - unique_bytes),
+                  humanize.naturalsize(total_bytes),
+                  (total_bytes - unique_bytes) * 100 / total_bytes if total_bytes else 0)
+
+
+def calc_file_chunks(file_name: str) -> list[tuple[bytes, int]]:
+    """
+    Splits a file into content-defined chunks (see find_chunk_cuts()) and calculates hash of each chunk using
+    hash engine given in --hash argument. Since chunk boundaries depend only on the contents around them, an insertion
+    or deletion of a few bytes changes only the chunks around it, and the rest of the chunks stay the same.
+    Can be called from hashing worker threads and processes, so it must not rely on global tables.
+
+    :param file_name: File name
+    :return: List of (chunk hash, chunk length) tuples in the order of chunks in the file
+    """
+    chunks = []
+    pending = bytearray()
+    with open_file(file_name) as f:
+        for block in itertools.chain(read_file_blocks(f, [(0, None)], INTERNAL_FILE_BUFFER_SIZE), [None]):
+            if block is not None:
+                pending += block
+
+            start = 0
+            with memoryview(pending) as view:
+                for end in find_chunk_cuts(pending, block is None):
+                    hasher = HASH_ENGINES[ARGS.hash]()
+                    hasher.update(view[start:end])
+                    chunks.append((hasher.digest(), end - start))
+                    start = end
+            del pending[:start]
+
+    return chunks
+
+
+def find_chunk_cuts(data: bytes | bytearray, final: bool) -> list[int]:
+    """
+    Finds chunk boundaries in data starting at a chunk boundary, FastCDC-style: a chunk ends after a byte where
+    the rolling gear hash of the last CHUNK_WINDOW bytes has all bits of a mask clear. The mask is stricter before
+    --chunk-size bytes and looser after it, so that chunk sizes concentrate around --chunk-size. Chunks are never
+    smaller than 1/4 and never larger than 8 times --chunk-size, except the last chunk of a file.
+
+    :param data: Data starting at a chunk boundary
+    :param final: Whether data ends at the end of file. If not, the incomplete last chunk is not returned
+    :return: Offsets of the chunk ends in data
+    """
+    min_size, max_size = ARGS.chunk_size // 4, ARGS.chunk_size * 8
+    strict_mask, loose_mask = get_chunk_masks(ARGS.chunk_size)
+    strict_candidates, loose_candidates = find_chunk_cut_candidates(data, strict_mask, loose_mask)
+
+    cuts = []
+    start = 0
+    while start < len(data):
+        end = None
+        normal = start + ARGS.chunk_size - 1
+        i = bisect.bisect_left(strict_candidates, start + min_size - 1)
+        if i < len(strict_candidates) and strict_candidates[i] < normal:
+            end = strict_candidates[i]
+        elif normal < len(data):
+            i = bisect.bisect_left(loose_candidates, normal)
+            if i < len(loose_candidates) and loose_candidates[i] < start + max_size - 1:
+                end = loose_candidates[i]
+            elif start + max_size - 1 < len(data):
+                end = start + max_size - 1
+
+        if end is None:
+            # More data is needed to find the end of this chunk, unless it is the last one
+            if final:
+                cuts.append(len(data))
+            break
+
+        cuts.append(end + 1)
+        start = end + 1
+
+    return cuts
+
+
+def get_chunk_masks(chunk_size: int) -> tuple[int, int]:
+    """
+    Returns masks of the gear hash bits checked by find_chunk_cuts(): with 2 bits more than log2(chunk_size) before
+    the normal chunk size and with 2 bits less after it (normalized chunking level 2 in FastCDC paper). The bits are
+    spread over the hash, so that cut points depend on all CHUNK_WINDOW bytes, not just on the last few of them.
+
+    :param chunk_size: Normal chunk size, a power of two
+    :return: Tuple of (strict mask, loose mask)
+    """
+    masks = []
+    for bit_count in (chunk_size.bit_length() + 1, chunk_size.bit_length() - 3):
+        masks.append(sum(1 << (i * CHUNK_WINDOW // bit_count) for i in range(bit_count)))
+
+    return masks[0], masks[1]
+
+
+def find_chunk_cut_candidates(data: bytes | bytearray, strict_mask: int, loose_mask: int) \
+        -> tuple[list[int], list[int]]:
+    """
+    Calculates the rolling gear hash for each byte of data: h = (h << 1) + GEAR[byte] modulo 2^32, which makes it
+    a function of the last 32 bytes only, and finds the bytes where the hash has all bits of a mask clear.
+    With NumPy, the hashes are calculated for all bytes at once: since the hash over a window of 2w bytes is the hash
+    over the last w bytes plus the hash over the w bytes before them shifted by w bits, 5 vector operations double
+    the window from 1 to 32 bytes. Without NumPy, bytes are processed one by one, which is much slower.
+
+    :param data: Data
+    :param strict_mask: Mask of the bits which must be clear at a strict candidate
+    :param loose_mask: Mask of the bits which must be clear at a loose candidate
+    :return: Tuple of (offsets of strict candidates, offsets of loose candidates), in ascending order
+    """
+    if numpy is not None:
+        hashes = GEAR_ARRAY[numpy.frombuffer(data, dtype=numpy.uint8)]
+        width = 1
+        while width < CHUNK_WINDOW:
+            hashes[width:] += hashes[:-width] << numpy.uint32(width)
+            width *= 2
+
+        return (numpy.flatnonzero((hashes & numpy.uint32(strict_mask)) == 0).tolist(),
+                numpy.flatnonzero((hashes & numpy.uint32(loose_mask)) == 0).tolist())
+
+    strict_candidates = []
+    loose_candidates = []
+    gear = GEAR
+    h = 0
+    for i, byte in enumerate(data):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        if not h & strict_mask:
+            strict_candidates.append(i)
+        if not h & loose_mask:
+            loose_candidates.append(i)
+
+    return strict_candidates, loose_candidates
+
+
+def execute_command_on_identical_files(group_hash: bytes, group: list[str]) -> None:
+    """
+    If user gave --exec argument, executes the given command for the group of identical files. No shell is involved:
+    the command is split into arguments like a shell does (see shlex.split()), and file names are appended to them
+    as separate arguments, optionally preceded by the hash (see --exec-hash-arg). File names are sorted
+    alphabetically.
+    With --exec-batch, groups are collected and given to a single command on its stdin, see start_command_batch().
+    With --exec-jobs greater than 1, the command runs in background, up to --exec-jobs commands at once, otherwise
+    it finishes before the search continues. Output/error are passed through.
+    Failed commands are reported in the summary, see finish_commands().
+
+    :param group_hash: Hash digest for this group of files
+    :param group: File names to give to the command
+    """
+    if not ARGS.exec:
+        return
+
+    hash_args = [format_hash(group_hash)] if ARGS.exec_hash_arg else []
+    if ARGS.exec_batch > 0:
+        EXEC_BATCH.append(hash_args + group)
+        if len(EXEC_BATCH) >= ARGS.exec_batch:
+            start_command_batch()
+    else:
+        start_command(ARGS.exec + hash_args + group, None)
+
+
+def start_command_batch() -> None:
+    """
+    Starts --exec command for the groups collected in EXEC_BATCH. Each group is written to the command's stdin as
+    a record of NUL-terminated fields: the hash (if --exec-hash-arg is given) and the file names, followed by an empty
+    field (so a record ends with two NUL characters). Any file name can be passed this way, like with find -print0.
+    """
+    if not EXEC_BATCH:
+        return
+
+    records = b"".join(b"".join(os.fsencode(field) + b"\0" for field in record) + b"\0" for record in EXEC_BATCH)
+    EXEC_BATCH.clear()
+    start_command(ARGS.exec, records)
+
+
+def start_command(argv: list[str], records: bytes | None) -> None:
+    """
+    Starts --exec command in background, first waiting for a running command to finish if --exec-jobs commands
+    are running already. If --exec-jobs is 1, waits for the command to finish, so that its output comes right after
+    the output of the group it is executed for.
+
+    :param argv: Command and its arguments
+    :param records: Data to write to the command's stdin, or None to pass our stdin through
+    """
+    while len(EXEC_PROCESSES) >= ARGS.exec_jobs:
+        wait_for_command()
+
+    if is_verbose(2):
+        print_verbose2("Executing %s%s", shlex.join(argv), f" with {len(records)} bytes on stdin" if records else "")
+
+    # Let the command's output follow our output printed so far
+    sys.stdout.flush()
+    EXEC_STATS["started"] += 1
+    try:
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE if records is not None else None)
+    except OSError as ex:
+        # Report it like shell does for a command which is not found
+        print_normal("ERROR: cannot execute %s: %s", argv[0], ex.strerror)
+        EXEC_STATS["failed"][127] = EXEC_STATS["failed"].get(127, 0) + 1
+        return
+
+    writer = None
+    if records is not None:
+        # A separate thread feeds the command, so that hashing continues while the command reads its input
+        writer = threading.Thread(target=write_command_input, args=(process, records), daemon=True)
+        writer.start()
+
+    EXEC_PROCESSES.append((argv, process, writer))
+    if ARGS.exec_jobs == 1:
+        wait_for_command()
+
+
+def write_command_input(process: subprocess.Popen, records: bytes) -> None:
+    """
+    Writes the batch of records to the stdin of the command and closes it. Runs in a separate thread.
+
+    :param process: Command process
+    :param records: Records, see start_command_batch()
+    """
+    try:
+        process.stdin.write(records)
+    except BrokenPipeError:
+        pass  # The command is not interested in the rest of its input, its exit code tells if it is an error
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def wait_for_command() -> None:
+    """
+    Waits for the oldest running --exec command to finish and accounts its exit code.
+    """
+    argv, process, writer = EXEC_PROCESSES.popleft()
+    return_code = process.wait()
+    if writer:
+        writer.join()
+
+    if return_code != 0:
+        print_verbose1("Command %s exited with code %d", shlex.join(argv[:1]), return_code)
+        EXEC_STATS["failed"][return_code] = EXEC_STATS["failed"].get(return_code, 0) + 1
+
+
+def act_on_identical_files(group: list[str]) -> None:
+    """
+    Performs --action on a group of identical files: the alphabetically first file is kept, the others are replaced
+    with hard links to it or copy-on-write clones of it, or deleted. Each file is re-verified just before acting:
+    if its size or modification time has changed since it was hashed, it is skipped. A file with other hard links
+    (see HARD_LINKS_BY_FILE) is acted on under all its names, and its space is counted as reclaimed only if all of
+    them are done. With --dry-run, only prints what would be done.
+
+    :param group: Names of the identical files, sorted alphabetically
+    """
+    # Archive members cannot be replaced or deleted without rewriting the archive
+    group = [file_name for file_name in group if STAT_BY_FILE[file_name].dev != ARCHIVE_MEMBER_DEV]
+    if len(group) < 2:
+        return
+
+    original = group[0]
+    if not is_file_unchanged(original):
+        print_normal("SKIPPED: %s: changed since it was compared, keeping all its duplicates", original)
+        ACTION_STATS["skipped"] += sum(1 + len(HARD_LINKS_BY_FILE.get(file_name, ())) for file_name in group[1:])
+        return
+
+    for file_name in group[1:]:
+        linked_file_names = [file_name] + HARD_LINKS_BY_FILE.get(file_name, [])
+        changed_file_names = [linked_file_name for linked_file_name in linked_file_names
+                              if not is_file_unchanged(linked_file_name)]
+        if changed_file_names:
+            for changed_file_name in changed_file_names:
+                print_normal("SKIPPED: %s: changed since it was compared", changed_file_name)
+            ACTION_STATS["skipped"] += len(linked_file_names)
+            continue
+
+        if ARGS.dry_run:
+            for linked_file_name in linked_file_names:
+                print_normal("Would %s %s", ARGS.action, linked_file_name)
+            ACTION_STATS["done"] += len(linked_file_names)
+            ACTION_STATS["bytes"] += get_allocated_size(file_name, STAT_BY_FILE[file_name])
+            continue
+
+        all_done = True
+        for linked_file_name in linked_file_names:
+            try:
+                if ARGS.action == "delete":
+                    os.remove(linked_file_name)
+                else:
+                    replace_file(original, linked_file_name, ARGS.action)
+                    if ARGS.watch:
+                        stat = os.stat(linked_file_name)
+                        WATCH_REPLACED_FILES[linked_file_name] = (stat.st_dev, stat.st_ino)
+
+            except OSError as ex:
+                print_normal("ERROR: cannot %s %s: %s", ARGS.action, linked_file_name, ex.strerror)
+                ACTION_STATS["failed"] += 1
+                all_done = False
+                continue
+
+            print_verbose1("Done %s of %s", ARGS.action, linked_file_name)
+            ACTION_STATS["done"] += 1
+
+        # The data stays on disk while any name of the file is left
+        if all_done:
+            ACTION_STATS["bytes"] += get_allocated_size(file_name, STAT_BY_FILE[file_name])
+
+
+def is_file_unchanged(file_name: str) -> bool:
+    """
+    Checks that the file still has the size and modification time it had when it was scanned.
 
-""" Parsed program arguments """
-ARGS: Namespace = Namespace()
+    :param file_name: File name
+    :return: True if the file exists and is unchanged
+    """
+    stat = STAT_BY_FILE[file_name]
+    try:
+        current_stat = os.stat(file_name)
+    except OSError:
+        return False
 
-""" All found files grouped by size """
-FILES_BY_SIZE: dict[int, set[str]] = {}
-""" Size per each found file """
-SIZE_BY_FILE: dict[str, int] = {}
-""" Filesystem cluster size in bytes per path given in arguments. Used to calculate wasted disk space """
-CLUSTER_SIZE_BY_PATH: dict[str, int] = {}
+    return current_stat.st_size == stat.size and current_stat.st_mtime_ns == stat.mtime_ns
 
 
-def main() -> None:
+def replace_file(original: str, file_name: str, action: str) -> None:
     """
-    Main functionality:
-    1. parses arguments,
-    2. obtains paths to scan,
-    3. adds all files in these paths into global tables above,
-    4. finds and reports duplicates
+    Atomically replaces a file with a hard link to the original file or with a copy-on-write clone of it.
+    The link or clone is created under a temporary name in the same directory first and then renamed over the file,
+    so the file name always refers to either the old or the new contents. A clone keeps permissions and times
+    of the replaced file. If the temporary name is already taken, the replacement fails and that file is left intact.
+
+    :param original: Name of the file to keep
+    :param file_name: Name of the identical file to replace
+    :param action: "hardlink" or "reflink"
     """
-    global ARGS
-    ARGS = process_args()
+    dir_name, base_name = os.path.split(file_name)
+    temp_name = os.path.join(dir_name, f".{base_name}.findup-{os.getpid()}")
+    temp_created = False
 
-    paths = get_paths()
+    try:
+        if action == "hardlink":
+            os.link(original, temp_name)
+            temp_created = True
+        else:
+            if not fcntl:
+                raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
 
-    for path in paths:
-        save_cluster_size(path)
-        add_files(path)
+            stat = os.stat(file_name)
+            with open(original, "rb") as src, open(temp_name, "xb") as dst:
+                temp_created = True
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.chmod(temp_name, stat.st_mode & 0o7777)
+            os.utime(temp_name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
 
-    find_duplicates()
+        os.replace(temp_name, file_name)
 
+    except OSError:
+        # Never remove a file findup has not created, e.g. when the link or open failed with EEXIST
+        if temp_created:
+            try:
+                os.remove(temp_name)
+            except FileNotFoundError:
+                pass
+        raise
 
-def get_paths() -> list[str]:
-    """
-    Extracts list of directory paths to scan from argument file or stdin (--paths option) plus command-line arguments.
 
-    :return: List of directory paths to scan, or emtpy list if none
+def report_actions() -> None:
     """
-    dirlist = []
-    if ARGS.paths_file:
-        dirlist.extend([line.strip() for line in ARGS.paths_file])
+    Prints summary of --action: number of replaced or deleted files, reclaimed space, skipped and failed files.
+    """
+    if ARGS.dry_run:
+        summary = "Would %s %d files and reclaim %s" % (ARGS.action, ACTION_STATS["done"],
+                                                          humanize.naturalsize(ACTION_STATS["bytes"]))
+    else:
+        summary = "Done %s of %d files, reclaimed %s" % (ARGS.action, ACTION_STATS["done"],
+                                                           humanize.naturalsize(ACTION_STATS["bytes"]))
 
-    if ARGS.paths:
-        dirlist.extend(ARGS.paths)
+    if ACTION_STATS["skipped"]:
+        summary += f", skipped {ACTION_STATS['skipped']} changed files"
+    if ACTION_STATS["failed"]:
+        summary += f", failed {ACTION_STATS['failed']} files"
 
-    return dirlist
+    print_summary(summary)
 
 
-def add_files(path: str) -> None:
+def finish_commands() -> None:
     """
-    Scans the path for the subdirectories and files. Invokes itself recursively for subdirectories.
-    Adds files to the global list of candidate files. If the path does not exist, just does nothing.
-
-    :param path: Filesystem path to scan.
+    Starts --exec command for the last incomplete batch, waits for all running commands and reports the failed ones
+    in the summary.
     """
-    print_verbose1(f"Scanning {path}:")
+    if not ARGS.exec:
+        return
 
-    if os.path.isfile(path):
-        add_file(path)
-    else:
-        for root, dirs, files in os.walk(path):
-            for dir_name in dirs:
-                add_files(os.path.join(root, dir_name))
-            for file_name in files:
-                add_file(os.path.join(root, file_name))
+    start_command_batch()
+    while EXEC_PROCESSES:
+        wait_for_command()
 
+    failed = EXEC_STATS["failed"]
+    if failed:
+        print_summary("Failed commands: %d of %d (exit codes: %s)", sum(failed.values()), EXEC_STATS["started"],
+                      ", ".join(f"{code} x{count}" for code, count in sorted(failed.items())))
 
-def save_cluster_size(path: str) -> None:
-    """
-    Saves cluster size for given path into a global variable CLUSTER_SIZE_BY_PATH.
-    Cluster size is used to calculate wasted disk space due to duplicates. Exceptions are silently ignored.
 
-    :param path: Path to find cluster size for
+def start_watch() -> None:
     """
+    Creates an inotify instance for --watch. Directories are added to it by add_files() while they are scanned,
+    so that no change is missed between the scan and the start of watching. Exits the process if inotify
+    is not available.
+    """
+    global LIBC, WATCH_FD
+
     try:
-        cluster_size = fs_cluster_size(path)
-        CLUSTER_SIZE_BY_PATH[path] = cluster_size
-        print_verbose2(f"Cluster size: {humanize.naturalsize(cluster_size)}")
+        LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = LIBC.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        print("ERROR: --watch requires inotify, which is not available on this platform")
+        exit(1)
 
-    except OSError as ex:
-        print_verbose3(f"Error obtaining cluster size for {path}: {ex}")
+    if fd < 0:
+        print(f"ERROR: cannot start watching: {os.strerror(ctypes.get_errno())}")
+        exit(1)
 
+    WATCH_FD = fd
 
-def add_file(file_name: str) -> None:
+
+def add_watch(dir_path: str) -> None:
     """
-    Adds a file to global list of candidates (FILES_BY_SIZE, SIZE_BY_FILE).
-    File is not added if its size is less than the minimal (see program arguments).
+    Adds a directory to the inotify instance. Adding the same directory again just updates its path,
+    e.g. after it has been moved. Errors (e.g. exceeded fs.inotify.max_user_watches) are reported and ignored.
 
-    :param file_name: File name to add
+    :param dir_path: Directory to watch
     """
-    if ARGS.exclude and any(fnmatch.fnmatch(file_name, glob) for glob in ARGS.exclude):
-        print_verbose2(f"    SKIPPED: {file_name}: excluded via -x")
+    wd = LIBC.inotify_add_watch(WATCH_FD, os.fsencode(dir_path), WATCH_MASK)
+    if wd < 0:
+        print_normal("WARNING: cannot watch %s: %s", dir_path, os.strerror(ctypes.get_errno()))
         return
 
-    if ARGS.exclude_re and any(re.match(regex, file_name) for regex in ARGS.exclude_re):
-        print_verbose2(f"    SKIPPED: {file_name}: excluded via -X")
-        return
+    WATCH_DIRS[wd] = dir_path
 
-    file_size = os.path.getsize(file_name)
 
-    if file_size < ARGS.min_file_size:
-        print_verbose2(f"    SKIPPED: {file_name}: {file_size} bytes (too small)")
-        return
+def init_watched_files() -> None:
+    """
+    Copies all scanned files from FILE_TABLE into WATCH_FILES and WATCH_FILES_BY_SIZE, since find_duplicates() keeps
+    only the candidates of the current batch. Full hashes calculated by find_duplicates() are saved into WATCH_HASHES
+    by group_by_stage_hash().
+    """
+    for file_name, stat in FILE_TABLE.iter_files():
+        WATCH_FILES[file_name] = stat
+        WATCH_FILES_BY_SIZE.setdefault(stat.size, set()).add(file_name)
 
-    print_verbose2(f"    {file_name}: {file_size} bytes")
 
-    FILES_BY_SIZE.setdefault(file_size, set()).add(file_name)
-    SIZE_BY_FILE[file_name] = file_size
+def watch() -> None:
+    """
+    Watches the scanned directories for created, modified, moved and deleted files until interrupted (Ctrl+C).
+    Events are collected for --watch-delay seconds after the first one, so that a burst of changes is handled
+    at once. Only the changed files are hashed, together with the not yet hashed files of the same size,
+    and duplicate groups of the changed files are reported as they appear.
+    """
+    print_normal("Watching %d directories for changes, press Ctrl+C to stop", len(WATCH_DIRS))
+    sys.stdout.flush()
 
+    try:
+        while True:
+            changed_paths = read_watch_events()
+            while select.select([WATCH_FD], [], [], ARGS.watch_delay)[0]:
+                changed_paths.update(read_watch_events())
 
-def find_duplicates() -> None:
-    """
-    Searches for duplicates and prints them and/or executes a scripts. Calculates and reports wasted space.
-    Files are grouped first by size (in add_file() function), within groups, hashes are calculated for file prefix
-    (see --prefix argument), creating more groups if necessary. After that in each group, hashes are calculated
-    for the full file contents, creating even more groups, if needed.
-    So far all comparisons have been of O(n) complexity. However, if user specified --paranoid program argument,
-    within the groups from the last step, we compare the contents of the files byte-by-byte to create even more groups
-    if needed (O(n^2) complexity). Normally --paranoid should not be needed, as having a collision in two hashes
-    (crc32 and mmh3) are rare. If user is still not satisfied, it is perhaps a time to seek a spiritual teacher :)
+            changed_files = update_watched_files(changed_paths)
+            if changed_files:
+                find_watched_duplicates(changed_files)
+                start_command_batch()
 
-    Total number of duplicate files (minus original ones!) and wasted space (again, minus the original one)
-    is calculated. "Original" file is selected as the first in the alphabetical list of full paths.
-    """
-    print_verbose1("Finding duplicates...")
-    total_wasted_disk_space = 0
-    total_duplicates = 0
+            sys.stdout.flush()
 
-    for size, file_names in FILES_BY_SIZE.items():
-        if len(file_names) < 2:
-            continue
+    except KeyboardInterrupt:
+        print_verbose1("Stopped watching")
 
-        file_by_prefix_hash = group_by_prefix_hash(file_names, size)
-        file_by_hash = group_by_entire_file_hash(file_by_prefix_hash)
-        file_groups = group_by_hash_or_contents(file_by_hash)
+    finally:
+        os.close(WATCH_FD)
 
-        for group_hash, groups_by_hash in file_groups.items():
-            for group in groups_by_hash:
-                if len(group) < 2:
-                    continue
+    finish_commands()
+    if ARGS.action:
+        report_actions()
 
-                duplicate_count = len(group) - 1
-                wasted_disk_space = 0
-                for cur_file_name in group[1:]:
-                    wasted_disk_space += round_file_size(cur_file_name, size)
 
-                print_normal(f"Duplicates ({size} bytes each, wasted {humanize.naturalsize(wasted_disk_space)}):\n"
-                             f"    {'\n    '.join(group)}")
+def read_watch_events() -> dict[str, None]:
+    """
+    Reads inotify events, waiting for them if none are available. Files being created are ignored until they are
+    closed after writing, but created directories are scanned at once, so that files written into them are not missed.
 
-                execute_command_on_identical_files(group_hash, group)
+    :return: Changed paths, in the order of events (dict is used as an ordered set)
+    """
+    changed_paths = {}
+    buffer = os.read(WATCH_FD, 65536)
+    offset = 0
+    while offset < len(buffer):
+        wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+        name = os.fsdecode(buffer[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+        offset += INOTIFY_EVENT.size + length
 
-                total_wasted_disk_space += wasted_disk_space
-                total_duplicates += duplicate_count
+        if mask & IN_Q_OVERFLOW:
+            print_normal("WARNING: too many changes at once, some of them are missed. Restart to rescan everything")
+        elif mask & IN_IGNORED:
+            WATCH_DIRS.pop(wd, None)
+        elif wd in WATCH_DIRS and (mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE)
+                                   or mask & IN_CREATE and mask & IN_ISDIR):
+            changed_paths[os.path.join(WATCH_DIRS[wd], name)] = None
 
-    print_summary(f"Total wasted disk space in {str(total_duplicates)} files: "
-                  f"{humanize.naturalsize(total_wasted_disk_space)}")
+    return changed_paths
 
 
-def group_by_prefix_hash(file_names: set[str], size: int) -> dict[str, set[str]]:
+def update_watched_files(changed_paths: dict[str, None]) -> list[str]:
     """
-    For each given file name calculates hash (crc32 + mmh3) of the first <size> bytes of the file and
-    groups the file names by the hash. Returns a dict: hash -> [list of files with the same hash].
+    Updates WATCH_FILES with the current state of the changed paths: removes the files (and the directories)
+    which are no longer there, and rescans the files and directories which are, applying the same filters
+    as the initial scan. A file just replaced by --action is not considered changed, otherwise its own event
+    would make it a duplicate again, and a clone would be replaced again and again.
 
-    :param file_names: File names to calculate the hash for
-    :param size: The size of the files (since we first group files by size, all file_names will be of the same size)
-    :return: dict containing sets of files grouped by hash
+    :param changed_paths: Changed paths reported by inotify
+    :return: Names of the new or changed files, which need to be checked for duplicates
     """
-    file_by_prefix_hash = {}
-    prefix_size = min(size, ARGS.prefix_size)
+    global FILE_TABLE
 
-    for file_name in file_names:
-        file_prefix_hash = calc_file_hash(file_name, prefix_size)
-        file_by_prefix_hash.setdefault(file_prefix_hash, set()).add(file_name)
+    FILE_TABLE = FileTable()
+    for path in changed_paths:
+        remove_watched_file(path)
+        prefixes = (path + os.sep, path + ARCHIVE_SEPARATOR)
+        for file_name in [file_name for file_name in WATCH_FILES if file_name.startswith(prefixes)]:
+            remove_watched_file(file_name)
 
-    return file_by_prefix_hash
+        if os.path.isdir(path):
+            if not get_dir_exclusion(path):
+                add_files(path)
+        elif os.path.isfile(path):
+            add_file(path)
 
+    changed_files = []
+    for file_name, stat in FILE_TABLE.iter_files():
+        WATCH_FILES[file_name] = stat
+        WATCH_FILES_BY_SIZE.setdefault(stat.size, set()).add(file_name)
+        if WATCH_REPLACED_FILES.pop(file_name, None) != (stat.dev, stat.ino):
+            changed_files.append(file_name)
 
-def group_by_entire_file_hash(file_by_prefix_hash: dict[str, set[str]]) -> dict[str, set[str]]:
+    FILE_TABLE = FileTable()
+    return changed_files
+
+
+def remove_watched_file(file_name: str) -> None:
+    """
+    Removes a file from WATCH_FILES, WATCH_FILES_BY_SIZE and WATCH_HASHES, if it is there.
+
+    :param file_name: File name
+    """
+    stat = WATCH_FILES.pop(file_name, None)
+    if stat:
+        WATCH_FILES_BY_SIZE[stat.size].discard(file_name)
+        WATCH_HASHES.pop(file_name, None)
+
+
+def find_watched_duplicates(changed_files: list[str]) -> None:
     """
-    For each dict value given in the argument calculates hash (crc32 + mmh3) of the entire file and
-    groups the file names by the hash. Skips an entry if there are just one or no files in it.
-    Returns a dict: hash -> [list of files with the same hash].
+    Finds and reports duplicates of the changed files among all watched files. Full hashes are calculated
+    for the changed files and for the files of the same size which have not been hashed yet, files which cannot be
+    read anymore are skipped.
 
-    :param file_by_prefix_hash: An output from group_by_prefix_hash():
-           a dict: hash -> [names of the files with the same hash]
-    :return: a dict: hash -> [names of the files with the same hash (of entire file)]
+    :param changed_files: Names of the new or changed files
     """
-    file_by_hash = {}
+    sizes = {WATCH_FILES[file_name].size for file_name in changed_files}
+    file_names = [file_name for size in sorted(sizes) if len(WATCH_FILES_BY_SIZE[size]) >= 2
+                  for file_name in sorted(WATCH_FILES_BY_SIZE[size]) if file_name not in WATCH_HASHES]
+    STAT_BY_FILE.update((file_name, WATCH_FILES[file_name]) for file_name in file_names)
 
-    for group_hash, same_hash_file_names in file_by_prefix_hash.items():
-        if len(same_hash_file_names) < 2:
+    requests = [(file_name, get_stage_kind("full", STAT_BY_FILE[file_name].size),
+                 get_stage_ranges("full", STAT_BY_FILE[file_name].size)) for file_name in file_names]
+    try:
+        WATCH_HASHES.update(zip(file_names, get_file_hashes(requests)))
+    except OSError:
+        # Some files have changed or vanished after the event, hash the rest one by one
+        for request in requests:
+            try:
+                WATCH_HASHES[request[0]] = get_file_hashes([request])[0]
+            except OSError as ex:
+                print_verbose1("    SKIPPED: %s: %s", request[0], ex.strerror)
+
+    reported_groups = set()
+    for file_name in changed_files:
+        file_hash = WATCH_HASHES.get(file_name)
+        if file_hash is None:
             continue
 
-        print_verbose2(f"Processing identical hash group:\n    {'\n    '.join(same_hash_file_names)}\n")
+        # Hard links to the same file are not duplicates, keep the alphabetically first name of each inode
+        group_by_inode = {}
+        for cur_file_name in sorted(WATCH_FILES_BY_SIZE[WATCH_FILES[file_name].size]):
+            stat = WATCH_FILES[cur_file_name]
+            if WATCH_HASHES.get(cur_file_name) == file_hash:
+                group_by_inode.setdefault((stat.dev, stat.ino), cur_file_name)
+
+        group = sorted(group_by_inode.values())
+        if len(group) < 2 or tuple(group) in reported_groups:
+            continue
 
-        for file_name in same_hash_file_names:
-            file_hash = calc_file_hash(file_name)
-            file_by_hash.setdefault(file_hash, set()).add(file_name)
+        reported_groups.add(tuple(group))
+        STAT_BY_FILE.update((cur_file_name, WATCH_FILES[cur_file_name]) for cur_file_name in group)
+        for group_hash, groups in group_by_hash_or_contents({file_hash: group}).items():
+            for same_contents_group in groups:
+                if len(same_contents_group) >= 2:
+                    report_duplicates(group_hash, WATCH_FILES[file_name].size, same_contents_group)
 
-    return file_by_hash
+    STAT_BY_FILE.clear()
 
 
-def calc_file_hash(file_name: str, size: int = None) -> str:
+def get_allocated_size(file_name: str, stat: FileStat) -> int:
     """
-    Calculates hash of first size bytes of the file_name or entire file if size is None.
+    Returns disk space allocated for a file. Where the OS provides the number of allocated blocks (st_blocks),
+    it is used, which is correct for sparse and compressed files. Otherwise, file size is rounded up to cluster size
+    of the file's filesystem. If no cluster size information available, returns file size.
 
-    Reads file contents into a limited buffer in order to keep memory consumption moderate.
+    :param file_name: File name
+    :param stat: File metadata as collected by add_file()
+    :return: Allocated disk space in bytes
+    """
+    if stat.blocks >= 0:
+        return stat.blocks * 512
 
-    :param file_name File to calculate the hash for
-    :param size How many bytes to include into hash from the beginning, or None to calculate for the entire file
+    cluster_size = get_cluster_size(file_name, stat.dev)
+    return math.ceil(stat.size / cluster_size) * cluster_size if cluster_size else stat.size
+
+
+def get_cluster_size(file_name: str, dev: int) -> [int, None]:
     """
-    print_verbose3("Calculating hash for "
-                   f"{'first ' + str(size) + ' bytes of ' if size else ''}{file_name}: ",
-                   end='')
+    Returns cluster size of the filesystem of a given file. Cluster sizes are cached per device, so the filesystem
+    is queried once per device. If the cluster size cannot be found, returns None.
 
-    if ARGS.mock_prefix_hash and size:
-        print_verbose3(f"{ARGS.mock_prefix_hash}")
-        return ARGS.mock_prefix_hash
+    :param file_name: Name of a file on the device
+    :param dev: Device number of the file (st_dev)
+    :return: None or cluster size
+    """
+    if dev not in CLUSTER_SIZE_BY_DEV:
+        try:
+            CLUSTER_SIZE_BY_DEV[dev] = fs_cluster_size(file_name)
+        except OSError as ex:
+            print_verbose3(f"Error obtaining cluster size for {file_name}: {ex}")
+            CLUSTER_SIZE_BY_DEV[dev] = None
 
-    if ARGS.mock_full_hash and not size:
-        print_verbose3(f"{ARGS.mock_full_hash}")
-        return ARGS.mock_full_hash
+    return CLUSTER_SIZE_BY_DEV[dev]
 
-    if not size:
-        size = SIZE_BY_FILE[file_name]
 
-    buffer_size = max(INTERNAL_FILE_BUFFER_SIZE, get_cluster_size(file_name))
-    offset = 0
-    hash1 = 0
-    hash2 = 0
-    with open(file_name, 'rb') as f:
-        while offset < size:
-            buffer = f.read(min(buffer_size, size - offset))
-            if not buffer:
-                break
-            hash1 = zlib.crc32(buffer, hash1)
-            hash2 = mmh3.hash(buffer, hash2, signed=False)
-            offset += len(buffer)
+def open_hash_cache(cache_file: str) -> None:
+    """
+    Opens (creating if necessary) the persistent hash cache database into HASH_CACHE global variable.
+    Cache entries are keyed by device and inode numbers, and are valid only while file size and modification time
+    stay the same. If the cache cannot be opened, prints a warning and continues without the cache.
 
-    file_hash = str(hash1) + "_" + str(hash2)
-    print_verbose3(f"{file_hash}")
-    return file_hash
+    :param cache_file: SQLite database file name
+    """
+    global HASH_CACHE, HASH_CACHE_RUN_TIME, HASH_CACHE_COMMIT_TIME
+
+    try:
+        db = sqlite3.connect(cache_file)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS file_hash ("
+                   "dev INTEGER NOT NULL, ino INTEGER NOT NULL, kind TEXT NOT NULL, "
+                   "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash BLOB NOT NULL, last_used INTEGER NOT NULL, "
+                   "PRIMARY KEY (dev, ino, kind))")
+        db.execute("CREATE INDEX IF NOT EXISTS file_hash_last_used ON file_hash (last_used)")
+
+    except sqlite3.Error as ex:
+        print(f"WARNING: cannot open hash cache {cache_file}, continuing without it: {ex}")
+        return
+
+    HASH_CACHE = db
+    HASH_CACHE_RUN_TIME = time.time_ns()
+    HASH_CACHE_COMMIT_TIME = time.monotonic()
+    print_verbose1(f"Using hash cache {cache_file}")
 
 
-def group_by_hash_or_contents(file_by_hash: dict[str, set[str]]) -> dict[str, list[list[str]]]:
+def get_cached_hash(stat: FileStat, kind: str) -> [bytes, None]:
     """
-    If user has specified --paranoid argument, this method will perform binary file comparisons inside groups,
-    adding more groups when needed. If no such argument provided, output is basically the input with
-    groups sorted alphabetically
+    Looks up a hash in the persistent hash cache. If the file has been changed since the hash was stored,
+    all cached hashes for the file are invalidated.
 
-    :param file_by_hash: Files already grouped by hash
-    :return: Files grouped by exact contents, sorted alphabetically within group
+    :param stat: File metadata as collected by add_file()
+    :param kind: Hash kind, see get_stage_kind()
+    :return: Cached hash or None if not found
     """
-    file_groups = {}
+    row = HASH_CACHE.execute("SELECT size, mtime_ns, hash FROM file_hash WHERE dev = ? AND ino = ? AND kind = ?",
+                             (stat.dev, stat.ino, kind)).fetchone()
 
-    for group_hash, cur_file_names in file_by_hash.items():
-        if len(cur_file_names) < 2:
-            continue
+    if row and (row[0] != stat.size or row[1] != stat.mtime_ns):
+        HASH_CACHE.execute("DELETE FROM file_hash WHERE dev = ? AND ino = ?", (stat.dev, stat.ino))
+        HASH_CACHE_STATS["stale"] += 1
+        row = None
 
-        sorted_file_names = sorted(list(cur_file_names))
+    if not row:
+        HASH_CACHE_STATS["misses"] += 1
+        return None
 
-        if ARGS.paranoid:
-            file_groups.setdefault(group_hash, list()).extend(paranoid_compare_files(sorted_file_names))
-        else:
-            file_groups.setdefault(group_hash, list()).append(sorted_file_names)
+    HASH_CACHE.execute("UPDATE file_hash SET last_used = ? WHERE dev = ? AND ino = ? AND kind = ?",
+                       (HASH_CACHE_RUN_TIME, stat.dev, stat.ino, kind))
+    HASH_CACHE_STATS["hits"] += 1
+    return row[2]
 
-    return file_groups
 
+def put_cached_hash(stat: FileStat, kind: str, file_hash: bytes) -> None:
+    """
+    Stores a hash into the persistent hash cache. Commits the stored hashes every HASH_CACHE_COMMIT_INTERVAL
+    seconds, so that the hashes calculated so far are kept if the program is interrupted or crashes.
 
-def paranoid_compare_files(sorted_file_names: list[str]) -> list[list[str]]:
+    :param stat: File metadata as collected by add_file()
+    :param kind: Hash kind, see get_stage_kind()
+    :param file_hash: Hash to store
     """
-    Compares files byte-by-byte and groups them into file having exactly the same contents.
-    Takes each file in order and tries to find a group for it by comparing with the first file in the group.
-    Worst case complexity is O(n^2).
+    global HASH_CACHE_COMMIT_TIME
 
-    Called for files having the same hash when --paranoid argument is given.
+    HASH_CACHE.execute("INSERT OR REPLACE INTO file_hash (dev, ino, kind, size, mtime_ns, hash, last_used) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (stat.dev, stat.ino, kind, stat.size, stat.mtime_ns, file_hash, HASH_CACHE_RUN_TIME))
 
-    :param sorted_file_names: list of names of the files to compare
-    :return: list of groups. Each group is the list of files having exactly the same content
+    if time.monotonic() - HASH_CACHE_COMMIT_TIME >= HASH_CACHE_COMMIT_INTERVAL:
+        HASH_CACHE.commit()
+        HASH_CACHE_COMMIT_TIME = time.monotonic()
+
+
+def close_hash_cache() -> None:
     """
-    file_groups = []
+    Evicts least recently used entries exceeding --cache-max-entries, saves and closes the hash cache.
+    Prints cache statistics if --cache-stats argument is given.
+    """
+    global HASH_CACHE
 
-    for cur_file_name in sorted_file_names:
-        found_group = False
+    entry_count = HASH_CACHE.execute("SELECT COUNT(*) FROM file_hash").fetchone()[0]
+    if entry_count > ARGS.cache_max_entries:
+        HASH_CACHE.execute("DELETE FROM file_hash WHERE rowid IN "
+                           "(SELECT rowid FROM file_hash ORDER BY last_used LIMIT ?)",
+                           (entry_count - ARGS.cache_max_entries,))
+        HASH_CACHE_STATS["evicted"] = entry_count - ARGS.cache_max_entries
 
-        for group in file_groups:
-            if are_files_binary_identical(cur_file_name, group[0]):
-                group.append(cur_file_name)
-                found_group = True
-                break
+    HASH_CACHE.commit()
+    HASH_CACHE.close()
+    HASH_CACHE = None
 
-        if not found_group:
-            file_groups.append([cur_file_name])
+    if ARGS.cache_stats:
+        print_normal(f"Hash cache: {HASH_CACHE_STATS['hits']} hits, {HASH_CACHE_STATS['misses']} misses, "
+                     f"{HASH_CACHE_STATS['stale']} stale, {HASH_CACHE_STATS['evicted']} evicted, "
+                     f"{humanize.naturalsize(HASH_CACHE_STATS['bytes_saved'])} not read thanks to cache")
 
-    return file_groups
 
+def write_manifest(manifest_file: str) -> None:
+    """
+    Writes all found files with their prefix hashes (and full hashes if --manifest-full-hashes is given) into
+    a manifest file, which can be merged with manifests written on other hosts, see merge_manifests().
+    The manifest is a JSON Lines file: a header with format version, host name and hashing parameters, followed by
+    one record per file. Full hashes of the files not longer than --prefix-size are always written, since they are
+    the same as prefix hashes. Files are hashed in batches, so that they can be hashed in parallel (see --jobs).
 
-def are_files_binary_identical(file1: str, file2: str) -> bool:
+    :param manifest_file: Manifest file name
     """
-    Does binary comparison of the files, reading them in buffers of max(cluster size, 1MB).
+    stages = ("prefix", "full") if ARGS.manifest_full_hashes else ("prefix",)
+    header = {"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION, "host": ARGS.host, "hash": ARGS.hash,
+              "prefix_size": ARGS.prefix_size}
+    file_count = 0
 
-    Reads file contents into a limited buffer in order to keep memory consumption moderate.
+    with open(manifest_file, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.write(json.dumps(header) + "\n")
+
+        for batch in itertools.batched(FILE_TABLE.iter_files(), HASH_BATCH_SIZE):
+            STAT_BY_FILE.update(batch)
+
+            hashes_by_stage = {}
+            for stage in stages:
+                requests = [(file_name, get_stage_kind(stage, stat.size), get_stage_ranges(stage, stat.size))
+                            for file_name, stat in batch if stage == "prefix" or get_stage_ranges("prefix", stat.size)]
+                hashes_by_stage[stage] = dict(zip((file_name for file_name, kind, ranges in requests),
+                                                  get_file_hashes(requests)))
+
+            for file_name, stat in batch:
+                record = {"path": file_name, "size": stat.size, "dev": stat.dev, "ino": stat.ino,
+                          "mtime_ns": stat.mtime_ns, "blocks": stat.blocks,
+                          "prefix": hashes_by_stage["prefix"][file_name].hex()}
+                full_hash = hashes_by_stage.get("full", {}).get(file_name)
+                if full_hash or not get_stage_ranges("prefix", stat.size):
+                    record["full"] = full_hash.hex() if full_hash else record["prefix"]
+
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            file_count += len(batch)
+            STAT_BY_FILE.clear()
+
+    print_verbose1(f"Wrote {file_count} files to manifest {manifest_file}")
+
+
+def read_manifests(manifest_files: list[str]) -> dict[tuple[str, str], dict[str, Any]]:
+    """
+    Reads manifests written by write_manifest(). All manifests must be written with the same --hash and --prefix-size
+    arguments. Records of the same file in several manifests are merged, so that full hashes calculated later for
+    the same file contents are added to the records of the earlier manifests. Exits the process on invalid manifest.
 
-    :param file1: A file to compare
-    :param file2: The other file to compare
-    :return: true if the files are binary equal
+    :param manifest_files: Manifest file names
+    :return: dict: (host, file name) -> manifest record
     """
-    print_verbose1("Binary comparing " + file1 + " vs " + file2 + ": ", end='')
+    records = {}
+    hash_params = None
 
-    buffer_size = max(INTERNAL_FILE_BUFFER_SIZE, get_cluster_size(file1), get_cluster_size(file2))
+    for manifest_file in manifest_files:
+        with open(manifest_file, encoding="utf-8", errors="surrogateescape") as f:
+            try:
+                header = json.loads(f.readline() or "{}")
+            except json.JSONDecodeError:
+                header = {}
 
-    with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
-        offset = 0
+            if header.get("format") != MANIFEST_FORMAT or not 1 <= header.get("version", 0) <= MANIFEST_VERSION:
+                print(f"ERROR: {manifest_file} is not a manifest of version {MANIFEST_VERSION} or older")
+                exit(1)
 
-        while True:
-            buffer1 = f1.read(buffer_size)
-            buffer2 = f2.read(buffer_size)
+            if hash_params and hash_params != (header["hash"], header["prefix_size"]):
+                print(f"ERROR: {manifest_file} is written with --hash={header['hash']} and "
+                      f"--prefix-size={header['prefix_size']}, which differ from the previous manifests")
+                exit(1)
 
-            if not buffer1 and not buffer2:
-                print_verbose1("identical")
-                return True
+            hash_params = (header["hash"], header["prefix_size"])
+            host = header["host"]
 
-            if buffer1 != buffer2:
-                for i in range(min(len(buffer1), len(buffer2))):
-                    if buffer1[i] != buffer2[i]:
-                        print_verbose1(f"difference found at offset {offset + i}")
-                        return False
+            for line in f:
+                record = json.loads(line)
+                previous_record = records.get((host, record["path"]))
+                if (previous_record and "full" not in record and "full" in previous_record and
+                        (previous_record["size"], previous_record["mtime_ns"]) == (record["size"], record["mtime_ns"])):
+                    record["full"] = previous_record["full"]
+                records[(host, record["path"])] = record
 
-            offset += buffer_size
+        print_verbose1(f"Read manifest {manifest_file} of host {host}")
 
+    return records
 
-def execute_command_on_identical_files(group_hash: str, group: list[str]) -> None:
+
+def merge_manifests(manifest_files: list[str]) -> None:
+    """
+    Finds duplicates among the files in manifests written on one or several hosts (see --merge argument).
+    Files are grouped by size and prefix hash, hard links are collapsed into one file per host and inode.
+    If all files of a group have full hashes, duplicates are reported the same way as by find_duplicates(), with
+    "host:" prefix before file names. Otherwise, the files lacking full hashes are saved into per-host lists in
+    --request-dir directory, so that each host hashes only these files, writing another manifest to be merged
+    together with the first ones.
+
+    :param manifest_files: Manifest file names
     """
-    If user gave --exec argument, executes the given command with quotes space-separated file names as arguments.
-    Return code if the command is ignored. Input and output/error are passed through.
-    File names are sorted alphabetically.
+    file_by_prefix = {}
+    for (host, file_name), record in read_manifests(manifest_files).items():
+        file_by_prefix.setdefault((record["size"], record["prefix"]), []).append((host, file_name, record))
 
-    :param group_hash: Hash string for this group of files
-    :param group: File names to give to the command
+    total_wasted_disk_space = 0
+    total_duplicates = 0
+    cross_host_groups = 0
+    requests_by_host = {}
+
+    for (size, prefix_hash), files in sorted(file_by_prefix.items()):
+        file_by_inode = {}
+        for host, file_name, record in sorted(files, key=lambda file: file[:2]):
+            file_by_inode.setdefault((host, record["dev"], record["ino"]), (host, file_name, record))
+        if len(file_by_inode) < 2:
+            continue
+
+        files = list(file_by_inode.values())
+        missing_files = [(host, file_name) for host, file_name, record in files if "full" not in record]
+        if missing_files:
+            for host, file_name in missing_files:
+                requests_by_host.setdefault(host, []).append(file_name)
+            continue
+
+        file_by_full_hash = {}
+        for host, file_name, record in files:
+            file_by_full_hash.setdefault(record["full"], []).append((host, file_name, record))
+
+        for group in file_by_full_hash.values():
+            if len(group) < 2:
+                continue
+
+            wasted_disk_space = sum(record["blocks"] * 512 if record["blocks"] >= 0 else size
+                                    for host, file_name, record in group[1:])
+            print_normal(f"Duplicates ({size} bytes each, wasted {humanize.naturalsize(wasted_disk_space)}):\n"
+                         f"    {'\n    '.join(f'{host}:{file_name}' for host, file_name, record in group)}")
+
+            total_wasted_disk_space += wasted_disk_space
+            total_duplicates += len(group) - 1
+            if len({host for host, file_name, record in group}) > 1:
+                cross_host_groups += 1
+
+    print_summary(f"Total wasted disk space in {str(total_duplicates)} files: "
+                  f"{humanize.naturalsize(total_wasted_disk_space)}")
+    print_summary(f"Duplicate groups spanning several hosts: {cross_host_groups}")
+
+    if requests_by_host:
+        request_count = sum(map(len, requests_by_host.values()))
+        if ARGS.request_dir:
+            os.makedirs(ARGS.request_dir, exist_ok=True)
+            for host, file_names in requests_by_host.items():
+                with open(os.path.join(ARGS.request_dir, host.replace(os.sep, "_") + ".paths"), "w",
+                          encoding="utf-8", errors="surrogateescape") as f:
+                    f.writelines(file_name + "\n" for file_name in file_names)
+
+        print_summary(f"Full hashes are needed for {request_count} files on {len(requests_by_host)} hosts"
+                      + (f", lists of files are saved in {ARGS.request_dir}" if ARGS.request_dir else
+                         ", use --request-dir to save lists of files"))
+
+
+def open_index(index_file: str, create: bool) -> sqlite3.Connection:
+    """
+    Opens the reference index database (see --build-index and --against arguments). The index keeps size, prefix
+    hash and (once calculated) full hash of each indexed file, looked up by size and prefix hash.
+    Hash engine and prefix size are stored in the index when it is created, and are used instead of --hash and
+    --prefix-size arguments afterwards. Exits the process if the index cannot be opened.
+
+    :param index_file: SQLite database file name
+    :param create: Create the index if it does not exist
+    :return: Index database
     """
-    if ARGS.exec:
-        hash_arg = group_hash + ' ' if ARGS.exec_hash_arg else ''
-        cmdline = f"{ARGS.exec} {hash_arg}\"{'\" \"'.join(group)}\""
-        print_verbose2(f"Executing '{cmdline}'")
-        os.system(cmdline)
+    if not create and not os.path.isfile(index_file):
+        print(f"ERROR: index {index_file} does not exist")
+        exit(1)
+
+    try:
+        db = sqlite3.connect(index_file)
+        db.execute("CREATE TABLE IF NOT EXISTS index_info (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS indexed_file ("
+                   "path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                   "prefix_hash BLOB NOT NULL, full_hash BLOB)")
+        db.execute("CREATE INDEX IF NOT EXISTS indexed_file_hash ON indexed_file (size, prefix_hash)")
+        index_info = dict(db.execute("SELECT name, value FROM index_info"))
+
+    except sqlite3.Error as ex:
+        print(f"ERROR: cannot open index {index_file}: {ex}")
+        exit(1)
+
+    if not index_info:
+        db.executemany("INSERT INTO index_info (name, value) VALUES (?, ?)",
+                       [("version", str(INDEX_VERSION)), ("hash", ARGS.hash), ("prefix_size", str(ARGS.prefix_size))])
+
+    elif int(index_info["version"]) > INDEX_VERSION:
+        print(f"ERROR: index {index_file} has version {index_info['version']}, but only {INDEX_VERSION} "
+              f"or older is supported")
+        exit(1)
+
+    elif (ARGS.hash, ARGS.prefix_size) != (index_info["hash"], int(index_info["prefix_size"])):
+        print_verbose1(f"INFO: using --hash={index_info['hash']} and --prefix-size={index_info['prefix_size']} "
+                       f"of index {index_file}")
+        ARGS.hash = index_info["hash"]
+        ARGS.prefix_size = int(index_info["prefix_size"])
 
+    print_verbose1(f"Using index {index_file}")
+    return db
 
-def round_file_size(file_name: str, file_size: int) -> int:
+
+def build_index(index: sqlite3.Connection) -> None:
     """
-    Rounds file size up to cluster size for a given name. If no cluster size information available, returns
-    file_size.
+    Adds all found files with their prefix hashes into the reference index (see --build-index argument), replacing
+    the entries of the same files. Full hashes are calculated only for the files not longer than --prefix-size,
+    since they are the same as prefix hashes. Other full hashes are calculated later, when a queried file has the same
+    size and prefix hash as an indexed file (see query_index()). Files are stored with absolute paths.
 
-    :param file_name: File name
-    :param file_size: File size to round
-    :return: Rounded or original file size
+    :param index: Index database, see open_index()
     """
-    cluster_size = get_cluster_size(file_name)
-    return math.ceil(file_size / cluster_size) * cluster_size if cluster_size else file_size
+    file_count = 0
+    for batch in itertools.batched(FILE_TABLE.iter_files(), HASH_BATCH_SIZE):
+        STAT_BY_FILE.update(batch)
 
+        prefix_hashes = get_file_hashes([(file_name, get_stage_kind("prefix", stat.size),
+                                          get_stage_ranges("prefix", stat.size)) for file_name, stat in batch])
+        index.executemany("INSERT OR REPLACE INTO indexed_file (path, size, mtime_ns, prefix_hash, full_hash) "
+                          "VALUES (?, ?, ?, ?, ?)",
+                          [(os.fsencode(os.path.abspath(file_name)), stat.size, stat.mtime_ns, prefix_hash,
+                            None if get_stage_ranges("prefix", stat.size) else prefix_hash)
+                           for (file_name, stat), prefix_hash in zip(batch, prefix_hashes)])
 
-def get_cluster_size(file_name: str) -> [int, None]:
-    """
-    Tries to find cluster size for a given file. Cluster sizes are stored per path given in the arguments.
-    If the cluster size cannot be found, returns None.
+        file_count += len(batch)
+        STAT_BY_FILE.clear()
 
-    :param file_name: File name to search for the cluster size
-    :return: None or cluster size
+    print_summary(f"Indexed {file_count} files")
+
+
+def query_index(index: sqlite3.Connection) -> None:
     """
-    for path, cluster_size in CLUSTER_SIZE_BY_PATH.items():
-        if file_name.startswith(path):
-            return cluster_size
+    Reports which found files already exist in the reference index (see --against argument). Only the found files
+    are hashed: prefix hash if there are indexed files of the same size, and full hash if there are indexed files
+    with the same size and prefix hash. Full hashes of these indexed files are calculated on demand and saved
+    into the index (see get_indexed_full_hash()). So the time depends on the number of found files rather than
+    the size of the index. A found file is not compared with its own index entry, so the queried directories
+    may overlap with the indexed ones.
+
+    :param index: Index database, see open_index()
+    """
+    total_file_count = 0
+    existing_file_count = 0
+    existing_size = 0
+
+    for batch in itertools.batched(FILE_TABLE.iter_files(), HASH_BATCH_SIZE):
+        total_file_count += len(batch)
+        paths = {file_name: os.fsencode(os.path.abspath(file_name)) for file_name, stat in batch}
+        candidates = [(file_name, stat) for file_name, stat in batch
+                      if index.execute("SELECT 1 FROM indexed_file WHERE size = ? AND path != ? LIMIT 1",
+                                       (stat.size, paths[file_name])).fetchone()]
+        STAT_BY_FILE.update(candidates)
+
+        prefix_hashes = get_file_hashes([(file_name, get_stage_kind("prefix", stat.size),
+                                          get_stage_ranges("prefix", stat.size)) for file_name, stat in candidates])
+        indexed_files_by_file = {}
+        for (file_name, stat), prefix_hash in zip(candidates, prefix_hashes):
+            indexed_files = index.execute("SELECT path, mtime_ns, full_hash FROM indexed_file "
+                                          "WHERE size = ? AND prefix_hash = ? AND path != ? ORDER BY path",
+                                          (stat.size, prefix_hash, paths[file_name])).fetchall()
+            if indexed_files:
+                indexed_files_by_file[file_name] = indexed_files
+
+        full_requests = [(file_name, get_stage_kind("full", STAT_BY_FILE[file_name].size), None)
+                         for file_name in indexed_files_by_file
+                         if get_stage_ranges("prefix", STAT_BY_FILE[file_name].size)]
+        full_hashes = dict(zip((file_name for file_name, kind, ranges in full_requests),
+                               get_file_hashes(full_requests)))
+
+        for file_name, indexed_files in indexed_files_by_file.items():
+            size = STAT_BY_FILE[file_name].size
+            full_hash = full_hashes.get(file_name)
+            existing_files = [os.fsdecode(path) for path, mtime_ns, indexed_full_hash in indexed_files
+                              if full_hash is None or full_hash == (indexed_full_hash or
+                                                                    get_indexed_full_hash(index, path, size, mtime_ns))]
+            if not existing_files:
+                continue
+
+            print_normal(f"Already in index ({size} bytes each):\n    {file_name}\n    {'\n    '.join(existing_files)}")
+            existing_file_count += 1
+            existing_size += size
+
+        STAT_BY_FILE.clear()
+
+    print_summary(f"Files already in index: {existing_file_count} of {total_file_count} "
+                  f"({humanize.naturalsize(existing_size)})")
+
+
+def get_indexed_full_hash(index: sqlite3.Connection, path: bytes, size: int, mtime_ns: int) -> bytes | None:
+    """
+    Calculates full hash of an indexed file and saves it into the index. If the file has been changed or deleted
+    since it was indexed, it is removed from the index.
+
+    :param index: Index database, see open_index()
+    :param path: Indexed file path
+    :param size: Indexed file size
+    :param mtime_ns: Indexed file modification time
+    :return: Full hash or None if the file has been changed or cannot be read
+    """
+    file_name = os.fsdecode(path)
+    try:
+        stat = os.stat(file_name)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            print_verbose1(f"INFO: {file_name} has been changed since indexed, removing it from the index")
+            index.execute("DELETE FROM indexed_file WHERE path = ?", (path,))
+            return None
 
-    return None
+        full_hash = calc_file_hash(file_name)
+
+    except OSError as ex:
+        print_verbose1(f"INFO: cannot hash indexed file {file_name}: {ex.strerror}")
+        return None
+
+    index.execute("UPDATE indexed_file SET full_hash = ? WHERE path = ?", (full_hash, path))
+    return full_hash
 
 
-def print_normal(*args, **kwargs) -> None:
+def print_normal(message: str, *args) -> None:
     """
-    Prints normal line, if no quiet argument given to the program. See print() for arguments.
+    Prints normal line, if no quiet argument given to the program. See print_line() for arguments.
     """
     if not ARGS.quiet:
-        print(*args, **kwargs)
+        print_line(message, args)
 
 
-def print_verbose1(*args, **kwargs) -> None:
+def print_verbose1(message: str, *args) -> None:
     """
-    Prints verbose line if verbosity level 1 is enabled in program arguments. See print() for arguments.
+    Prints verbose line if verbosity level 1 is enabled in program arguments. See print_line() for arguments.
     """
     if not ARGS.quiet and ARGS.verbose >= 1:
-        print(*args, **kwargs)
+        print_line(message, args)
 
 
-def print_verbose2(*args, **kwargs) -> None:
+def print_verbose2(message: str, *args) -> None:
     """
-    Prints verbose line if verbosity level 2 is enabled in program arguments. See print() for arguments.
+    Prints verbose line if verbosity level 2 is enabled in program arguments. See print_line() for arguments.
     """
     if not ARGS.quiet and ARGS.verbose >= 2:
-        print(*args, **kwargs)
+        print_line(message, args)
 
 
-def print_verbose3(*args, **kwargs) -> None:
+def print_verbose3(message: str, *args) -> None:
     """
-    Prints verbose line if verbosity level 3 is enabled in program arguments. See print() for arguments.
+    Prints verbose line if verbosity level 3 is enabled in program arguments. See print_line() for arguments.
     """
     if not ARGS.quiet and ARGS.verbose >= 3:
-        print(*args, **kwargs)
+        print_line(message, args)
 
 
-def print_summary(*args, **kwargs) -> None:
+def print_summary(message: str, *args) -> None:
     """
-    Prints summary if summary printing is enabled in program arguments. See print() for arguments.
+    Prints summary if summary printing is enabled in program arguments. See print_line() for arguments.
     """
     if not ARGS.quiet and not ARGS.no_summary:
-        print(*args, **kwargs)
+        print_line(message, args)
+
+
+def is_verbose(level: int) -> bool:
+    """
+    Checks if the given verbosity level is enabled, to skip preparing arguments of print_verbose*() calls
+    which are expensive to calculate.
+
+    :param level: Verbosity level
+    :return: True if print_verbose<level>() prints anything
+    """
+    return not ARGS.quiet and ARGS.verbose >= level
+
+
+def print_line(message: str, args: tuple) -> None:
+    """
+    Prints a line to stdout. The message is formatted with % operator only when it is printed, like in logging
+    module, so that frequent calls with disabled verbosity level cost nothing but a check of the level.
+    If a progress line is shown on the same terminal (see --progress), it is erased first.
+
+    :param message: Message, or format string if args are given
+    :param args: Arguments for the format string
+    """
+    if PROGRESS["shown"]:
+        clear_progress()
+
+    sys.stdout.write((message % args if args else message) + "\n")
+
+
+def report_progress(final: bool = False) -> None:
+    """
+    Updates the progress line on stderr (see --progress argument): number and size of the scanned files, bytes hashed
+    out of bytes to hash, hashing speed and estimated time left. Called for each file, but updates the line no more
+    often than once in PROGRESS_INTERVAL seconds.
+
+    :param final: Update the line regardless of the time since the last update, and finish it
+    """
+    now = time.monotonic()
+    if now < PROGRESS["next_time"] and not final or not PROGRESS_LOCK.acquire(blocking=False):
+        return
+
+    try:
+        PROGRESS["next_time"] = now + PROGRESS_INTERVAL
+        line = f"Scanned {PROGRESS['files_scanned']} files ({humanize.naturalsize(PROGRESS['bytes_scanned'])})"
+        if PROGRESS["bytes_to_hash"]:
+            speed = PROGRESS["bytes_hashed"] / max(now - PROGRESS["hash_start_time"], 1e-9)
+            eta = (PROGRESS["bytes_to_hash"] - PROGRESS["bytes_hashed"]) / speed if speed else 0
+            line += (f", hashed {humanize.naturalsize(PROGRESS['bytes_hashed'])} of "
+                     f"{humanize.naturalsize(PROGRESS['bytes_to_hash'])} ({humanize.naturalsize(speed)}/s, "
+                     f"ETA {datetime.timedelta(seconds=round(eta))})")
+
+        if sys.stderr.isatty():
+            sys.stderr.write(f"\r{line}\033[K" + ("\n" if final else ""))
+            PROGRESS["shown"] = not final
+        else:
+            sys.stderr.write(line + "\n")
+        sys.stderr.flush()
+
+    finally:
+        PROGRESS_LOCK.release()
+
+
+def clear_progress() -> None:
+    """
+    Erases the progress line from the terminal, so that it is not mixed with normal output. The line is shown again
+    on the next update.
+    """
+    sys.stderr.write("\r\033[K")
+    sys.stderr.flush()
+    PROGRESS["shown"] = False
 
 
 def fs_cluster_size(path: str) -> int:
@@ -445,8 +3501,6 @@ def fs_cluster_size(path: str) -> int:
     :return: Cluster size in bytes
     """
     if platform.system() == "Windows":
-        import ctypes
-
         sectors_per_cluster = ctypes.c_ulonglong(0)
         bytes_per_sector = ctypes.c_ulonglong(0)
         free_clusters = ctypes.c_ulonglong(0)
@@ -490,22 +3544,174 @@ def process_args() -> argparse.Namespace:
     p.add_argument('-d', '--paranoid', action='store_true', default=False, help=
         "don't trust those hashes. Compare files byte-by-byte in a hardcode way, if size and hashes match. "
         "Can significantly increase execution time")
-    p.add_argument('-e', '--exec', help=
-        "execute a command for each group of identical files")
+    p.add_argument('--max-open-files', default=256, type=int, help=
+        "maximum number of files kept open simultaneously by --paranoid comparison, and of temporary run files "
+        "of --memory-limit. Default is %(default)s")
+    p.add_argument('-H', '--hard-links', action='store_true', help=
+        "print sets of hard links to the same file. Hard links are never reported as duplicates and do not "
+        "count as wasted space")
+    p.add_argument('-e', '--exec', type=parse_command, help=
+        "execute a command for each group of identical files, with the file names as arguments. The command is split "
+        "into arguments like in shell, but run without shell: use e.g. -e \"sh -c 'ls -l \\\"$@\\\"' sh\" "
+        "for shell features")
     p.add_argument('-a', '--exec-hash-arg', action='store_true', help=
         "include hash as the first argument in -e command (useless without -e)")
+    p.add_argument('--action', choices=['hardlink', 'reflink', 'delete'], help=
+        "for each group of identical files, keep the alphabetically first file and replace the others with hard links "
+        "to it, with copy-on-write clones of it (btrfs, XFS), or delete them. Files changed since they were compared "
+        "are skipped. Default is no action")
+    p.add_argument('-n', '--dry-run', action='store_true', help=
+        "only print what --action would do")
+    p.add_argument('--exec-batch', default=0, type=int, metavar='GROUPS', help=
+        "give up to GROUPS groups to one -e command on its stdin instead of arguments, as records of NUL-terminated "
+        "fields: the hash (with -a), the file names and an empty field. 0 starts a command per group. "
+        "Default is %(default)s")
+    p.add_argument('--exec-jobs', default=1, type=int, help=
+        "number of -e commands running at once, while searching for duplicates continues. With 1, each command "
+        "finishes before the search continues. Output of parallel commands may interleave. Default is %(default)s")
     p.add_argument('-m', '--min-file-size', default=4, type=int, help=
         'minimum file size to include into analysis. Default is %(default)s bytes')
+    p.add_argument('-M', '--max-file-size', type=int, help=
+        'maximum file size to include into analysis. Default is no limit')
+    p.add_argument('--modified-after', metavar='DATETIME', type=parse_datetime, help=
+        'include only files modified after the given date and time, in ISO 8601 format, e.g. 2025-01-31T12:00')
+    p.add_argument('--modified-before', metavar='DATETIME', type=parse_datetime, help=
+        'include only files modified before the given date and time, in ISO 8601 format')
     p.add_argument('-p', '--prefix-size', default=1024, type=int, help=
         'size of prefix in prefix comparison: if checksums of the prefix are different, the complete file comparison '
         'is skipped. Default is %(default)s bytes')
+    p.add_argument('-j', '--jobs', default=1, type=int, help=
+        "number of files to hash in parallel. Default is %(default)s")
+    p.add_argument('--jobs-backend', choices=("thread", "process"), default="thread", help=
+        "run parallel hashing in threads or in processes. Processes may be faster if hashing is CPU-bound. "
+        "Default is %(default)s")
+    p.add_argument('--device-jobs', default=0, type=int, help=
+        "maximum number of files to read simultaneously from the same device, e.g. 1 or 2 for spinning disks. "
+        "Default is the same as --jobs")
+    p.add_argument('--pipeline', action='store_true', help=
+        "start hashing while the scan is still running: as soon as a second file of some size is found, files of "
+        "this size are hashed for the first stage (see --stages), so that slow disks do not sit idle during the scan")
+    p.add_argument('--buffer-memory', default=64 * 1024 * 1024, type=int, help=
+        "total size of file read buffers of all parallel jobs, and of all files compared at once with --paranoid "
+        "(at least 64 KiB per file). Default is %(default)s bytes")
+    p.add_argument('--memory-limit', default=0, type=int, help=
+        "approximate memory limit for the list of found files and candidates, in bytes. Over this limit, found "
+        "files are spilled to temporary run files (in $TMPDIR, at least 4 MiB of files each) and merged back when "
+        "grouped by size, and candidates are compared in batches of size groups. Hashes of the files being compared "
+        "and a group of files of the same size larger than the limit are still kept in memory. 0 means no limit. "
+        "Default is %(default)s")
+    p.add_argument('--suffix-size', default=1024, type=int, help=
+        'size of suffix in suffix comparison stage (see --stages). Default is %(default)s bytes')
+    p.add_argument('--sample-count', default=8, type=int, help=
+        'number of blocks evenly spread over the file in sampled blocks comparison stage (see --stages). '
+        'Default is %(default)s')
+    p.add_argument('--sample-size', default=4096, type=int, help=
+        'size of each block in sampled blocks comparison stage (see --stages). Default is %(default)s bytes')
+    p.add_argument('-s', '--stages', default="prefix,full", type=parse_stages, help=
+        "comma-separated list of comparison stages, each one hashing only files which are still identical after "
+        "the previous stage: prefix (see --prefix-size), suffix (see --suffix-size), samples (see --sample-count "
+        "and --sample-size), full. The last stage must be full. Default is %(default)s")
+    p.add_argument('--io-method', choices=("read", "readinto", "mmap"), default="read", help=
+        "how to read files: read (allocate new memory for each block), readinto (reuse preallocated buffers) or "
+        "mmap (map files into memory; binary comparison with --paranoid uses readinto). Default is %(default)s")
+    p.add_argument('--io-order', choices=("none", "inode", "physical"), default="none", help=
+        "order of reading files of the same device: none (as found), inode (by inode number) or physical (by "
+        "physical location of data on disk, found with FIEMAP on Linux, falling back to inode number). Ordered "
+        "reads reduce seeks on spinning disks. Default is %(default)s")
+    p.add_argument('--read-policy', choices=("normal", "fadvise", "direct"), default="normal", help=
+        "how hashing uses the page cache: normal, fadvise (hint sequential access, prefetch the next file to hash "
+        "and drop hashed files from the page cache, so that hashing does not evict data of other programs; not "
+        "available on macOS and Windows, where normal reads are used) or "
+        "direct (read with O_DIRECT bypassing the page cache, Linux only; falls back to normal reads where not "
+        "supported). Default is %(default)s")
+    p.add_argument('--io-stats', action='store_true', help=
+        "print how many bytes were read from files, and how many of them came from disk and from page cache "
+        "(Linux only)")
+    p.add_argument('--hash', choices=list(HASH_ENGINES) + ["auto"], default="crc32+mmh3", help=
+        "hash algorithm: crc32+mmh3 (CRC32 and 32-bit MurmurHash3), mmh3-128 (128-bit MurmurHash3), blake2b "
+        "(128-bit BLAKE2b), xxh3-128 (only if xxhash package is installed) or auto (the fastest one on this CPU, "
+        "see --hash-benchmark). Default is %(default)s")
+    p.add_argument('--hash-benchmark', action='store_true', help=
+        "measure the speed of all hash algorithms on this CPU and exit")
     p.add_argument('-i', '--paths', dest='paths_file',
         type=argparse.FileType('r'), help=
         "read directory names from a file or the standard input, if '-' is given. ")
+    p.add_argument('-L', '--follow-symlinks', action='store_true', help=
+        "follow symbolic links to files and directories. By default symbolic links are skipped")
     p.add_argument('-x', '--exclude', action='append', help=
-        "exclude files based on glob pattern(s). You can pass multiple -x arguments")
+        "exclude files based on glob pattern(s). You can pass multiple -x arguments. Directories are not scanned "
+        "if a pattern ending with * excludes everything inside them, e.g. '*/build/*'")
     p.add_argument('-X', '--exclude-re', action='append', help=
         "exclude files based on regexp(s). You can pass multiple -X arguments")
+    p.add_argument('-c', '--cache', metavar='CACHE_FILE', help=
+        "keep file hashes in a persistent cache file between runs. Files are identified by device and inode "
+        "numbers; cached hashes are discarded when file size or modification time changes")
+    p.add_argument('--cache-max-entries', default=1000000, type=int, help=
+        "maximum number of hashes to keep in the cache file, least recently used are evicted. "
+        "Default is %(default)s")
+    p.add_argument('--cache-stats', action='store_true', help=
+        "print hash cache hits, misses and the amount of data which was not read thanks to the cache")
+    p.add_argument('-I', '--include', action='append', help=
+        "include only files matching glob pattern(s). You can pass multiple -I arguments")
+    p.add_argument('--exclude-dir', action='append', help=
+        "don't scan directories with names matching glob pattern(s), e.g. .git. You can pass multiple "
+        "--exclude-dir arguments")
+    p.add_argument('--write-manifest', metavar='MANIFEST_FILE', help=
+        "instead of finding duplicates, write all found files with their sizes, inodes and prefix hashes into "
+        "a manifest file, which can be merged with manifests of other hosts with --merge")
+    p.add_argument('--manifest-full-hashes', action='store_true', help=
+        "write full hashes into the manifest too (see --write-manifest). Use this with a list of files "
+        "requested by --merge (see --request-dir) given in --paths")
+    p.add_argument('--host', default=platform.node(), help=
+        "host name written into the manifest (see --write-manifest). Default is %(default)s")
+    p.add_argument('--merge', metavar='MANIFEST_FILE', action='append', help=
+        "instead of scanning paths, find duplicates among the files in the manifests written on one or several hosts "
+        "(see --write-manifest). Can be given multiple times")
+    p.add_argument('--request-dir', help=
+        "directory to save lists of files which need full hashes to find duplicates with --merge, one list per host "
+        "(<host>.paths). Each host then writes another manifest for its list with --manifest-full-hashes, "
+        "and all manifests are merged again")
+    p.add_argument('--build-index', metavar='INDEX_FILE', help=
+        "instead of finding duplicates, add all found files into a reference index (SQLite database), so that other "
+        "files can be checked against it later with --against")
+    p.add_argument('--against', metavar='INDEX_FILE', help=
+        "instead of finding duplicates, report which found files already exist among the files of the reference "
+        "index (see --build-index). Files in the index are read only if their size and prefix hash match")
+    p.add_argument('--chunks', action='store_true', help=
+        "after finding identical files, split files of at least --chunk-size bytes into content-defined chunks and "
+        "report pairs of files sharing chunks, and the space block-level deduplication would save. Reads all these "
+        "files entirely, much faster with NumPy installed. Unreadable files are skipped")
+    p.add_argument('--chunk-size', default=65536, type=parse_chunk_size, help=
+        "normal size of --chunks chunks, a power of two between 1 KiB and 64 MiB. Chunks are 1/4 to 8 times this "
+        "size. Default is %(default)s")
+    p.add_argument('--chunk-max-files', default=16, type=int, help=
+        "chunks found in more than this number of files, like common headers or zero-filled blocks, are counted as "
+        "deduplicable space by --chunks, but do not make pairs of files sharing chunks. Default is %(default)s")
+    p.add_argument('--chunk-max-size-ratio', default=2.0, type=float, help=
+        "split a file into --chunks chunks only if another such file is at most this many times larger or smaller, "
+        "so that files of outstanding size are not read; their chunks are not counted as deduplicable space "
+        "either. 0 to split all files. Default is %(default)s")
+    p.add_argument('--chunk-max-pairs', default=100, type=int, help=
+        "maximum number of pairs of files sharing chunks printed by --chunks, 0 for no limit. Default is %(default)s")
+    p.add_argument('--archives', action='store_true', help=
+        "also look inside zip and tar archives (" + ", ".join(ARCHIVE_EXTENSIONS) + "): their members are compared "
+        "as virtual files named <archive>!<member>, without extracting them. Members are never cached, acted on by "
+        "--action, or counted as wasted space")
+    p.add_argument('-w', '--watch', action='store_true', help=
+        "after finding duplicates, keep watching the directories with inotify (Linux) and report duplicates of "
+        "created, modified and moved files as they appear, until interrupted. Only the changed files are hashed. "
+        "Keeps all scanned files in memory")
+    p.add_argument('--watch-delay', default=1.0, type=float, metavar='SECONDS', help=
+        "time to collect more changes after the first one, before hashing. Default is %(default)s")
+    p.add_argument('--progress', action='store_true', help=
+        "show progress on stderr: files scanned, bytes hashed, hashing speed and estimated time left. The progress "
+        "line is updated once a second")
+    p.add_argument('--stats', nargs='?', const='text', choices=("text", "json"), help=
+        "print time, CPU time, number of files in and out and bytes read per each stage of the run, and the largest "
+        "duplicate groups, as text or as a JSON object (--stats=json, printed even with --quiet)")
+    p.add_argument('--profile', metavar='PROFILE_FILE', help=
+        "run under cProfile and save the profile into a file, see python3 -m pstats. Only the main thread is profiled, "
+        "so use --jobs=1 to profile hashing")
     p.add_argument('-V', '--version', action='version',
        version="%(prog)s " + PROG_VERSION + ". " + COPYRIGHT)
 
@@ -523,15 +3729,90 @@ def process_args() -> argparse.Namespace:
 
     args = p.parse_args()
 
-    if not args.paths_file and len(args.paths) == 0:
+    if args.hash_benchmark:
+        for name, speed in benchmark_hash_engines().items():
+            print(f"{name}: {humanize.naturalsize(speed)}/s")
+        exit(0)
+
+    if not args.paths_file and len(args.paths) == 0 and not args.merge:
         p.print_help()
         exit(1)
 
+    # verify_arguments() prints through print_verbose*(), which rely on the global arguments
+    global ARGS
+    ARGS = args
     verify_arguments(args)
 
     return args
 
 
+def parse_command(value: str) -> list[str]:
+    """
+    Parses --exec argument into command arguments, like shell does, but without variable expansion etc.
+
+    :param value: Command line
+    :return: Command and its arguments
+    """
+    try:
+        argv = shlex.split(value)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+    if not argv:
+        raise argparse.ArgumentTypeError("empty command")
+
+    return argv
+
+
+def parse_chunk_size(value: str) -> int:
+    """
+    Parses and validates --chunk-size argument.
+
+    :param value: Chunk size in bytes
+    :return: Chunk size
+    """
+    chunk_size = int(value)
+    if chunk_size & (chunk_size - 1) or not 1024 <= chunk_size <= 64 * 1024 * 1024:
+        raise argparse.ArgumentTypeError("chunk size must be a power of two between 1024 and 67108864")
+
+    return chunk_size
+
+
+def parse_datetime(value: str) -> int:
+    """
+    Parses date and time arguments in ISO 8601 format. Local time zone is used if none is given.
+
+    :param value: Date and time
+    :return: Time in nanoseconds since the epoch, to compare with st_mtime_ns
+    """
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp() * 1e9)
+    except ValueError as ex:
+        raise argparse.ArgumentTypeError(str(ex))
+
+
+def parse_stages(value: str) -> list[str]:
+    """
+    Parses and validates --stages argument.
+
+    :param value: Comma-separated list of stage names
+    :return: List of stage names
+    """
+    stages = [stage.strip() for stage in value.split(",")]
+
+    for stage in stages:
+        if stage not in FINGERPRINT_STAGES:
+            raise argparse.ArgumentTypeError(f"unknown stage '{stage}', choose from {', '.join(FINGERPRINT_STAGES)}")
+
+    if len(set(stages)) != len(stages):
+        raise argparse.ArgumentTypeError("each stage can be given only once")
+
+    if stages[-1] != "full":
+        raise argparse.ArgumentTypeError("the last stage must be full")
+
+    return stages
+
+
 def verify_arguments(args: argparse.Namespace) -> None:
     """
     Verifies parsed program arguments and prints warnings if needed
@@ -547,8 +3828,46 @@ def verify_arguments(args: argparse.Namespace) -> None:
     if args.prefix_size <= 0:
         print_verbose1(f"INFO: --prefix-size={args.prefix_size} does not make any sense, but it is up to you")
 
-    if args.exec_hash_arg and not args.exec:
-        print_verbose1("INFO: --exec-hash-arg is given, but will be ignored, since no --exec is provided")
+    if (args.exec_hash_arg or args.exec_batch or args.exec_jobs != 1) and not args.exec:
+        print_verbose1("INFO: --exec-hash-arg, --exec-batch or --exec-jobs is given, but will be ignored, "
+                       "since no --exec is provided")
+
+    if args.watch and (args.write_manifest or args.build_index or args.against):
+        print_verbose1("INFO: --watch is given, but will be ignored, since it only works when finding duplicates")
+        args.watch = False
+
+    if args.chunks and (args.watch or args.write_manifest or args.build_index or args.against):
+        print_verbose1("INFO: --chunks is given, but will be ignored, since it only works when finding duplicates once")
+        args.chunks = False
+
+    if "samples" in args.stages and (args.sample_count < 1 or args.sample_size < 1):
+        print_verbose1(f"INFO: --sample-count={args.sample_count} and --sample-size={args.sample_size} do not make "
+                       "any sense, will skip samples stage")
+        args.stages.remove("samples")
+
+    if args.dry_run and not args.action:
+        print_verbose1("INFO: --dry-run is given, but will be ignored, since no --action is provided")
+
+    if args.action == "reflink" and not fcntl:
+        print_normal("WARNING: --action=reflink is not supported on this platform, all clones will fail")
+
+    if args.read_policy == "fadvise" and not hasattr(os, "posix_fadvise"):
+        print_verbose1("INFO: --read-policy=fadvise is not supported on this platform, will use normal reads")
+        args.read_policy = "normal"
+
+    if args.exec_jobs < 1:
+        print_verbose1(f"INFO: --exec-jobs={args.exec_jobs} does not make any sense, will run commands one by one")
+        args.exec_jobs = 1
+
+    if (args.cache_stats or args.cache_max_entries != 1000000) and not args.cache:
+        print_verbose1("INFO: --cache-stats or --cache-max-entries is given, but will be ignored, "
+                       "since no --cache is provided")
+
+    if args.memory_limit < 0:
+        print_verbose1(f"INFO: --memory-limit={args.memory_limit} does not make any sense, will not limit memory")
+
+    if args.jobs < 1:
+        print_verbose1(f"INFO: --jobs={args.jobs} does not make any sense, will hash files one by one")
 
     if args.paths_file and args.paths:
         print_verbose1("INFO: Directories supplied in both --paths option and as program arguments. Will scan all of them")
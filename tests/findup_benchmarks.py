@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ARGS = argparse.Namespace(findup='../src/python3/findup.py')
+
+""" Format version of the benchmark results file """
+RESULTS_VERSION = 2
+
+""" Benchmarks: name -> findup arguments. Mock hashes make all files of the same size reach the measured stage.
+    A benchmark is skipped if the findup revision under test does not know some of its options """
+BENCHMARKS = {
+    "scan": ["-m", str(2 ** 62)],
+    "prefix_hash": ["-s", "prefix,full", "--mock-full-hash", "0"],
+    "full_hash": ["-s", "full"],
+    "paranoid": ["-d", "--mock-prefix-hash", "0", "--mock-full-hash", "0"],
+}
+
+
+def generate_tree(root: str, scale: int, seed: int) -> dict:
+    """
+    Generates a reproducible synthetic tree of files: the same scale and seed always give the same tree.
+    The tree consists of:
+    - tiny files (scale * 1000 of them) of a few sizes, spread over nested directories, a part of them duplicates,
+    - large files (scale * 4 of them, 4 MiB each) sharing the first 1 MiB, a part of them duplicates,
+    - hard links to some of the large files,
+    - sparse files (scale of them, 64 MiB each) with a few bytes of data,
+    - a chain of 100 nested directories with a duplicate file at the bottom.
+
+    :param root: Directory to create the tree in
+    :param scale: Scale of the tree, 1 gives about 1000 files and 16 MiB of data
+    :param seed: Random generator seed
+    :return: Description of the tree
+    """
+    rng = random.Random(seed)
+    file_count = 0
+
+    tiny_contents = [rng.randbytes(rng.randint(1, 64)) for _ in range(200)]
+    for i in range(scale * 1000):
+        dir_name = os.path.join(root, "tiny", f"d{i % 97:02}", f"d{i % 13:02}")
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, f"f{i}"), "wb") as f:
+            f.write(rng.choice(tiny_contents) if rng.random() < 0.5 else rng.randbytes(rng.randint(1, 64)))
+        file_count += 1
+
+    large_dir = os.path.join(root, "large")
+    os.makedirs(large_dir, exist_ok=True)
+    common_prefix = rng.randbytes(1024 * 1024)
+    large_contents = [common_prefix + rng.randbytes(3 * 1024 * 1024) for _ in range(scale * 2)]
+    for i in range(scale * 4):
+        with open(os.path.join(large_dir, f"large{i}"), "wb") as f:
+            f.write(large_contents[i % len(large_contents)] if i % 2 else
+                    common_prefix + rng.randbytes(3 * 1024 * 1024))
+        file_count += 1
+
+    for i in range(0, scale * 4, 4):
+        os.link(os.path.join(large_dir, f"large{i}"), os.path.join(large_dir, f"link{i}"))
+        file_count += 1
+
+    sparse_dir = os.path.join(root, "sparse")
+    os.makedirs(sparse_dir, exist_ok=True)
+    for i in range(scale):
+        with open(os.path.join(sparse_dir, f"sparse{i}"), "wb") as f:
+            f.truncate(64 * 1024 * 1024)
+            f.seek(rng.randrange(64 * 1024 * 1024))
+            f.write(b"data")
+        file_count += 1
+
+    deep_dir = os.path.join(root, "deep", *(f"n{i}" for i in range(100)))
+    os.makedirs(deep_dir, exist_ok=True)
+    with open(os.path.join(deep_dir, "deep"), "wb") as f:
+        f.write(tiny_contents[0])
+    file_count += 1
+
+    return {"scale": scale, "seed": seed, "files": file_count}
+
+
+def check_findup_args(args: list[str]) -> str | None:
+    """
+    Checks that the findup revision under test accepts the arguments, so that older revisions can be measured too.
+    Runs findup with the arguments over an empty directory, as hidden options are not listed by --help.
+
+    :param args: findup arguments
+    :return: None if the arguments are accepted, the error message of findup otherwise
+    """
+    with tempfile.TemporaryDirectory(prefix="findup-benchmark-") as empty_dir:
+        result = subprocess.run([sys.executable, ARGS.findup, "-q", *args, empty_dir], capture_output=True, text=True)
+    if result.returncode != 2:
+        return None
+
+    return result.stderr.strip().splitlines()[-1].replace(f" {empty_dir}", "")
+
+
+def run_benchmark(name: str, root: str) -> dict:
+    """
+    Runs findup with the benchmark arguments over the tree --repeat times. If findup supports --stats=json, the wall
+    times of the stages are taken from its output, and the best run is the one with the least sum of them, so that
+    interpreter startup does not count. Otherwise, the best run is the one of the least wall time of the process.
+
+    :param name: Benchmark name, see BENCHMARKS
+    :param root: Tree to run findup over
+    :return: Benchmark result: wall time of each run, and the wall time, the sum of stage times and the stage times
+             of the best run, or the reason the benchmark was skipped
+    """
+    args = [*BENCHMARKS[name], *ARGS.findup_args]
+    error = check_findup_args(args)
+    if error:
+        print(f"{name}: skipped, {error}", file=sys.stderr)
+        return {"skipped": error}
+
+    stats_json = not check_findup_args(["--stats=json"])
+    if stats_json:
+        args.append("--stats=json")
+
+    runs = []
+    for _ in range(ARGS.repeat):
+        start_time = time.perf_counter()
+        result = subprocess.run([sys.executable, ARGS.findup, "-q", *args, root], capture_output=True, text=True)
+        wall_time = time.perf_counter() - start_time
+
+        if result.returncode != 0:
+            raise RuntimeError(f"findup failed in benchmark {name}: {result.stderr}")
+
+        stages = {}
+        if stats_json:
+            for stats in json.loads(result.stdout.splitlines()[-1])["stages"]:
+                stages[stats["stage"]] = stats["wall_seconds"]
+        runs.append((sum(stages.values()) if stats_json else wall_time, wall_time, stages))
+
+    best_time, wall_time, stages = min(runs, key=lambda run: run[0])
+    print(f"{name}: {wall_time:.3f} s" + "".join(f", {stage} {seconds:.3f} s" for stage, seconds in stages.items()),
+          file=sys.stderr)
+    result = {"seconds": wall_time, "runs": [run[1] for run in runs]}
+    if stats_json:
+        result.update(stage_seconds=best_time, stages=stages)
+    return result
+
+
+def run_benchmarks() -> dict:
+    """
+    Generates the tree (unless --tree is given) and runs the benchmarks given in --benchmark or all of them.
+
+    :return: Benchmark results with findup version and environment description
+    """
+    version = subprocess.run([sys.executable, ARGS.findup, "-V"], capture_output=True, text=True).stdout.strip()
+    results = {"version": RESULTS_VERSION, "findup": version, "findup_args": ARGS.findup_args,
+               "python": platform.python_version(), "platform": platform.platform(), "benchmarks": {}}
+
+    with tempfile.TemporaryDirectory(prefix="findup-benchmark-") as tmp_dir:
+        root = ARGS.tree or tmp_dir
+        os.makedirs(root, exist_ok=True)
+        if not os.listdir(root):
+            start_time = time.perf_counter()
+            results["tree"] = generate_tree(root, ARGS.scale, ARGS.seed)
+            print(f"Generated {results['tree']['files']} files in {time.perf_counter() - start_time:.1f} s",
+                  file=sys.stderr)
+
+        for name in ARGS.benchmark or BENCHMARKS:
+            results["benchmarks"][name] = run_benchmark(name, root)
+
+    return results
+
+
+def compare_results(old_results_file: str, new_results_file: str) -> bool:
+    """
+    Prints the best times of the benchmarks and of their stages in two result files side by side. The sums of stage
+    times are compared if both files have them, the wall times of the process otherwise. Benchmarks skipped in either
+    file are not compared.
+
+    :param old_results_file: Results of the baseline version
+    :param new_results_file: Results of the new version
+    :return: True if no benchmark got slower by more than --threshold percent
+    """
+    with open(old_results_file) as f:
+        old_results = json.load(f)
+    with open(new_results_file) as f:
+        new_results = json.load(f)
+
+    passed = True
+    print(f"{'benchmark':<24}{'old, s':>10}{'new, s':>10}{'change':>10}")
+    for name, new_result in new_results["benchmarks"].items():
+        old_result = old_results["benchmarks"].get(name, {})
+        if "seconds" not in old_result or "seconds" not in new_result:
+            print(f"{name:<24}{'':>30}  skipped")
+            continue
+
+        key = "stage_seconds" if "stage_seconds" in old_result and "stage_seconds" in new_result else "seconds"
+        change = (new_result[key] / old_result[key] - 1) * 100
+        regression = change > ARGS.threshold
+        passed = passed and not regression
+        print(f"{name:<24}{old_result[key]:>10.3f}{new_result[key]:>10.3f}{change:>+9.1f}%"
+              + ("  REGRESSION" if regression else ""))
+
+        old_stages = old_result.get("stages", {})
+        for stage, seconds in new_result.get("stages", {}).items():
+            if stage in old_stages:
+                change = (seconds / max(old_stages[stage], 1e-9) - 1) * 100
+                print(f"{'  ' + stage:<24}{old_stages[stage]:>10.3f}{seconds:>10.3f}{change:>+9.1f}%")
+
+    return passed
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Generates a synthetic tree of files and measures how long findup "
+                                            "takes to scan it and to hash and compare the files")
+    p.add_argument("-e", "--findup", default='../src/python3/findup.py', help="Path to findup executable. "
+                   "Default is %(default)s")
+    p.add_argument("--scale", default=1, type=int, help="Scale of the generated tree, 1 gives about 1000 files "
+                   "and 16 MiB of data, 1000 gives a million files. Default is %(default)s")
+    p.add_argument("--seed", default=1, type=int, help="Random generator seed. Default is %(default)s")
+    p.add_argument("--tree", help="Directory to keep the generated tree in, so that it can be reused by the next "
+                   "runs. The tree is generated only if the directory is empty or does not exist")
+    p.add_argument("--benchmark", action="append", choices=list(BENCHMARKS), help="Benchmark to run, can be given "
+                   "multiple times. Default is all benchmarks")
+    p.add_argument("--repeat", default=3, type=int, help="Number of runs of each benchmark, the best time is "
+                   "reported. Default is %(default)s")
+    p.add_argument("--findup-args", default=[], type=str.split, help="Extra findup arguments, e.g. \"-j 4\"")
+    p.add_argument("-o", "--output", help="File to write the results to in JSON format. Default is stdout")
+    p.add_argument("--compare", nargs=2, metavar=("OLD_RESULTS", "NEW_RESULTS"), help="Compare two result files "
+                   "instead of running benchmarks")
+    p.add_argument("--threshold", default=10.0, type=float, help="Slowdown in percent reported as regression by "
+                   "--compare. Default is %(default)s")
+
+    global ARGS
+    ARGS = p.parse_args()
+
+
+if __name__ == "__main__":
+    parse_args()
+
+    if ARGS.compare:
+        sys.exit(0 if compare_results(*ARGS.compare) else 1)
+
+    benchmark_results = run_benchmarks()
+    if ARGS.output:
+        with open(ARGS.output, "w") as output:
+            json.dump(benchmark_results, output, indent=2)
+    else:
+        json.dump(benchmark_results, sys.stdout, indent=2)
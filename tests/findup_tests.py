@@ -1,6 +1,15 @@
 import argparse
+import json
+import os
+import random
+import re
+import signal
 import subprocess
+import tarfile
+import tempfile
+import time
 import unittest
+import zipfile
 
 ARGS = argparse.Namespace(findup = '../src/python3/findup.py')
 
@@ -21,11 +30,11 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Total wasted disk space in 2 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 2 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_paths_file(self):
@@ -35,14 +44,14 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/largeDups/largeDir1/largeDup11.txt\\s+"
             "data/largeDups/largeDir2/largeDup21.txt\\s+"
-            "Total wasted disk space in 3 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 3 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_paths_stdin(self):
@@ -53,14 +62,14 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/largeDups/largeDir1/largeDup11.txt\\s+"
             "data/largeDups/largeDir2/largeDup21.txt\\s+"
-            "Total wasted disk space in 3 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 3 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_no_summary(self):
@@ -71,7 +80,7 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir2/dup21.txt\\s*",
@@ -85,12 +94,12 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir1/notdup13-sameSize-differentLastChar.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Total wasted disk space in 3 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 3 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_min_file_size(self):
@@ -101,10 +110,10 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/largeDups/largeDir1/largeDup11.txt\\s+"
             "data/largeDups/largeDir2/largeDup21.txt\\s+"
-            "Total wasted disk space in 1 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_exec(self):
@@ -134,6 +143,207 @@ class TestVersionArgument(unittest.TestCase):
             "TESTING TESTING 1150183819_3834600595 data/largeDups/largeDir1/largeDup11.txt data/largeDups/largeDir2/largeDup21.txt\\s*",
             "Duplicate output does not match expected value")
 
+    def test_exec_order(self):
+        """Test that with the default --exec-jobs, command output follows the group it is executed for."""
+        result = subprocess.run(["python3", ARGS.findup, "-e", "echo", "data/dups", "data/largeDups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "^Duplicates \\(16 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/dups/dir1/dup11.txt\\s+data/dups/dir1/dup12.txt\\s+data/dups/dir2/dup21.txt\\s+"
+            "data/dups/dir1/dup11.txt data/dups/dir1/dup12.txt data/dups/dir2/dup21.txt\\s+"
+            "Duplicates \\(5296 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/largeDups/largeDir1/largeDup11.txt\\s+data/largeDups/largeDir2/largeDup21.txt\\s+"
+            "data/largeDups/largeDir1/largeDup11.txt data/largeDups/largeDir2/largeDup21.txt\\s+"
+            "Total wasted disk space in 3 files: [\\d.]+ \\w*B$",
+            "Command output does not follow its group")
+
+    def test_exec_batch(self):
+        """Test that --exec-batch gives groups to one command as NUL-delimited records and failures are reported."""
+        result = subprocess.run(["python3", ARGS.findup,
+             "-q", "-a", "--exec-batch", "10", "--exec-jobs", "2",
+             "-e", "python3 -c 'import sys; print(sys.argv[1:], sys.stdin.buffer.read().split(b\"\\0\"))' \"a b\"",
+             "data/dups", "data/largeDups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertEqual(result.stdout.strip(),
+            "['a b'] [b'2554083253_2843422385', b'data/dups/dir1/dup11.txt', b'data/dups/dir1/dup12.txt', "
+            "b'data/dups/dir2/dup21.txt', b'', b'1150183819_3834600595', b'data/largeDups/largeDir1/largeDup11.txt', "
+            "b'data/largeDups/largeDir2/largeDup21.txt', b'', b'']")
+
+        result = subprocess.run(["python3", ARGS.findup, "--exec-jobs", "2", "-e", "sh -c 'exit 3'", "-i", "data/paths.txt"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout, "Failed commands: 2 of 2 \\(exit codes: 3 x2\\)\\s+Total wasted")
+
+    def test_action(self):
+        """Test that --dry-run only reports what --action would do and --action=hardlink replaces duplicates."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["a", "b", "c"]:
+                with open(os.path.join(tmp_dir, name), "w") as f:
+                    f.write("identical contents")
+
+            result = subprocess.run(["python3", ARGS.findup, "--action", "hardlink", "--dry-run", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout, "Would hardlink .*/b\\s+Would hardlink .*/c\\s+"
+                "Would hardlink 2 files and reclaim [\\d.]+ \\w*B")
+            self.assertEqual(os.stat(os.path.join(tmp_dir, "a")).st_nlink, 1)
+
+            result = subprocess.run(["python3", ARGS.findup, "--action", "hardlink", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout, "Done hardlink of 2 files, reclaimed [\\d.]+ \\w*B")
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["a", "b", "c"])
+            self.assertEqual(os.stat(os.path.join(tmp_dir, "a")).st_nlink, 3)
+
+    def test_action_hard_links(self):
+        """Test that --action acts on all hard links to a duplicate and counts its space once."""
+        for action, expected_files in (("hardlink", ["x", "y", "y2"]), ("delete", ["x"])):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for name in ["x", "y"]:
+                    with open(os.path.join(tmp_dir, name), "w") as f:
+                        f.write("identical contents")
+                os.link(os.path.join(tmp_dir, "y"), os.path.join(tmp_dir, "y2"))
+
+                result = subprocess.run(["python3", ARGS.findup, "-H", "--action", action, tmp_dir],
+                    capture_output=True, text=True)
+
+                self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+                self.assertRegex(result.stdout, f"Done {action} of 2 files, reclaimed [\\d.]+ \\w*B")
+                self.assertEqual(sorted(os.listdir(tmp_dir)), expected_files)
+                self.assertEqual(os.stat(os.path.join(tmp_dir, "x")).st_nlink, len(expected_files))
+
+    def test_watch(self):
+        """Test that --watch reports duplicates of the files written after the scan."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, "a"), "w") as f:
+                f.write("identical contents")
+
+            process = subprocess.Popen(["python3", ARGS.findup, "--watch", "--watch-delay", "0.1", tmp_dir],
+                stdout=subprocess.PIPE, text=True)
+            self.assertRegex(process.stdout.readline(), "Total wasted disk space in 0 files")
+            self.assertRegex(process.stdout.readline(), "Watching 1 directories for changes")
+
+            os.mkdir(os.path.join(tmp_dir, "new"))
+            with open(os.path.join(tmp_dir, "new", "b"), "w") as f:
+                f.write("identical contents")
+
+            self.assertRegex(process.stdout.readline(), "Duplicates \\(18 bytes each, wasted [\\d.]+ \\w*B\\):")
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "a"))
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "new", "b"))
+
+            process.send_signal(signal.SIGINT)
+            process.communicate(timeout=10)
+            self.assertEqual(process.returncode, 0, "Program did not exit successfully")
+
+    def test_watch_action(self):
+        """Test that --watch does not handle files replaced by --action as changed ones, which would replace them
+        again and again."""
+        # Copy-on-write clones are not supported on all filesystems, so a clone is mocked with a copy
+        mock_clone = ("import fcntl, os, runpy, sys\n"
+                      "ioctl = fcntl.ioctl\n"
+                      "fcntl.ioctl = lambda fd, request, arg: (os.sendfile(fd, arg, 0, os.fstat(arg).st_size)\n"
+                      "    if request == 0x40049409 else ioctl(fd, request, arg))\n"
+                      "sys.argv = sys.argv[1:]\n"
+                      "runpy.run_path(sys.argv[0], run_name='__main__')\n")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ["a", "b"]:
+                with open(os.path.join(tmp_dir, name), "w") as f:
+                    f.write("identical contents")
+
+            process = subprocess.Popen(["python3", "-c", mock_clone, ARGS.findup, "--watch", "--watch-delay", "0.1",
+                 "--action", "reflink", tmp_dir],
+                stdout=subprocess.PIPE, text=True)
+            self.assertRegex(process.stdout.readline(), "Duplicates \\(18 bytes each, wasted [\\d.]+ \\w*B\\):")
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "a"))
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "b"))
+            self.assertRegex(process.stdout.readline(), "Done reflink of 1 files")
+            self.assertRegex(process.stdout.readline(), "Total wasted disk space in 1 files")
+            self.assertRegex(process.stdout.readline(), "Watching 1 directories for changes")
+
+            with open(os.path.join(tmp_dir, "c"), "w") as f:
+                f.write("identical contents")
+
+            self.assertRegex(process.stdout.readline(), "Duplicates \\(18 bytes each, wasted [\\d.]+ \\w*B\\):")
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "a"))
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "b"))
+            self.assertEqual(process.stdout.readline().strip(), os.path.join(tmp_dir, "c"))
+
+            time.sleep(1)
+            process.send_signal(signal.SIGINT)
+            stdout, _ = process.communicate(timeout=10)
+            self.assertEqual(process.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(stdout.strip(), "^Done reflink of 3 files, reclaimed [\\d.]+ \\w*B$",
+                "Replaced files are handled as changed ones")
+
+    def test_archives(self):
+        """Test that --archives finds duplicates among zip and tar members and loose files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with zipfile.ZipFile(os.path.join(tmp_dir, "a.zip"), "w", zipfile.ZIP_DEFLATED) as archive:
+                archive.write("data/dups/dir1/dup11.txt", "dir/dup.txt")
+                archive.write("data/dups/dir1/notdup13-sameSize-differentLastChar.txt", "notdup.txt")
+            with tarfile.open(os.path.join(tmp_dir, "b.tar.gz"), "w:gz") as archive:
+                archive.add("data/dups/dir1/dup11.txt", "dup.txt")
+
+            result = subprocess.run(["python3", ARGS.findup, "--archives", "-d", tmp_dir, "data/dups/dir2"],
+                capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(16 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            ".*/a.zip!dir/dup.txt\\s+"
+            ".*/b.tar.gz!dup.txt\\s+"
+            "data/dups/dir2/dup21.txt\\s+"
+            "Total wasted disk space in 2 files: [\\d.]+ \\w*B$")
+
+    def test_chunks(self):
+        """Test that --chunks reports files sharing most of their contents and deduplicable block space, and does not
+        split files of outstanding size."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            contents = random.Random(1).randbytes(200000)
+            with open(os.path.join(tmp_dir, "a"), "wb") as f:
+                f.write(contents)
+            with open(os.path.join(tmp_dir, "b"), "wb") as f:
+                f.write(contents[:100000] + b"inserted" + contents[100000:])
+            with open(os.path.join(tmp_dir, "c"), "wb") as f:
+                f.write(contents * 3)
+
+            result = subprocess.run(["python3", ARGS.findup, "--chunks", "--chunk-size", "4096", tmp_dir],
+                capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout, "Total wasted disk space in 0 files: 0 Bytes\\s+"
+            "Shared chunks \\([\\d.]+ \\w*B, 9\\d.\\d% and 9\\d.\\d% of the files\\):\\s+.*/a\\s+.*/b\\s+"
+            "Deduplicable block space in \\d+ chunks of 2 files: [\\d.]+ \\w*B of [\\d.]+ \\w*B \\(4\\d.\\d%\\)")
+
+    def test_chunks_common(self):
+        """Test that chunks common to many files do not pair them, and that the printed pairs are limited."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rng = random.Random(1)
+            for i in range(20):
+                with open(os.path.join(tmp_dir, f"file{i:02}"), "wb") as f:
+                    f.write(bytes(65536) + rng.randbytes(16384))
+
+            result = subprocess.run(["python3", ARGS.findup, "--chunks", "--chunk-size", "4096", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertNotIn("Shared chunks", result.stdout, "Files are paired by chunks common to all of them")
+            self.assertRegex(result.stdout, "Deduplicable block space in \\d+ chunks of 20 files: [\\d.]+ \\w*B "
+                "of [\\d.]+ \\w*B \\(7\\d.\\d%\\)")
+
+            result = subprocess.run(["python3", ARGS.findup, "--chunks", "--chunk-size", "4096",
+                 "--chunk-max-files", "20", "--chunk-max-pairs", "2", tmp_dir],
+                capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertEqual(result.stdout.count("Shared chunks"), 2, "Printed pairs are not limited")
+        self.assertRegex(result.stdout, "188 more pairs of files sharing less data are not shown")
+
     def test_paranoid(self):
         """Test that the program correctly returns its version when --version is passed."""
         result = subprocess.run(["python3", ARGS.findup,
@@ -142,15 +352,15 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir1/notdup13-sameSize-differentLastChar.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+            "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/notdup11.txt\\s+"
             "data/dups/dir1/notdup12-additionalLFs.txt\\s+"
-            "Total wasted disk space in 4 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 4 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
         result = subprocess.run(["python3", ARGS.findup,
@@ -159,11 +369,11 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
             "data/dups/dir2/dup21.txt\\s+"
-            "Total wasted disk space in 2 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 2 files: [\\d.]+ \\w*B\\s*",
             "Duplicate output does not match expected value")
 
     def test_exclude_dir(self):
@@ -173,10 +383,10 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
-            "Total wasted disk space in 1 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s*",
                      "Duplicate output does not match expected value")
 
     def test_exclude_file(self):
@@ -186,10 +396,10 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
-            "Total wasted disk space in 1 files: [\\d.]+ MB\\s*",
+            "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s*",
                      "Duplicate output does not match expected value")
 
 
@@ -200,12 +410,473 @@ class TestVersionArgument(unittest.TestCase):
             capture_output=True, text=True)
 
         self.assertEqual(result.returncode, 0, "Program did not exit successfully")
-        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ MB\\):\\s+"
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/dups/dir1/dup11.txt\\s+"
+            "data/dups/dir1/dup12.txt\\s+"
+            "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s*",
+            "Duplicate output does not match expected value")
+
+    def test_exclude_re_flags(self):
+        """Test that -X regular expressions starting with global flags like (?i) can be used with other ones."""
+        result = subprocess.run(["python3", ARGS.findup,
+             "-X", "(?i).*DUP11", "-X", ".*weird", "data/dups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/dups/dir1/dup12.txt\\s+"
+            "data/dups/dir2/dup21.txt\\s+"
+            "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s*",
+            "Duplicate output does not match expected value")
+
+    def test_cache(self):
+        """Test that the second run with --cache takes all hashes from the cache."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, "cache.db")
+            args = ["python3", ARGS.findup, "-S", "-c", cache_file, "--cache-stats", "data/dups"]
+
+            result = subprocess.run(args, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout, "Hash cache: \\d+ hits, [1-9]\\d* misses",
+                "Cache statistics of the first run do not match expected value")
+
+            result = subprocess.run(args, capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "data/dups/dir1/dup11.txt\\s+"
+                "data/dups/dir1/dup12.txt\\s+"
+                "data/dups/dir2/dup21.txt\\s+"
+                "Hash cache: \\d+ hits, 0 misses",
+                "Duplicate output does not match expected value")
+
+    def test_follow_symlinks(self):
+        """Test that symbolic links are skipped unless --follow-symlinks is given, and link loops are not followed."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for dir_name in ("scanned", "linked"):
+                os.mkdir(os.path.join(tmp_dir, dir_name))
+                with open(os.path.join(tmp_dir, dir_name, "file.txt"), "w") as f:
+                    f.write("symbolic link test")
+            os.symlink(os.path.join("..", "linked"), os.path.join(tmp_dir, "scanned", "link"))
+            os.symlink(".", os.path.join(tmp_dir, "scanned", "loop"))
+            scanned_dir = os.path.join(tmp_dir, "scanned")
+
+            result = subprocess.run(["python3", ARGS.findup, "-S", scanned_dir], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertEqual(result.stdout.strip(), "", "Symbolic links should not be followed by default")
+
+            result = subprocess.run(["python3", ARGS.findup, "-S", "-L", scanned_dir], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(), "^Duplicates \\(18 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "\\S+/scanned/file.txt\\s+"
+                "\\S+/scanned/link/file.txt$",
+                "Duplicate output does not match expected value")
+
+    def test_jobs(self):
+        """Test that parallel hashing in threads and processes gives the same output as sequential hashing."""
+        args = ["python3", ARGS.findup, "-a", "-i", "data/paths.txt"]
+        expected = subprocess.run(args, capture_output=True, text=True).stdout
+
+        for backend in ("thread", "process"):
+            result = subprocess.run(args + ["-j", "4", "--device-jobs", "2", "--jobs-backend", backend],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertEqual(result.stdout, expected, f"Output with {backend} jobs does not match sequential output")
+
+        result = subprocess.run(["python3", ARGS.findup, "-q", "-a", "-e", "echo", "-j", "2", "--buffer-memory", "4096",
+             "data/largeDups"],
+            capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertEqual(result.stdout.strip(),
+            "1150183819_3834600595 data/largeDups/largeDir1/largeDup11.txt data/largeDups/largeDir2/largeDup21.txt",
+            "Hash calculated with small --buffer-memory does not match expected value")
+
+    def test_hard_links(self):
+        """Test that hard links are not reported as duplicates and are listed separately with --hard-links."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for file_name in ("a.txt", "c.txt"):
+                with open(os.path.join(tmp_dir, file_name), "w") as f:
+                    f.write("hard link test")
+            os.link(os.path.join(tmp_dir, "c.txt"), os.path.join(tmp_dir, "b.txt"))
+            os.link(os.path.join(tmp_dir, "c.txt"), os.path.join(tmp_dir, "d.txt"))
+
+            result = subprocess.run(["python3", ARGS.findup, "-H", tmp_dir], capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(), "^Duplicates \\(14 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "\\S+/a.txt\\s+"
+                "\\S+/b.txt\\s+"
+                "Hard links \\(14 bytes each, no space wasted\\):\\s+"
+                "\\S+/b.txt\\s+"
+                "\\S+/c.txt\\s+"
+                "\\S+/d.txt\\s+"
+                "Total wasted disk space in 1 files: [\\d.]+ \\w*B\\s+"
+                "Hard links to already counted files \\(no space wasted\\): 2$",
+                "Duplicate output does not match expected value")
+
+    def test_overlapping_paths(self):
+        """Test that files found twice via repeated or overlapping paths are not reported as hard links."""
+        result = subprocess.run(["python3", ARGS.findup, "-H", "data/dups", "data/dups/dir1", "data/dups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "^Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/dups/dir1/dup11.txt\\s+"
+            "data/dups/dir1/dup12.txt\\s+"
+            "data/dups/dir2/dup21.txt\\s+"
+            "Total wasted disk space in 2 files: [\\d.]+ \\w*B$",
+            "Duplicate output does not match expected value")
+
+    def test_stages(self):
+        """Test that files sharing a prefix but differing at the end are eliminated by the suffix stage."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for file_name, last_char in (("a.bin", b"a"), ("b.bin", b"b")):
+                with open(os.path.join(tmp_dir, file_name), "wb") as f:
+                    f.write(b"\0" * 100000 + last_char)
+
+            result = subprocess.run(["python3", ARGS.findup, "-v", "-s", "prefix,suffix,samples,full", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout,
+                "Stage prefix: 2 files \\(200.0 kB\\) in, 0 files \\(0 Bytes\\) eliminated\\s+"
+                "Stage suffix: 2 files \\(200.0 kB\\) in, 2 files \\(200.0 kB\\) eliminated\\s+"
+                "Stage samples: 0 files \\(0 Bytes\\) in, 0 files \\(0 Bytes\\) eliminated\\s+"
+                "Stage full: 0 files \\(0 Bytes\\) in, 0 files \\(0 Bytes\\) eliminated\\s+"
+                "Total wasted disk space in 0 files",
+                "Stage statistics do not match expected value")
+
+            result = subprocess.run(["python3", ARGS.findup, "-v", "-s", "samples,full", "--sample-count", "0", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertIn("will skip samples stage", result.stdout)
+            self.assertNotIn("Stage samples", result.stdout, "Samples stage without samples should be skipped")
+
+    def test_paranoid_chunks(self):
+        """Test that --paranoid splits groups of files differing after the first chunk, with few open files."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for file_name, last_char in (("a.bin", b"a"), ("b.bin", b"b"), ("c.bin", b"a"), ("d.bin", b"b")):
+                with open(os.path.join(tmp_dir, file_name), "wb") as f:
+                    f.write(b"\0" * 200000 + last_char)
+
+            result = subprocess.run(["python3", ARGS.findup, "-d", "--buffer-memory", "1", "--max-open-files", "1",
+                 "--mock-prefix-hash", "0", "--mock-full-hash", "1", tmp_dir],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(), "^Duplicates \\(200001 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "\\S+/a.bin\\s+"
+                "\\S+/c.bin\\s+"
+                "Duplicates \\(200001 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "\\S+/b.bin\\s+"
+                "\\S+/d.bin\\s+"
+                "Total wasted disk space in 2 files",
+                "Duplicate output does not match expected value")
+
+    def test_io_method(self):
+        """Test that all I/O methods give the same hashes and --paranoid results."""
+        for args in (["-a", "-i", "data/paths.txt"],
+                     ["-d", "--mock-prefix-hash", "0", "--mock-full-hash", "1", "data/dups"]):
+            expected = subprocess.run(["python3", ARGS.findup, "--io-method", "read"] + args,
+                capture_output=True, text=True).stdout
+
+            for io_method in ("readinto", "mmap"):
+                result = subprocess.run(["python3", ARGS.findup, "--io-method", io_method] + args,
+                    capture_output=True, text=True)
+
+                self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+                self.assertEqual(result.stdout, expected, f"Output with {io_method} does not match output with read")
+
+    def test_hash_engines(self):
+        """Test that all hash engines find the same duplicates, and --hash-benchmark lists them."""
+        for hash_engine in ("mmh3-128", "blake2b", "auto"):
+            result = subprocess.run(["python3", ARGS.findup,
+                 "-q", "-a", "-e", "echo TESTING", "--hash", hash_engine,
+                 "data/dups", "data/largeDups"],
+                capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(),
+                "^TESTING [0-9a-f]{32} data/dups/dir1/dup11.txt data/dups/dir1/dup12.txt data/dups/dir2/dup21.txt\\s+"
+                "TESTING [0-9a-f]{32} data/largeDups/largeDir1/largeDup11.txt data/largeDups/largeDir2/largeDup21.txt$",
+                f"Duplicate output with {hash_engine} hash does not match expected value")
+
+        result = subprocess.run(["python3", ARGS.findup, "--hash-benchmark"], capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout, "crc32\\+mmh3: [\\d.]+ \\w*B/s",
+            "Benchmark output does not match expected value")
+
+    def test_exclude_dir_and_include(self):
+        """Test that --exclude-dir skips directories and -I/-M filter files."""
+        result = subprocess.run(["python3", ARGS.findup, "-vv",
+             "--exclude-dir", "dir[13]", "-I", "*/largeDup*", "-I", "*/dup*", "-M", "5296",
+             "data/dups", "data/largeDups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertIn("SKIPPED: data/dups/dir1/: excluded via --exclude-dir", result.stdout)
+        self.assertNotIn("dir1/dup11.txt", result.stdout)
+        self.assertRegex(result.stdout, "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "data/largeDups/largeDir1/largeDup11.txt\\s+"
+            "data/largeDups/largeDir2/largeDup21.txt\\s+"
+            "Total wasted disk space in 1 files",
+            "Duplicate output does not match expected value")
+
+        result = subprocess.run(["python3", ARGS.findup, "-M", "5295", "data/dups", "data/largeDups"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(\\d+ bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
             "data/dups/dir1/dup11.txt\\s+"
             "data/dups/dir1/dup12.txt\\s+"
-            "Total wasted disk space in 1 files: [\\d.]+ MB\\s*",
+            "data/dups/dir2/dup21.txt\\s+"
+            "Total wasted disk space in 2 files",
             "Duplicate output does not match expected value")
 
+    def test_file_table(self):
+        """Test that only files with non-unique sizes become candidates."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, data in (("a", b"same"), ("b", b"same"), ("c", b"other"), ("d", b"unique size")):
+                with open(os.path.join(tmp_dir, name), "wb") as f:
+                    f.write(data)
+
+            result = subprocess.run(["python3", ARGS.findup, "-v", tmp_dir], capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertIn("File table: 4 files", result.stdout)
+        self.assertIn("Candidates: 2 files in 1 groups of the same size", result.stdout)
+        self.assertIn("Total wasted disk space in 1 files", result.stdout)
+
+    def test_memory_limit(self):
+        """Test that spilling the file table to disk and processing candidates in batches gives the same result."""
+        result = subprocess.run(["python3", ARGS.findup, "-i", "data/paths.txt"], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+        for extra_args in (["--memory-limit", "1"], ["--memory-limit", "1", "--max-open-files", "2"]):
+            limited_result = subprocess.run(["python3", ARGS.findup, "-v", *extra_args, "-i", "data/paths.txt"],
+                capture_output=True, text=True)
+
+            self.assertEqual(limited_result.returncode, 0, "Program did not exit successfully")
+            self.assertNotIn("run files spilled to disk", limited_result.stdout, "Runs are smaller than the minimum")
+            self.assertEqual(result.stdout, "".join(line for line in limited_result.stdout.splitlines(keepends=True)
+                                                    if line.startswith(("Duplicates", "    ", "Total"))))
+
+    def test_memory_limit_runs(self):
+        """Test that run files spilled with --memory-limit are merged as soon as there are --max-open-files of them."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Long names make the file table grow over the minimum run size with fewer files
+            for dir_number in range(20):
+                os.mkdir(os.path.join(tmp_dir, str(dir_number)))
+                for file_number in range(1000):
+                    with open(os.path.join(tmp_dir, str(dir_number), f"{file_number:0240}"), "w") as f:
+                        f.write(f"{file_number % 500:08}")
+
+            result = subprocess.run(["python3", ARGS.findup, tmp_dir], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+            limited_result = subprocess.run(["python3", ARGS.findup, "-v", "--memory-limit", "1",
+                 "--max-open-files", "2", tmp_dir],
+                capture_output=True, text=True)
+
+        self.assertEqual(limited_result.returncode, 0, "Program did not exit successfully")
+        self.assertIn("Merged run files of 20000 files into one", limited_result.stdout)
+        self.assertEqual(result.stdout, "".join(line for line in limited_result.stdout.splitlines(keepends=True)
+                                                if line.startswith(("Duplicates", "    ", "Total"))))
+
+    def test_pipeline(self):
+        """Test that hashing while scanning gives the same result and does not hash files twice."""
+        result = subprocess.run(["python3", ARGS.findup, "-vvv", "-i", "data/paths.txt"],
+            capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+        for extra_args in ([], ["-j", "3"]):
+            pipeline_result = subprocess.run(["python3", ARGS.findup, "-vvv", "--pipeline", *extra_args,
+                 "-i", "data/paths.txt"], capture_output=True, text=True)
+
+            self.assertEqual(pipeline_result.returncode, 0, "Program did not exit successfully")
+            self.assertIn("Hashed 8 files (", pipeline_result.stdout)
+            self.assertEqual(result.stdout.count("Calculated hash"), pipeline_result.stdout.count("Calculated hash"))
+            self.assertEqual(result.stdout[result.stdout.index("Duplicates"):],
+                             pipeline_result.stdout[pipeline_result.stdout.index("Duplicates"):])
+
+    def test_allocated_size(self):
+        """Test that wasted space is calculated from allocated blocks, so sparse files waste no space."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ("sparse1", "sparse2"):
+                with open(os.path.join(tmp_dir, name), "wb") as f:
+                    f.truncate(10 * 1024 * 1024)
+
+            result = subprocess.run(["python3", ARGS.findup, tmp_dir], capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(10485760 bytes each, wasted 0 Bytes\\):\\s+"
+            ".*sparse1\\s+"
+            ".*sparse2\\s+"
+            "Total wasted disk space in 1 files: 0 Bytes")
+
+    def test_io_order(self):
+        """Test that the order of reading files does not change the result."""
+        result = subprocess.run(["python3", ARGS.findup, "-i", "data/paths.txt"], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+        for io_order in ("none", "inode", "physical"):
+            for jobs in ("1", "3"):
+                ordered_result = subprocess.run(["python3", ARGS.findup, "--io-order", io_order, "-j", jobs,
+                     "-i", "data/paths.txt"], capture_output=True, text=True)
+
+                self.assertEqual(ordered_result.returncode, 0, "Program did not exit successfully")
+                self.assertEqual(result.stdout, ordered_result.stdout)
+
+        result = subprocess.run(["python3", ARGS.findup, "-vv", "--io-order", "physical", "-i", "data/paths.txt"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout, "Physical read order: \\d+ of 8 files located, estimated seek distance")
+
+    def test_read_policy(self):
+        """Test that page cache read policies do not change the result, and that I/O counters are printed."""
+        result = subprocess.run(["python3", ARGS.findup, "-i", "data/paths.txt"], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+        for read_policy in ("normal", "fadvise", "direct"):
+            for jobs in ("1", "3"):
+                policy_result = subprocess.run(["python3", ARGS.findup, "--read-policy", read_policy, "-j", jobs,
+                     "-s", "prefix,suffix,full", "--suffix-size", "1000", "--io-stats", "-i", "data/paths.txt"],
+                    capture_output=True, text=True)
+
+                self.assertEqual(policy_result.returncode, 0, "Program did not exit successfully")
+                self.assertTrue(policy_result.stdout.startswith(result.stdout))
+                self.assertRegex(policy_result.stdout, "I/O: [\\d.]+ \\w*B read from files")
+
+    def test_manifest_merge(self):
+        """Test that manifests of several hosts are merged, requesting full hashes only for prefix collisions."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_a = os.path.join(tmp_dir, "a.jsonl")
+            manifest_b = os.path.join(tmp_dir, "b.jsonl")
+            manifest_b_full = os.path.join(tmp_dir, "b-full.jsonl")
+            request_dir = os.path.join(tmp_dir, "requests")
+
+            for host, manifest, paths in (("hostA", manifest_a, ["data/dups/dir2"]),
+                                          ("hostB", manifest_b, ["data/dups/dir1", "data/largeDups"])):
+                result = subprocess.run(["python3", ARGS.findup, "--write-manifest", manifest, "--host", host,
+                     *paths], capture_output=True, text=True)
+                self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+            result = subprocess.run(["python3", ARGS.findup, "--merge", manifest_a, "--merge", manifest_b,
+                 "--request-dir", request_dir], capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertRegex(result.stdout.strip(), "Duplicates \\(16 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+                "hostA:data/dups/dir2/dup21.txt\\s+"
+                "hostB:data/dups/dir1/dup11.txt\\s+"
+                "hostB:data/dups/dir1/dup12.txt\\s+"
+                "Total wasted disk space in 2 files: [\\d.]+ \\w*B\\s+"
+                "Duplicate groups spanning several hosts: 1\\s+"
+                "Full hashes are needed for 2 files on 1 hosts")
+            with open(os.path.join(request_dir, "hostB.paths")) as f:
+                self.assertEqual(f.read(), "data/largeDups/largeDir1/largeDup11.txt\n"
+                                           "data/largeDups/largeDir2/largeDup21.txt\n")
+
+            result = subprocess.run(["python3", ARGS.findup, "--write-manifest", manifest_b_full, "--host", "hostB",
+                 "--manifest-full-hashes", "-i", os.path.join(request_dir, "hostB.paths")],
+                capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+            result = subprocess.run(["python3", ARGS.findup, "--merge", manifest_a, "--merge", manifest_b,
+                 "--merge", manifest_b_full], capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Duplicates \\(5296 bytes each, wasted [\\d.]+ \\w*B\\):\\s+"
+            "hostB:data/largeDups/largeDir1/largeDup11.txt\\s+"
+            "hostB:data/largeDups/largeDir2/largeDup21.txt\\s+"
+            "Total wasted disk space in 3 files: [\\d.]+ \\w*B\\s+"
+            "Duplicate groups spanning several hosts: 1$")
+
+    def test_index(self):
+        """Test that files are checked against a reference index built beforehand."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, "index.db")
+
+            result = subprocess.run(["python3", ARGS.findup, "--build-index", index_file,
+                 "data/dups/dir1", "data/largeDups/largeDir1"], capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertEqual(result.stdout.strip(), "Indexed 6 files")
+
+            result = subprocess.run(["python3", ARGS.findup, "--against", index_file,
+                 "data/dups/dir2", "data/largeDups/largeDir2"], capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout.strip(), "Already in index \\(16 bytes each\\):\\s+"
+            "data/dups/dir2/dup21.txt\\s+"
+            "/.*/data/dups/dir1/dup11.txt\\s+"
+            "/.*/data/dups/dir1/dup12.txt\\s+"
+            "Already in index \\(5296 bytes each\\):\\s+"
+            "data/largeDups/largeDir2/largeDup21.txt\\s+"
+            "/.*/data/largeDups/largeDir1/largeDup11.txt\\s+"
+            "Files already in index: 2 of 2 ")
+
+    def test_index_overlapping(self):
+        """Test that a found file does not match its own entry when the queried directory is indexed too."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_file = os.path.join(tmp_dir, "index.db")
+
+            result = subprocess.run(["python3", ARGS.findup, "--build-index", index_file, "data/dups"],
+                capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+
+            result = subprocess.run(["python3", ARGS.findup, "--against", index_file, "data/dups/dir1"],
+                capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertNotRegex(result.stdout, "data/dups/dir1/(\\w+.txt)\\s+/.*/data/dups/dir1/\\1",
+            "A file is reported as a copy of itself")
+        self.assertNotIn("notdup", result.stdout, "Files without copies are reported as already in index")
+        self.assertRegex(result.stdout, "Files already in index: 2 of 5 ")
+
+    def test_stats_and_profile(self):
+        """Test that per-stage statistics are printed as text and JSON, and the profile is saved."""
+        result = subprocess.run(["python3", ARGS.findup, "--stats", "-d", "-i", "data/paths.txt"],
+            capture_output=True, text=True)
+
+        self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+        self.assertRegex(result.stdout, "Statistics:\\s+"
+            "Stage scan: [\\d.]+ s, CPU [\\d.]+ s, 8 files in, 8 files out\\s+"
+            "Stage size: .*, 8 files in, 8 files out \\(0.0% eliminated\\)\\s+"
+            "Stage prefix: .*, 8 files in, 5 files out \\(37.5% eliminated\\), [\\d.]+ \\w*B read, .*/s\\s+"
+            "Stage full: .*, 5 files in, 5 files out .*\\s+"
+            "Stage paranoid: .*, 5 files in, 5 files out .*\\s+"
+            "Largest duplicate groups:\\s+"
+            "2 files of 5296 bytes, wasted [\\d.]+ \\w*B: data/largeDups/largeDir1/largeDup11.txt\\s+"
+            "3 files of 16 bytes, wasted [\\d.]+ \\w*B: data/dups/dir1/dup11.txt")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profile_file = os.path.join(tmp_dir, "findup.prof")
+            result = subprocess.run(["python3", ARGS.findup, "-q", "--stats=json", "--profile", profile_file,
+                 "-i", "data/paths.txt"], capture_output=True, text=True)
+
+            self.assertEqual(result.returncode, 0, "Program did not exit successfully")
+            self.assertTrue(os.path.getsize(profile_file) > 0)
+
+        stats = json.loads(result.stdout)
+        self.assertEqual([stage["stage"] for stage in stats["stages"]], ["scan", "size", "prefix", "full"])
+        self.assertEqual(stats["stages"][2]["files_out"], 5)
+        self.assertEqual(len(stats["largest_groups"]), 2)
+
+    def test_progress(self):
+        """Test that the progress line goes to stderr and does not change the output, also with -vvv."""
+        result = subprocess.run(["python3", ARGS.findup, "-vvv", "-i", "data/paths.txt"], capture_output=True,
+            text=True)
+        progress_result = subprocess.run(["python3", ARGS.findup, "-vvv", "--progress", "-i", "data/paths.txt"],
+            capture_output=True, text=True)
+
+        self.assertEqual(progress_result.returncode, 0, "Program did not exit successfully")
+        self.assertEqual(re.sub("[\\d.]+", "N", progress_result.stdout), re.sub("[\\d.]+", "N", result.stdout))
+        self.assertRegex(progress_result.stderr, "Scanned 8 files \\([\\d.]+ \\w*B\\), hashed [\\d.]+ \\w*B of "
+            "[\\d.]+ \\w*B \\(.*/s, ETA [\\d:]+\\)\n$")
+
 
 def parse_args():
     p = argparse.ArgumentParser()